@@ -0,0 +1,122 @@
+"""
+Benchmark the cold-start cost of importing navo_utils.
+
+Imports each module in a fresh interpreter under `python -X importtime`,
+several times, and reports the median cumulative import time and which heavy
+dependencies (astroquery, astropy.table, astropy.coordinates, IPython, ...)
+the import pulled in.  With --ref, the same is measured for the package as
+it was at an earlier git revision, extracted to a temporary directory, to
+show the change.
+
+Usage:
+    python benchmarks/bench_import.py [--repeat 7] [--ref HEAD~1] [--output import_times.json]
+        [--modules navo_utils.cone ...]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['navo_utils', 'navo_utils.utils', 'navo_utils.cone', 'navo_utils.image', 'navo_utils.spectra',
+           'navo_utils.tap', 'navo_utils.registry', 'workshop_utils.download']
+
+HEAVY = ['astroquery', 'astropy', 'astropy.units', 'astropy.table', 'astropy.coordinates', 'astropy.io.votable',
+         'IPython', 'requests', 'numpy']
+
+_SCRIPT = 'import sys, json, {0}; print(json.dumps([m for m in {1!r} if m in sys.modules]))'
+
+
+def import_once(module, tree):
+    """
+    Imports module in a new interpreter with tree first on the path.
+
+    Returns
+    -------
+    (float, list of str) or None
+        The cumulative import time in seconds and the heavy modules loaded,
+        or None if the import failed.
+    """
+    env = dict(os.environ, PYTHONPATH=tree)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _SCRIPT.format(module, HEAVY)],
+                          cwd=tree, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].rstrip() == ' ' + module:
+            return int(parts[1]) * 1e-6, json.loads(proc.stdout.strip().splitlines()[-1])
+    return None
+
+
+def measure(tree, modules, repeat):
+    results = {}
+    for module in modules:
+        # The first import compiles the .pyc files; it is not counted.
+        if import_once(module, tree) is None:
+            results[module] = None
+            continue
+        runs = [import_once(module, tree) for _ in range(repeat)]
+        times = [run[0] for run in runs if run is not None]
+        results[module] = {
+            'median_ms': 1e3 * statistics.median(times),
+            'min_ms': 1e3 * min(times),
+            'heavy': runs[-1][1] if runs[-1] is not None else None,
+        }
+    return results
+
+
+def extract(ref, directory):
+    """
+    Writes the packages as of git revision ref into directory.
+    """
+    archive = subprocess.run(['git', 'archive', ref, 'navo_utils', 'workshop_utils'], cwd=ROOT,
+                             capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=7, help='timed imports per module')
+    parser.add_argument('--ref', help='git revision to compare with')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    current = measure(os.path.abspath(ROOT), args.modules, args.repeat)
+    before = None
+    if args.ref:
+        with tempfile.TemporaryDirectory() as directory:
+            extract(args.ref, directory)
+            before = measure(directory, args.modules, args.repeat)
+
+    for module in args.modules:
+        now = current[module]
+        line = '{:<26s}'.format(module)
+        line += '  {:8.1f} ms'.format(now['median_ms']) if now else '    failed'
+        if before is not None:
+            old = before.get(module)
+            if old and now:
+                line += '   {}: {:8.1f} ms  ({:.1f}x faster)'.format(args.ref, old['median_ms'],
+                                                                     old['median_ms'] / now['median_ms'])
+            else:
+                line += '   {}: failed'.format(args.ref)
+        if now:
+            line += '   loads: {}'.format(', '.join(now['heavy']) or '-')
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version, 'repeat': args.repeat, 'ref': args.ref, 'current': current,
+                       'before': before}, f, indent=1)
+        print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark the per-request latency saved by the shared keep-alive session.
+
+Runs a local stand-in HTTP/1.1 server that returns a small VOTABLE and times
+the same GET sent (a) with a fresh requests.Session per request, as try_query
+used to do via astroquery's BaseQuery, and (b) through utils.try_query, which
+reuses pooled connections.
+
+Usage:
+    python benchmarks/bench_session.py [n_requests]
+"""
+
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from navo_utils import utils
+
+VOTABLE = b"""<?xml version="1.0" encoding="utf-8"?>
+<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+ <RESOURCE type="results">
+  <TABLE>
+   <FIELD name="ra" datatype="double" ucd="pos.eq.ra;meta.main"/>
+   <FIELD name="dec" datatype="double" ucd="pos.eq.dec;meta.main"/>
+   <DATA><TABLEDATA>
+    <TR><TD>10.0</TD><TD>20.0</TD></TR>
+   </TABLEDATA></DATA>
+  </TABLE>
+ </RESOURCE>
+</VOTABLE>
+"""
+
+
+class VOTableHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(VOTABLE)))
+        self.end_headers()
+        self.wfile.write(VOTABLE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def time_requests(send, url, n):
+    latencies = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        send(url)
+        latencies.append(time.perf_counter() - t0)
+    latencies.sort()
+    return {
+        'mean_ms': 1e3 * sum(latencies) / n,
+        'median_ms': 1e3 * latencies[n // 2],
+        'p95_ms': 1e3 * latencies[int(0.95 * (n - 1))],
+    }
+
+
+def fresh_session_get(url):
+    with requests.Session() as session:
+        return session.get(url, params={'RA': 10.0, 'DEC': 20.0, 'SR': 0.1}, timeout=60).content
+
+
+def shared_session_get(url):
+    return utils.try_query(url, get_params={'RA': 10.0, 'DEC': 20.0, 'SR': 0.1}).content
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = ThreadingHTTPServer(('127.0.0.1', 0), VOTableHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/cone'.format(server.server_address[1])
+
+    try:
+        # Warm up both paths.
+        fresh_session_get(url)
+        shared_session_get(url)
+
+        fresh = time_requests(fresh_session_get, url, n)
+        shared = time_requests(shared_session_get, url, n)
+    finally:
+        server.shutdown()
+
+    print('{} requests to {}'.format(n, url))
+    for label, stats in [('fresh session per request', fresh), ('shared pooled session', shared)]:
+        print('  {:<28s} mean {mean_ms:7.3f} ms   median {median_ms:7.3f} ms   p95 {p95_ms:7.3f} ms'.format(label, **stats))
+    print('  saved per request (mean): {:.3f} ms'.format(fresh['mean_ms'] - shared['mean_ms']))
+
+
+if __name__ == '__main__':
+    main()
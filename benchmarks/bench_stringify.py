@@ -0,0 +1,83 @@
+"""
+Micro-benchmark for decoding bytes columns in utils.stringify_table.
+
+Builds a wide table of object columns holding bytes, as the VOTABLE reader
+produces for char fields, and compares the old per-cell np.vectorize(sval)
+path with the bulk per-column decoder, reporting rows per second and the
+memory held by the resulting string columns.
+
+Usage:
+    python benchmarks/bench_stringify.py [n_rows] [n_columns]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from astropy.table import MaskedColumn, Table
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from navo_utils import utils
+
+
+def make_table(n_rows, n_columns):
+    rng = np.random.default_rng(42)
+    table = Table(masked=True)
+    for j in range(n_columns):
+        lengths = rng.integers(4, 24, size=n_rows)
+        values = np.empty(n_rows, dtype=object)
+        values[:] = [('val{}_'.format(j) + 'x' * k).encode('utf-8') for k in lengths]
+        mask = rng.random(n_rows) < 0.05
+        table.add_column(MaskedColumn(values, name='col{}'.format(j), mask=mask, meta={'ucd': 'meta.id'}))
+    return table
+
+
+def old_stringify(table):
+    # The previous implementation: one Python call per cell via np.vectorize.
+    for colname in table.colnames:
+        table[colname] = utils.svalv(table[colname])
+
+
+def object_stringify(table):
+    # Reference point: Python str objects in an object array.
+    for colname in table.colnames:
+        values = np.empty(len(table), dtype=object)
+        values[:] = [utils.sval(v) for v in np.ma.getdata(table[colname])]
+        table[colname] = values
+
+
+def column_bytes(table):
+    total = 0
+    for colname in table.colnames:
+        data = np.ma.getdata(table[colname])
+        total += data.nbytes
+        if data.dtype.kind == 'O':
+            total += sum(sys.getsizeof(v) for v in data)
+    return total
+
+
+def run(label, func, n_rows, n_columns):
+    table = make_table(n_rows, n_columns)
+    t0 = time.perf_counter()
+    func(table)
+    elapsed = time.perf_counter() - t0
+    print('  {:<22s} {:8.3f} s  {:12,.0f} rows/s  {:8.1f} MB in string columns'.format(
+        label, elapsed, n_rows / elapsed, column_bytes(table) / 2**20))
+    return table
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print('{} rows x {} bytes columns'.format(n_rows, n_columns))
+    run('object array of str', object_stringify, n_rows, n_columns)
+    old = run('np.vectorize(sval)', old_stringify, n_rows, n_columns)
+    new = run('bulk column decode', utils.stringify_table, n_rows, n_columns)
+    for colname in new.colnames:
+        unmasked = ~np.ma.getmaskarray(new[colname])
+        assert np.all(np.asarray(old[colname])[unmasked] == np.asarray(new[colname])[unmasked])
+
+
+if __name__ == '__main__':
+    main()
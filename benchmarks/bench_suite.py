@@ -0,0 +1,244 @@
+"""
+End-to-end throughput benchmark of the navo_utils query classes against a
+local stand-in server (see vo_standin.py), plus the parse-only cost of
+utils.astropy_table_from_votable_response.
+
+For each service (Cone, Image, Spectra, Tap, Registry) and each response
+size, sends n queries through the public query() method and reports
+queries and rows per second and the per-query latency percentiles, taken
+from the metrics spans of the queries.  The parse benchmark times the same
+synthetic VOTABLEs without any network.  Result and disk caches are off.
+
+Results are written as JSON; give --compare an earlier result file to print
+the relative change of each measurement.
+
+Usage:
+    python benchmarks/bench_suite.py [--rows 10 1000] [--width 16] [--columns 4]
+        [--latency 0] [--requests 200] [--workers 8] [--services cone tap ...] [--parse-pool 4]
+        [--output bench_results.json] [--compare baseline.json]
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from navo_utils import cache, metrics, parse_pool, utils
+from navo_utils.cone import Cone
+from navo_utils.image import Image
+from navo_utils.registry import Registry
+from navo_utils.spectra import Spectra
+from navo_utils.tap import Tap
+from vo_standin import KINDS, StandinServer, make_votable
+
+
+def positions(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0., 360., n), np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+
+
+def run_service(kind, url, n, workers):
+    """
+    Sends n queries of one kind; returns the result tables and the wall time.
+    """
+    ra, dec = positions(n)
+    start = time.perf_counter()
+    if kind == 'cone':
+        results = Cone.query(url, (ra, dec), 0.01, max_workers=workers)
+    elif kind == 'image':
+        results = Image.query(url, (ra, dec), 0.01, max_workers=workers)
+    elif kind == 'spectra':
+        results = Spectra.query(url, (ra, dec), 0.01, max_workers=workers)
+    else:
+        if kind == 'tap':
+            call = lambda i: Tap.query(url, 'SELECT * FROM stand.in WHERE source_id = {}'.format(i))
+        else:
+            call = lambda i: Registry.query(service_type='image', keyword='stand-in {}'.format(i))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(call, range(n)))
+    return results, time.perf_counter() - start
+
+
+def percentiles(seconds):
+    seconds = np.asarray(seconds, dtype=float)
+    if len(seconds) == 0:
+        return None
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+    return {'mean_ms': 1e3 * float(seconds.mean()), 'p50_ms': 1e3 * float(p50), 'p95_ms': 1e3 * float(p95),
+            'p99_ms': 1e3 * float(p99)}
+
+
+def bench_service(server, kind, rows, width, columns, latency, n, workers):
+    url = server.url(kind, rows=rows, width=width, columns=columns, latency=latency)
+    registry_url = Registry._REGISTRY_TAP_SYNC_URL
+    if kind == 'registry':
+        Registry._REGISTRY_TAP_SYNC_URL = url
+
+    sink = metrics.MemorySink()
+    try:
+        # One untimed query warms up the connection pool and the server's body cache.
+        run_service(kind, url, 1, 1)
+        metrics.add_sink(sink)
+        results, wall = run_service(kind, url, n, workers)
+    finally:
+        metrics.remove_sink(sink)
+        Registry._REGISTRY_TAP_SYNC_URL = registry_url
+
+    records = [r for r in sink.records if r['kind'] == kind]
+    errors = sum(1 for t in results if t is None or t.meta.get('error') or len(t) != rows)
+    phases = {phase: percentiles([r[phase] for r in records if r.get(phase) is not None])
+              for phase in metrics.PHASES}
+    return {
+        'benchmark': 'query',
+        'service': kind,
+        'rows': rows,
+        'width': width,
+        'columns': columns,
+        'server_latency': latency,
+        'requests': n,
+        'workers': workers,
+        'parse_pool': parse_pool.get_pool() is not None,
+        'errors': errors,
+        'wall_s': wall,
+        'queries_per_s': n / wall,
+        'rows_per_s': n * rows / wall,
+        'bytes_per_query': float(np.mean([r['bytes_received'] for r in records])) if records else None,
+        'latency': percentiles([r['total'] for r in records]),
+        'phases': phases,
+    }
+
+
+def bench_parse(kind, rows, width, columns, min_time=1.):
+    """
+    Times astropy_table_from_votable_response on a canned response, repeating for at least min_time seconds.
+    """
+    content = make_votable(kind, rows, width, columns)
+    response = requests.Response()
+    response._content = content
+    response.status_code = 200
+    response.url = 'http://127.0.0.1/parse'
+    response.encoding = 'utf-8'
+
+    times = []
+    start = time.perf_counter()
+    while not times or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        utils.astropy_table_from_votable_response(response)
+        times.append(time.perf_counter() - t0)
+    best = min(times)
+    return {
+        'benchmark': 'parse',
+        'service': kind,
+        'rows': rows,
+        'width': width,
+        'columns': columns,
+        'bytes': len(content),
+        'parse_pool': parse_pool.get_pool() is not None,
+        'repeats': len(times),
+        'rows_per_s': rows / best,
+        'mb_per_s': len(content) / best / 1e6,
+        'latency': percentiles(times),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import astropy
+    return {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'astropy': astropy.__version__,
+        'requests': requests.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def result_key(result):
+    return tuple(result.get(k) for k in ('benchmark', 'service', 'rows', 'width', 'columns', 'server_latency', 'workers', 'parse_pool'))
+
+
+def compare(results, baseline_path):
+    """
+    Prints the change of each result's throughput and median latency from a baseline file.
+    """
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    print('\nChange from {} (positive throughput and negative latency are better):'.format(baseline_path))
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        change = lambda new, before: 100. * (new / before - 1.) if before else float('nan')
+        print('  {:<6s} {:<8s} rows {:>7d}   rows/s {:+7.1f}%   p50 {:+7.1f}%'.format(
+            result['benchmark'], result['service'], result['rows'],
+            change(result['rows_per_s'], old['rows_per_s']),
+            change(result['latency']['p50_ms'], old['latency']['p50_ms'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--services', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--rows', nargs='+', type=int, default=[10, 1000])
+    parser.add_argument('--width', type=int, default=16, help='characters per string value')
+    parser.add_argument('--columns', type=int, default=4, help='extra filler columns')
+    parser.add_argument('--latency', type=float, default=0., help='server think time in seconds')
+    parser.add_argument('--requests', type=int, default=200, help='queries per service and size')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--parse-time', type=float, default=1., help='seconds to repeat each parse')
+    parser.add_argument('--no-parse', action='store_true', help='skip the parse-only benchmark')
+    parser.add_argument('--parse-pool', type=int, metavar='PROCESSES',
+                        help='parse responses in a pool of this many processes (see navo_utils.parse_pool)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    cache.disable()
+    if args.parse_pool:
+        parse_pool.enable(args.parse_pool)
+    results = []
+    with StandinServer() as server:
+        for kind in args.services:
+            for rows in args.rows:
+                result = bench_service(server, kind, rows, args.width, args.columns, args.latency, args.requests,
+                                       args.workers)
+                results.append(result)
+                print('query  {:<8s} rows {:>7d}   {:8.1f} queries/s {:11.0f} rows/s   '
+                      'p50 {:8.2f} ms   p95 {:8.2f} ms   errors {}'.format(
+                          kind, rows, result['queries_per_s'], result['rows_per_s'], result['latency']['p50_ms'],
+                          result['latency']['p95_ms'], result['errors']))
+
+    if not args.no_parse:
+        for kind in args.services:
+            for rows in args.rows:
+                result = bench_parse(kind, rows, args.width, args.columns, args.parse_time)
+                results.append(result)
+                print('parse  {:<8s} rows {:>7d}   {:8.1f} MB/s {:15.0f} rows/s   p50 {:8.2f} ms'.format(
+                    kind, rows, result['mb_per_s'], result['rows_per_s'], result['latency']['p50_ms']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'arguments': vars(args), 'results': results}, f, indent=1)
+    print('Wrote {}'.format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+Local stand-in for the VO services queried by navo_utils, for benchmarks.
+
+Serves synthetic VOTABLEs from five endpoints, one per service kind:
+
+    cone      Simple Cone Search (GET RA, DEC, SR)
+    image     Simple Image Access (GET POS, SIZE)
+    spectra   Simple Spectral Access (GET POS, SIZE)
+    tap       TAP <access_url>/sync (POST)
+    registry  RegTAP /sync (POST)
+
+The shape of each response is set in the URL path, so that any number of
+configurations can be served at once and every URL is reproducible:
+
+    /<rows>,<width>,<columns>,<latency>/<kind>
+
+rows is the number of rows, width the number of characters in each string
+value, columns the number of extra filler columns (alternately double and
+char) and latency the seconds to wait before answering.  Bodies are built
+once per configuration from a fixed seed and then served from memory, so
+the server costs the client as little CPU as possible.
+
+    with StandinServer() as server:
+        url = server.url('cone', rows=1000)
+
+By default the server runs in a separate process, so that it does not
+compete with the client for the GIL.
+
+Usage (to serve until interrupted):
+    python benchmarks/vo_standin.py [port]
+"""
+
+import multiprocessing
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+KINDS = ('cone', 'image', 'spectra', 'tap', 'registry')
+
+DEFAULTS = {'rows': 100, 'width': 16, 'columns': 4, 'latency': 0.}
+
+# Endpoint path of each kind, after the configuration segment.
+_PATHS = {'cone': 'cone', 'image': 'sia', 'spectra': 'ssa', 'tap': 'tap/sync', 'registry': 'regtap/sync'}
+_KIND_OF_PATH = {path: kind for kind, path in _PATHS.items()}
+
+_HEADER = b"""<?xml version="1.0" encoding="utf-8"?>
+<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+ <RESOURCE type="results">
+  <INFO name="QUERY_STATUS" value="OK"/>
+  <TABLE>
+"""
+
+_FOOTER = b"""   </TABLEDATA></DATA>
+  </TABLE>
+ </RESOURCE>
+</VOTABLE>
+"""
+
+
+def _field(name, datatype, ucd=None, utype=None, arraysize=None):
+    attrs = ['name="{}"'.format(name), 'datatype="{}"'.format(datatype)]
+    if arraysize is not None:
+        attrs.append('arraysize="{}"'.format(arraysize))
+    if ucd is not None:
+        attrs.append('ucd="{}"'.format(ucd))
+    if utype is not None:
+        attrs.append('utype="{}"'.format(utype))
+    return '   <FIELD {}/>\n'.format(' '.join(attrs))
+
+
+def _text(rng, n, width, prefix):
+    # Deterministic string values of exactly width characters.
+    prefix = prefix[:width]
+    k = width - len(prefix)
+    if k == 0:
+        return [prefix] * n
+    letters = np.frombuffer(b'abcdefghijklmnopqrstuvwxyz', dtype='S1')
+    chars = letters[rng.integers(0, len(letters), size=(n, k))]
+    return [prefix + s.decode('ascii') for s in chars.view('S{}'.format(k)).ravel().tolist()]
+
+
+def _columns(kind, rows, width, rng):
+    """
+    Returns [(FIELD element, list of TD strings)] for a service kind.
+    """
+    ra = rng.uniform(0., 360., rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., rows)))
+    fmt = lambda values: ['{!r}'.format(v) for v in values.tolist()]
+    ids = ['{}-{:08d}'.format(kind, i) for i in range(rows)]
+
+    if kind == 'cone':
+        return [
+            (_field('id', 'char', 'meta.id;meta.main', arraysize='*'), ids),
+            (_field('ra', 'double', 'pos.eq.ra;meta.main'), fmt(ra)),
+            (_field('dec', 'double', 'pos.eq.dec;meta.main'), fmt(dec)),
+            (_field('mag', 'float', 'phot.mag'), fmt(rng.uniform(10., 25., rows).astype(np.float32))),
+        ]
+    if kind == 'image':
+        scale = 1. / 3600.
+        return [
+            (_field('title', 'char', 'VOX:Image_Title', arraysize='*'), _text(rng, rows, width, 'image ')),
+            (_field('ra', 'double', 'POS_EQ_RA_MAIN'), fmt(ra)),
+            (_field('dec', 'double', 'POS_EQ_DEC_MAIN'), fmt(dec)),
+            (_field('naxes', 'int', 'VOX:Image_Naxes'), ['2'] * rows),
+            (_field('naxis', 'int', 'VOX:Image_Naxis', arraysize='*'), ['2048 2048'] * rows),
+            (_field('scale', 'double', 'VOX:Image_Scale', arraysize='*'),
+             ['{!r} {!r}'.format(-scale, scale)] * rows),
+            (_field('format', 'char', 'VOX:Image_Format', arraysize='*'), ['image/fits'] * rows),
+            (_field('projection', 'char', 'VOX:WCS_CoordProjection', arraysize='3'), ['TAN'] * rows),
+            (_field('crpix', 'double', 'VOX:WCS_CoordRefPixel', arraysize='*'), ['1024.5 1024.5'] * rows),
+            (_field('crval', 'double', 'VOX:WCS_CoordRefValue', arraysize='*'),
+             ['{!r} {!r}'.format(r, d) for r, d in zip(ra.tolist(), dec.tolist())]),
+            (_field('cd', 'double', 'VOX:WCS_CDMatrix', arraysize='*'),
+             ['{!r} 0.0 0.0 {!r}'.format(-scale, scale)] * rows),
+            (_field('url', 'char', 'VOX:Image_AccessReference', arraysize='*'),
+             ['http://127.0.0.1/images/{}.fits'.format(i) for i in ids]),
+        ]
+    if kind == 'spectra':
+        return [
+            (_field('url', 'char', utype='ssa:Access.Reference', arraysize='*'),
+             ['http://127.0.0.1/spectra/{}.fits'.format(i) for i in ids]),
+            (_field('format', 'char', utype='ssa:Access.Format', arraysize='*'), ['application/fits'] * rows),
+            (_field('title', 'char', utype='ssa:DataID.Title', arraysize='*'), _text(rng, rows, width, 'spec ')),
+            (_field('publisher', 'char', utype='ssa:Curation.Publisher', arraysize='*'), ['stand-in'] * rows),
+            (_field('length', 'long', utype='ssa:Dataset.Length'), ['4096'] * rows),
+            (_field('pos', 'double', utype='ssa:Char.SpatialAxis.Coverage.Location.Value', arraysize='2'),
+             ['{!r} {!r}'.format(r, d) for r, d in zip(ra.tolist(), dec.tolist())]),
+            (_field('extent', 'double', utype='ssa:Char.SpatialAxis.Coverage.Bounds.Extent'),
+             ['0.000833'] * rows),
+        ]
+    if kind == 'tap':
+        return [
+            (_field('source_id', 'long', 'meta.id;meta.main'), [str(i) for i in range(rows)]),
+            (_field('ra', 'double', 'pos.eq.ra;meta.main'), fmt(ra)),
+            (_field('dec', 'double', 'pos.eq.dec;meta.main'), fmt(dec)),
+        ]
+    if kind == 'registry':
+        return [
+            (_field('waveband', 'char', arraysize='*'), ['optical#infrared'] * rows),
+            (_field('short_name', 'char', arraysize='*'), _text(rng, rows, min(width, 16), 'SN')),
+            (_field('ivoid', 'char', arraysize='*'), ['ivo://standin/{}'.format(i) for i in ids]),
+            (_field('res_description', 'char', arraysize='*'), _text(rng, rows, width * 8, 'A stand-in ')),
+            (_field('access_url', 'char', arraysize='*'), ['http://127.0.0.1/cone/{}'.format(i) for i in ids]),
+            (_field('reference_url', 'char', arraysize='*'), ['http://127.0.0.1/about/{}'.format(i) for i in ids]),
+            (_field('publisher', 'char', arraysize='*'), ['Stand-in Data Center'] * rows),
+            (_field('service_type', 'char', arraysize='*'), ['simpleimageaccess'] * rows),
+        ]
+    raise ValueError('unknown service kind {!r}; expected one of {}'.format(kind, ', '.join(KINDS)))
+
+
+def make_votable(kind, rows=DEFAULTS['rows'], width=DEFAULTS['width'], columns=DEFAULTS['columns'], seed=0):
+    """
+    Returns the bytes of a synthetic TABLEDATA VOTABLE for a service kind.
+
+    Parameters
+    ----------
+    kind : str
+        One of KINDS, selecting the columns a real service of that kind returns.
+    rows : int
+        Number of rows.
+    width : int
+        Characters in each free-text string value.
+    columns : int
+        Extra filler columns, alternately double and char of the given width.
+    seed : int
+        Seed of the values, so the same arguments always give the same bytes.
+    """
+    rng = np.random.default_rng(seed)
+    cols = _columns(kind, rows, width, rng)
+    for j in range(columns):
+        if j % 2:
+            cols.append((_field('text{}'.format(j), 'char', arraysize='*'),
+                         _text(rng, rows, width, 't{}'.format(j))))
+        else:
+            cols.append((_field('value{}'.format(j), 'double'),
+                         ['{!r}'.format(v) for v in rng.normal(size=rows).tolist()]))
+
+    fields = ''.join(field for field, values in cols).encode('utf-8')
+    body = ['    <TR>' + ''.join('<TD>{}</TD>'.format(escape(v)) for v in row) + '</TR>\n'
+            for row in zip(*[values for field, values in cols])]
+    return _HEADER + fields + b'   <DATA><TABLEDATA>\n' + ''.join(body).encode('utf-8') + _FOOTER
+
+
+def parse_path(path):
+    """
+    Returns (kind, config dict) for a request path, or None if it is not a stand-in endpoint.
+    """
+    parts = urllib.parse.urlsplit(path).path.strip('/').split('/', 1)
+    if len(parts) != 2 or parts[1] not in _KIND_OF_PATH:
+        return None
+    try:
+        rows, width, columns, latency = parts[0].split(',')
+        config = {'rows': int(rows), 'width': int(width), 'columns': int(columns), 'latency': float(latency)}
+    except ValueError:
+        return None
+    return _KIND_OF_PATH[parts[1]], config
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+
+    # Bodies per (kind, rows, width, columns), shared by all handlers.
+    bodies = {}
+    bodies_lock = threading.Lock()
+
+    def _body(self, kind, config):
+        key = (kind, config['rows'], config['width'], config['columns'])
+        body = self.bodies.get(key)
+        if body is None:
+            with self.bodies_lock:
+                body = self.bodies.get(key)
+                if body is None:
+                    body = self.bodies[key] = make_votable(kind, config['rows'], config['width'], config['columns'])
+        return body
+
+    def _answer(self):
+        parsed = parse_path(self.path)
+        if parsed is None:
+            self.send_error(404)
+            return
+        kind, config = parsed
+        body = self._body(kind, config)
+        if config['latency'] > 0:
+            time.sleep(config['latency'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml;content=x-votable')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        # Read (and ignore) the form so the connection can be reused.
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            self.rfile.read(length)
+        self._answer()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def _serve(port, queue):
+    server = _Server(('127.0.0.1', port), StandinHandler)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandinServer:
+    """
+    Runs the stand-in services on a local port.
+
+    Parameters
+    ----------
+    port : int
+        Port to listen on; 0 picks a free one.
+    process : bool
+        Serve from a separate process (the default) rather than a thread of this one.
+    **defaults
+        Default rows, width, columns and latency of the URLs made by url().
+    """
+
+    def __init__(self, port=0, process=True, **defaults):
+        unknown = set(defaults) - set(DEFAULTS)
+        if unknown:
+            raise TypeError('unknown settings: {}'.format(', '.join(sorted(unknown))))
+        self.defaults = dict(DEFAULTS, **defaults)
+        self.port = port
+        self.process = process
+        self._worker = None
+        self._server = None
+
+    def start(self):
+        if self.process:
+            context = multiprocessing.get_context('spawn')
+            queue = context.Queue()
+            self._worker = context.Process(target=_serve, args=(self.port, queue), daemon=True)
+            self._worker.start()
+            self.port = queue.get(timeout=60)
+        else:
+            self._server = _Server(('127.0.0.1', self.port), StandinHandler)
+            self.port = self._server.server_address[1]
+            self._worker = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        elif self._worker is not None:
+            self._worker.terminate()
+            self._worker.join()
+        self._worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def url(self, kind, **settings):
+        """
+        Returns the URL to query for a service kind, as the query classes expect
+        it: the TAP access URL without /sync for 'tap', the /sync URL for
+        'registry' and the endpoint itself otherwise.
+        """
+        config = dict(self.defaults, **settings)
+        url = 'http://127.0.0.1:{}/{rows:d},{width:d},{columns:d},{latency!r}/{}'.format(
+            self.port, _PATHS[kind], **config)
+        if kind == 'tap':
+            url = url[:-len('/sync')]
+        return url
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = StandinServer(port, process=False).start()
+    print('Serving on port {}; e.g. {}'.format(server.port, server.url('cone')))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
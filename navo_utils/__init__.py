@@ -0,0 +1,25 @@
+"""
+Utilities for querying Virtual Observatory services.
+
+The query objects can be imported from the package itself, e.g.
+``from navo_utils import Cone``.  Each is loaded on first use, and astropy
+tables only when the first result is parsed, so importing the package is cheap.
+"""
+import importlib
+
+_LAZY = {'Cone': 'cone', 'Image': 'image', 'Spectra': 'spectra', 'Tap': 'tap', 'Registry': 'registry'}
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,298 @@
+"""
+On-disk cache of parsed query results.
+
+Results are keyed on the canonical service URL plus the normalized query
+parameters and stored as pickled astropy Tables, so a hit skips both the
+network round-trip and VOTABLE parsing.  Entries expire after a per-service
+time to live, and the least recently used entries are evicted when the cache
+grows past its size cap.
+
+Several processes may share one cache directory: entries are written to a
+temporary file and renamed into place, readers treat a vanished or partial
+entry as a miss, and only one process at a time runs eviction.
+"""
+
+import hashlib
+import html
+import os
+import pickle
+import tempfile
+import threading
+import time
+import urllib.parse
+
+try:
+    import fcntl
+except ImportError:  # Windows; eviction is then not serialized between processes.
+    fcntl = None
+
+from . import utils
+
+__all__ = ['QueryCache', 'get_default_cache', 'set_default_cache', 'enable', 'disable']
+
+# Time to live, in seconds, of cached results for each kind of service.
+DEFAULT_TTLS = {
+    'registry': 24 * 3600,
+    'cone': 7 * 24 * 3600,
+    'image': 7 * 24 * 3600,
+    'spectra': 7 * 24 * 3600,
+}
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.navo_utils', 'cache')
+
+
+def canonical_url(url):
+    """
+    Returns the URL with HTML escapes removed, scheme and host lower-cased,
+    and any query string split off.
+
+    Returns
+    -------
+    (str, list of (str, str))
+        The base URL and the parameters that were in its query string.
+    """
+    parts = urllib.parse.urlsplit(html.unescape(url))
+    base = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, '', ''))
+    return base, urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+
+
+def _normalize_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 10))
+    return str(value)
+
+
+def cache_key(url, params):
+    """
+    Returns the content address of a query: a hash of the canonical URL and
+    the parameters, with parameter names upper-cased (VO parameter names are
+    case-insensitive) and sorted.
+
+    Parameters
+    ----------
+    url : str
+        The service URL, possibly with its own query string.
+    params : dict
+        The GET parameters or POST data of the query.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the query.
+    """
+    base, url_params = canonical_url(url)
+    items = [(k.upper(), _normalize_value(v)) for k, v in url_params]
+    if params is not None:
+        items.extend((str(k).upper(), _normalize_value(v)) for k, v in params.items())
+    items.sort()
+    text = base + '?' + urllib.parse.urlencode(items)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class QueryCache:
+    """
+    Content-addressed on-disk cache of parsed query result tables.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the cache; created if needed.
+    max_bytes : int
+        Size cap.  When exceeded, least recently used entries are evicted.
+    ttls : dict
+        Time to live in seconds for each kind of service, overriding DEFAULT_TTLS.
+    default_ttl : float
+        Time to live for kinds not listed in ttls.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, ttls=None, default_ttl=24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._counts_lock = threading.Lock()   # query_loop workers share the cache
+        self._bytes_since_evict = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def get(self, kind, url, params):
+        """
+        Returns the cached table for a query, or None if it is absent or expired.
+        """
+        path = self._path(cache_key(url, params))
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            created, table = entry['created'], entry['table']
+        except OSError:
+            self._count(hit=False)
+            return None
+        except Exception:
+            # A truncated entry, or one pickled by other versions of astropy
+            # or numpy, can fail in many ways; drop it and query again.
+            self._remove(path)
+            self._count(hit=False)
+            return None
+
+        if time.time() - created > self.ttls.get(kind, self.default_ttl):
+            self._remove(path)
+            self._count(hit=False)
+            return None
+
+        # The modification time records the last use, for LRU eviction.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(hit=True)
+        if entry.get('truncated'):
+            table.meta['truncated'] = True
+        return table
+
+    def _count(self, hit):
+        with self._counts_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, kind, url, params, table):
+        """
+        Stores the table for a query, evicting old entries if over the size cap.
+        """
+        path = self._path(cache_key(url, params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The raw response text is only there for debugging parse errors; the
+        # one thing read from it later, the OVERFLOW status, is kept as a flag.
+        cached = table.copy(copy_data=False)
+        cached.meta.pop('text', None)
+        entry = {'created': time.time(), 'kind': kind, 'truncated': utils.is_truncated(table), 'table': cached}
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+        # Rescan the directory only after a twentieth of the cap has been written.
+        size = os.path.getsize(path)
+        if self._bytes_since_evict is None or self._bytes_since_evict + size > self.max_bytes / 20:
+            self.evict()
+        else:
+            self._bytes_since_evict += size
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its size cap.
+        """
+        lock_file = open(os.path.join(self.directory, '.lock'), 'w')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return   # Another process is evicting.
+
+            entries = []
+            total = 0
+            for entry in self._scan():
+                entries.append(entry)
+                total += entry[2]
+
+            if total > self.max_bytes:
+                # Evict down to 90% of the cap so that eviction doesn't run on every put.
+                target = 0.9 * self.max_bytes
+                entries.sort(key=lambda e: e[1])
+                for path, mtime, size in entries:
+                    if total <= target:
+                        break
+                    self._remove(path)
+                    total -= size
+            self._bytes_since_evict = 0
+        finally:
+            lock_file.close()
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        for path, mtime, size in self._scan():
+            self._remove(path)
+
+    def size(self):
+        """
+        Returns the total size in bytes of the cached entries.
+        """
+        return sum(size for path, mtime, size in self._scan())
+
+    def _scan(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if not name.endswith('.pkl'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """
+    Returns the cache used by the query classes, or None if caching is disabled.
+    """
+    return _default_cache
+
+
+def set_default_cache(cache):
+    """
+    Sets the cache used by the query classes; None disables caching.
+    """
+    global _default_cache
+    _default_cache = cache
+
+
+def enable(directory=DEFAULT_DIRECTORY, **kwargs):
+    """
+    Enables result caching for Registry, Cone, Image and Spectra queries.
+
+    Parameters are those of QueryCache.
+
+    Returns
+    -------
+    QueryCache
+        The new default cache.
+    """
+    cache = QueryCache(directory, **kwargs)
+    set_default_cache(cache)
+    return cache
+
+
+def disable():
+    """
+    Disables result caching.
+    """
+    set_default_cache(None)
@@ -3,10 +3,12 @@
 VO Queries
 """
 
-from astroquery.query import BaseQuery
-from astroquery.utils import parse_coordinates
-from astropy.coordinates import SkyCoord
-from . import utils
+import numpy as np
+from . import planner, utils
+from .cone_cache import ConeCache
+from .query import BaseQuery
+from .retry import RetryPolicy
+from .tap import Tap
 
 
 
@@ -18,60 +20,234 @@ class ConeClass(BaseQuery):
         super(ConeClass, self).__init__()
         self._TIMEOUT = 60 # seconds to timeout
         self._RETRIES = 3 # total number of times to try
+        self._RETRY_POLICY = RetryPolicy() # backoff, adaptive timeouts, circuit breaker, hedging
+        self._cone_cache = None
 
-    def query(self, service, coords, radius, verbose=False):
+    def use_cone_cache(self, cache=None, **kwargs):
+        """
+        Answers cone searches that lie inside previously fetched cones from
+        memory, by angular-distance filtering of the cached rows.
+
+        Parameters
+        ----------
+        cache : ConeCache
+            The cache to use; by default a new ConeCache(**kwargs), e.g.
+            widen=2 to fetch twice the requested radius on each miss.
+
+        Returns
+        -------
+        ConeCache
+            The cache now in use, whose stats() give its hits and misses.
+        """
+        self._cone_cache = cache if cache is not None else ConeCache(**kwargs)
+        return self._cone_cache
+
+    def disable_cone_cache(self):
+        """
+        Sends every cone search to the network again.
+        """
+        self._cone_cache = None
+
+    @property
+    def cone_cache(self):
+        return self._cone_cache
+
+    def prefetch(self, service, coords, radius, verbose=False, max_workers=None, executor=None, coalesce=False):
+        """
+        Fills the cone cache with the given cones (widened as the cache is
+        configured), so that later searches inside them need no network access.
+
+        Arguments are as for query().  The cone cache must be enabled with use_cone_cache().
+        """
+        if self._cone_cache is None:
+            raise ValueError('prefetch needs a cone cache; call use_cone_cache() first.')
+        self.query(service, coords, radius, verbose=verbose, max_workers=max_workers, executor=executor,
+                   coalesce=coalesce)
+
+    def query(self, service, coords, radius, verbose=False, max_workers=None, executor=None, tap=None,
+              coalesce=False, merge=False):
         """Basic cone search query function
 
-        Input coords should be either a single string, a single
-        SkyCoord object, or a list. It will then loop over the objects
-        in the list, assuming each is a single source. Within the
-        _one_cone_search function, it then expects likewise a single
-        string, a single SkyCoord object, or list of 2 as an RA,DEC
-        pair.
+        Input coords should be either a single string, a SkyCoord
+        object (scalar or array), an (ra, dec) tuple in degrees (of
+        scalars or arrays), an (N,2) numpy array of RA,DEC in degrees,
+        an astropy Table with ra/dec columns, or a list of strings,
+        SkyCoords or RA,DEC pairs. All positions are converted to
+        RA,DEC in one vectorized pass and then searched one by one.
+        Input radius is a single value or one per position, in degrees
+        unless given as a Quantity.
 
         Input service can be a string URL a single row
         of an astropy Table.
 
+        max_workers = if given, run the per-position queries concurrently
+                    in a thread pool of this many workers (default = serial)
+        executor = a concurrent.futures.Executor to run the queries on
+                    instead; takes precedence over max_workers
+        tap = a TAP service holding the same catalog, given as a dict
+                    with 'access_url', 'table' and optionally 'ra' and
+                    'dec' column names (default 'ra' and 'dec').  All
+                    positions are then uploaded as one table and matched
+                    in a single TAP query instead of one cone search per
+                    position; the result is still a list with one table
+                    per position, with the columns of the TAP table.
+                    A service row with 'tap_access_url' and 'tap_table'
+                    entries selects this automatically.
+        coalesce = if True (or a maximum group radius in degrees), nearby
+                    positions are grouped and each group is fetched with
+                    one enclosing cone search, whose rows are then split
+                    back to each position by exact angular distance.
+                    This sends fewer requests on dense fields; the
+                    per-position results are the same.
+        merge = if True, return one table holding the rows of every
+                    position, with input_index, input_ra and input_dec
+                    columns, instead of a list of tables (see
+                    utils.merge_results; utils.group_view and
+                    utils.position_rows give back each position's rows)
+
+        If a cone cache is enabled with use_cone_cache(), searches inside
+        cones already fetched from the same service are answered from memory.
+
+        """
+        if merge:
+            # Parsed once here, so that names are not resolved again for the input columns.
+            coords = utils.parse_coordinates_array(coords)
+        results = [result for i, result in self.iter_query(service, coords, radius, verbose=verbose,
+                                                           max_workers=max_workers, executor=executor, tap=tap,
+                                                           coalesce=coalesce, ordered=True)]
+        if merge:
+            return utils.merge_results(results, *coords)
+        return results
+
+    def iter_query(self, service, coords, radius, verbose=False, max_workers=None, executor=None, tap=None,
+                   coalesce=False, ordered=False):
+        """Cone search that yields each position's result as it arrives
+
+        Arguments are as for query().  Returns a generator of (index,
+        table) pairs, index being the position's index in coords, so that
+        the first results can be processed while later ones are still being
+        fetched.
+
+        ordered = if True, yield the results in the order of coords;
+                    otherwise in the order they complete
+
         """
 
         if type(service) is str:
             service = {"access_url":service}
 
 
-        if type(coords) is str or isinstance(coords, SkyCoord):
-            coords = [coords]
-        assert type(coords) is list, """
-        ERROR: Give a coordinate object that is a single string,
-        a list/tuple (ra,dec), a SkyCoord, or a list of any of the above.
-        """
+        # Parse all positions and radii in one vectorized pass.
+        ra, dec = utils.parse_coordinates_array(coords)
+        inradius = utils.parse_radius_array(radius, len(ra))
 
-        if type(radius) is not list:
-            inradius = [radius]*len(coords)
-        else:
-            inradius = inradius
-            assert len(inradius) == len(coords), 'Please give either single radius or list of radii of same length as coords.'
+        if tap is None and hasattr(service, 'get') and service.get('tap_access_url') and service.get('tap_table'):
+            tap = {'access_url': service['tap_access_url'], 'table': service['tap_table'],
+                   'ra': service.get('tap_ra', 'ra'), 'dec': service.get('tap_dec', 'dec')}
+        if tap is not None:
+            return self._iter_tap_cone_search(tap, ra, dec, inradius, verbose=verbose)
+
+        if coalesce:
+            max_group_radius = None if coalesce is True else float(coalesce)
+            results = self._iter_coalesced_cone_search(service, ra, dec, inradius, max_group_radius, verbose=verbose,
+                                                       max_workers=max_workers, executor=executor)
+            return utils.iter_in_order(results) if ordered else results
 
         # Construct list of dictionaries, each with the parameters needed
         # for the function you're calling in the query_loop:
-        params = [{'coords':c, 'radius':inradius[i]} for i, c in enumerate(coords)]
-
-        result_list = utils.query_loop(self._one_cone_search, service=service, params=params, verbose=verbose)
-        return result_list
-
+        params = [{'coords':c, 'radius':r, 'verbose':verbose}
+                  for c, r in zip(zip(ra.tolist(), dec.tolist()), inradius.tolist())]
 
-    def _one_cone_search(self, coords, radius, service):
-        if (type(coords) is tuple or type(coords) is list) and len(coords) == 2:
-            coords = parse_coordinates("{} {}".format(coords[0], coords[1]))
-        elif type(coords) is str:
-            coords = parse_coordinates(coords)
-        else:
-            assert isinstance(coords, SkyCoord), "ERROR: cannot parse input coordinates {}".format(coords)
+        return utils.iter_query_loop(self._one_cone_search, service=service, params=params, verbose=verbose,
+                                     max_workers=max_workers, executor=executor, ordered=ordered)
 
-        params = {'RA': coords.ra.deg, 'DEC': coords.dec.deg, 'SR':radius}
-
-        response = utils.try_query(service, get_params=params, timeout=self._TIMEOUT, retries=self._RETRIES)
-
-        return utils.astropy_table_from_votable_response(response)
+    def _iter_coalesced_cone_search(self, service, ra, dec, radius, max_group_radius, verbose=False, **loop_kwargs):
+        """
+        Cone searches with nearby positions grouped into enclosing cones.
+        Yields (position index, table) as each group's result is split.
+        """
+        groups = planner.plan_cone_groups(ra, dec, radius, max_group_radius=max_group_radius)
+        if verbose: print("    Coalesced {} positions into {} cone searches".format(len(ra), len(groups)))
+
+        params = [{'coords':(g.ra, g.dec), 'radius':g.radius, 'verbose':verbose} for g in groups]
+        retry = []
+        for g, result in utils.iter_query_loop(self._one_cone_search, service=service, params=params,
+                                               verbose=verbose, **loop_kwargs):
+            group = groups[g]
+            split = planner.split_group_result(result, group, ra, dec, radius)
+            if split is None:
+                retry.extend(group.members.tolist())
+                continue
+            yield from zip(group.members.tolist(), split)
+
+        if retry:
+            # Group results that could not be split (no positions, or truncated):
+            # search those positions one by one.
+            params = [{'coords':(ra[i], dec[i]), 'radius':radius[i], 'verbose':verbose} for i in retry]
+            for k, result in utils.iter_query_loop(self._one_cone_search, service=service, params=params,
+                                                   verbose=verbose, **loop_kwargs):
+                yield retry[k], result
+
+
+    def _one_cone_search(self, coords, radius, service, verbose=False):
+        ra, dec = utils.parse_coordinates_array(coords)
+        ra, dec, radius = float(ra[0]), float(dec[0]), float(radius)
+
+        cone_cache = self._cone_cache
+        if cone_cache is None:
+            return self._fetch_cone(service, ra, dec, radius, verbose=verbose)
+
+        result = cone_cache.lookup(service, ra, dec, radius)
+        if result is not None:
+            return result
+
+        fetch_radius = cone_cache.fetch_radius(radius)
+        result = self._fetch_cone(service, ra, dec, fetch_radius, verbose=verbose)
+        if fetch_radius > radius:
+            ra_col, dec_col = utils.find_radec_columns(result)
+            if ra_col is None or dec_col is None or utils.is_truncated(result):
+                # The wider result can't be cut down to the requested cone, or
+                # was cut short by the service's row limit and may be missing
+                # rows of the requested cone.
+                result = self._fetch_cone(service, ra, dec, radius, verbose=verbose)
+                fetch_radius = radius
+        cone_cache.store(service, ra, dec, fetch_radius, result)
+        if fetch_radius > radius:
+            result = ConeCache.cut(result, ra_col, dec_col, ra, dec, radius)
+        return result
+
+    def _fetch_cone(self, service, ra, dec, radius, verbose=False):
+        params = {'RA': ra, 'DEC': dec, 'SR':radius}
+
+        return utils.query_votable(service, 'cone', get_params=params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=verbose)
+
+    def _tap_cone_search(self, tap, ra, dec, radius, verbose=False):
+        """
+        Cone searches of all positions at once, as a TAP query joining the
+        catalog table with an uploaded table of the positions.
+        """
+        from astropy.table import Table
+
+        upload = Table()
+        upload['in_idx'] = np.arange(len(ra), dtype=np.int32)
+        upload['in_ra'] = ra
+        upload['in_dec'] = dec
+        upload['in_sr'] = radius
+
+        adql = """
+            select u.in_idx, t.* from {table} as t
+            join TAP_UPLOAD.cone_positions as u
+            on 1=CONTAINS(POINT('ICRS', t.{ra}, t.{dec}), CIRCLE('ICRS', u.in_ra, u.in_dec, u.in_sr))
+            """.format(table=tap['table'], ra=tap.get('ra', 'ra'), dec=tap.get('dec', 'dec'))
+
+        if verbose: print("    Querying TAP service {} with {} uploaded positions".format(tap['access_url'], len(ra)))
+        matches = Tap.query(tap, adql, upload_file=upload, upload_name='cone_positions', verbose=verbose)
+        return utils.split_by_index(matches, 'in_idx', len(ra))
+
+    def _iter_tap_cone_search(self, tap, ra, dec, radius, verbose=False):
+        # All positions arrive together from the one TAP query.
+        yield from enumerate(self._tap_cone_search(tap, ra, dec, radius, verbose=verbose))
 
 
 Cone = ConeClass()
@@ -0,0 +1,239 @@
+"""
+In-memory semantic cache of cone search results.
+
+A cone search whose cone lies wholly inside a cone already fetched from the
+same service is answered from the cached rows by exact angular distance,
+without going back to the network.  Fetches can be widened so that later
+nearby or smaller searches hit the cache.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+from . import utils
+
+__all__ = ['ConeCache']
+
+DEFAULT_MAX_ROWS = 5000000
+
+# Tolerance, in degrees, on the containment test.
+_CONTAINMENT_TOLERANCE = 1e-9
+
+
+class _Entry:
+    __slots__ = ('key', 'service', 'ra', 'dec', 'radius', 'table', 'ra_col', 'dec_col', 'slot')
+
+    def __init__(self, key, service, ra, dec, radius, table, ra_col, dec_col):
+        self.key = key
+        self.service = service
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius
+        self.table = table
+        self.ra_col = ra_col
+        self.dec_col = dec_col
+        self.slot = None
+
+
+class _ServiceEntries:
+    """
+    The entries of one service, with their cones kept in arrays that grow as
+    entries are stored, so that a lookup is one vectorized pass.  Removed
+    entries leave a slot that never matches until the arrays are compacted.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.live = 0
+        self._allocate(16)
+
+    def _allocate(self, capacity):
+        n = len(self.entries)
+        arrays = [np.empty(capacity), np.empty(capacity), np.empty(capacity), np.zeros(capacity, dtype=bool)]
+        if n:
+            for new, old in zip(arrays, (self.ra, self.dec, self.radius, self.filterable)):
+                new[:n] = old[:n]
+        self.ra, self.dec, self.radius, self.filterable = arrays
+
+    def add(self, entry):
+        n = len(self.entries)
+        if n == len(self.ra):
+            self._allocate(2 * n)
+        self.ra[n] = entry.ra
+        self.dec[n] = entry.dec
+        self.radius[n] = entry.radius
+        self.filterable[n] = entry.ra_col is not None
+        entry.slot = n
+        self.entries.append(entry)
+        self.live += 1
+
+    def remove(self, entry):
+        self.entries[entry.slot] = None
+        self.radius[entry.slot] = -np.inf
+        self.live -= 1
+        if self.live < len(self.entries) // 2:
+            entries = [e for e in self.entries if e is not None]
+            self.entries = []
+            self.live = 0
+            self._allocate(max(16, 2 * len(entries)))
+            for e in entries:
+                self.add(e)
+
+    def find(self, ra, dec, radius):
+        if self.live == 0:
+            return None
+        n = len(self.entries)
+        e_radius = self.radius[:n]
+        sep = utils.angular_separation(ra, dec, self.ra[:n], self.dec[:n])
+        exact = (sep <= _CONTAINMENT_TOLERANCE) & (np.abs(e_radius - radius) <= _CONTAINMENT_TOLERANCE)
+        usable = np.flatnonzero(np.where(self.filterable[:n], sep + radius <= e_radius + _CONTAINMENT_TOLERANCE,
+                                         exact))
+        if len(usable) == 0:
+            return None
+        # The smallest containing cone has the fewest rows to filter.
+        return self.entries[usable[np.argmin(e_radius[usable])]]
+
+
+class ConeCache:
+    """
+    Cone search results kept in memory per service, answering any cone
+    contained in a cached one.
+
+    Parameters
+    ----------
+    widen : float
+        Fetch this multiple of the requested radius on a miss, so that later
+        searches nearby or with smaller radii are hits.  The requested cone is
+        then cut out of the wider result.  1 fetches exactly what was asked.
+    max_fetch_radius : float
+        Never widen a fetch beyond this radius, in degrees.
+    max_rows : int
+        Total rows kept over all entries; least recently used entries are
+        dropped beyond this.
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of searches answered from the cache and from the network.
+    """
+
+    def __init__(self, widen=1., max_fetch_radius=1., max_rows=DEFAULT_MAX_ROWS):
+        if widen < 1:
+            raise ValueError('widen must be at least 1.')
+        self.widen = widen
+        self.max_fetch_radius = max_fetch_radius
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._by_service = collections.defaultdict(_ServiceEntries)
+        self._rows = 0
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def fetch_radius(self, radius):
+        """
+        Returns the radius to fetch from the network for a missed search of the given radius.
+        """
+        return max(radius, min(radius * self.widen, self.max_fetch_radius))
+
+    def lookup(self, service, ra, dec, radius):
+        """
+        Returns the cached result for a cone search, or None on a miss.
+
+        Parameters
+        ----------
+        service : str
+            The service URL.
+        ra, dec, radius : float
+            The cone, in degrees.
+
+        Returns
+        -------
+        astropy.table.Table or None
+            The rows of the smallest cached cone containing this one that lie
+            within radius of (ra, dec).
+        """
+        with self._lock:
+            entry = self._find(service, ra, dec, radius)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(entry.key)
+
+        if entry.ra_col is None:
+            # Only an exact repeat of the cached search can be served.
+            return entry.table.copy()
+        return self.cut(entry.table, entry.ra_col, entry.dec_col, ra, dec, radius)
+
+    def _find(self, service, ra, dec, radius):
+        entries = self._by_service.get(service)
+        return None if entries is None else entries.find(ra, dec, radius)
+
+    @staticmethod
+    def cut(table, ra_col, dec_col, ra, dec, radius):
+        """
+        Returns the rows of table within radius degrees of (ra, dec).
+        """
+        row_ra = np.asarray(table[ra_col], dtype=float)
+        row_dec = np.asarray(table[dec_col], dtype=float)
+        return table[utils.angular_separation(row_ra, row_dec, ra, dec) <= radius]
+
+    def store(self, service, ra, dec, radius, table):
+        """
+        Adds the result of a cone search to the cache.
+
+        Results that failed or were truncated by the service's row limit are
+        not stored.  Results without recognizable RA/Dec columns can only
+        serve exact repeats of the same search.
+        """
+        if len(table.columns) == 0 or table.meta.get('error') or utils.is_truncated(table):
+            return
+        ra_col, dec_col = utils.find_radec_columns(table)
+        if ra_col is None or dec_col is None:
+            ra_col = dec_col = None
+
+        cached = table.copy(copy_data=False)
+        cached.meta.pop('text', None)
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            entry = _Entry(key, service, float(ra), float(dec), float(radius), cached, ra_col, dec_col)
+            self._entries[key] = entry
+            self._by_service[service].add(entry)
+            self._rows += len(cached)
+            self._evict()
+
+    def _evict(self):
+        while self._rows > self.max_rows and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._by_service[entry.service].remove(entry)
+            self._rows -= len(entry.table)
+
+    def clear(self):
+        """
+        Removes every entry and resets the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._by_service.clear()
+            self._rows = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses, hit_rate, entries and rows.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.,
+                'entries': len(self._entries),
+                'rows': self._rows,
+            }
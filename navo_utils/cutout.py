@@ -0,0 +1,350 @@
+"""
+Batched image cutouts for many positions
+"""
+
+import concurrent.futures
+import html
+import os
+
+import numpy as np
+from astropy.table import Table
+
+from . import utils
+from .image import Image, ImageColumn, ImageTable
+from .remote_fits import RemoteFits, scale_image_data
+
+__all__ = ['Cutouts', 'plan_cutouts', 'cutout_remote', 'cutout_local', 'query_cutouts', 'write_stacks']
+
+
+class Cutouts(list):
+    """
+    The cutouts of each position: a list with one list of
+    astropy.io.fits.ImageHDU per position.
+
+    Attributes
+    ----------
+    errors : dict
+        For each image or file that could not be cut (unreadable, no
+        celestial WCS, ...), its URL or path mapped to the error.  The
+        positions it was planned for are missing its cutouts.
+    """
+
+    def __init__(self, cutouts=(), errors=None):
+        super().__init__(cutouts)
+        self.errors = dict(errors or {})
+
+
+def _size_degrees(size):
+    if hasattr(size, 'unit'):
+        return float(size.to_value('deg'))
+    return float(size)
+
+
+def _celestial_wcs(header):
+    """
+    Returns the celestial WCS of a header and the number of leading
+    (non-celestial) numpy axes to index at 0 to get a 2-d image.
+    """
+    from astropy.wcs import WCS
+
+    wcs = WCS(header).celestial
+    if wcs.naxis != 2:
+        raise ValueError('the image has no celestial WCS.')
+    return wcs, header.get('NAXIS', 2) - 2
+
+
+def _cut(read, shape, wcs, ra, dec, size):
+    """
+    Cuts a size x size degree square around (ra, dec) out of a 2-d image.
+
+    Parameters
+    ----------
+    read : callable
+        read(slices) returns the pixels of a (y, x) slice of the image.
+    shape : tuple
+        (ny, nx) shape of the image.
+    wcs : astropy.wcs.WCS
+        Celestial WCS of the image.
+
+    Returns
+    -------
+    (numpy.ndarray, astropy.io.fits.Header) or None
+        The pixels and a header with the cutout's WCS, or None if the square
+        does not overlap the image.
+    """
+    from astropy.nddata.utils import NoOverlapError, overlap_slices
+    from astropy.wcs.utils import proj_plane_pixel_scales
+
+    x, y = wcs.world_to_pixel_values(ra, dec)
+    if not (np.isfinite(x) and np.isfinite(y)):
+        return None
+    scales = proj_plane_pixel_scales(wcs)
+    cut_shape = (max(int(np.round(size / scales[1])), 1), max(int(np.round(size / scales[0])), 1))
+    try:
+        slices, _ = overlap_slices(shape, cut_shape, (float(y), float(x)), mode='trim')
+    except NoOverlapError:
+        return None
+    data = np.asarray(read(slices))
+    header = wcs.slice(slices).to_header()
+    return data, header
+
+
+def plan_cutouts(images, coords):
+    """
+    Pairs positions with the FITS images to cut them out of.
+
+    Parameters
+    ----------
+    images : ImageTable or list of ImageTable
+        Either one table per position, as returned by Image.query() for a list
+        of positions, or a single table whose images are matched to every
+        position by their footprints (see ImageTable.contains).
+    coords
+        The positions, in any form accepted by Image.query().
+
+    Returns
+    -------
+    list of (int, str)
+        (position index, access URL) for each cutout to make.
+    """
+    ra, dec = utils.parse_coordinates_array(coords)
+    if isinstance(images, Table):
+        table = images if isinstance(images, ImageTable) else ImageTable(images, copy=False)
+        positions, rows = table.contains((ra, dec))
+        tables = [(table, positions, rows)]
+    else:
+        if len(images) != len(ra):
+            raise ValueError('give one image table per position, or a single table.')
+        tables = []
+        for i, table in enumerate(images):
+            table = table if isinstance(table, ImageTable) else ImageTable(table, copy=False)
+            tables.append((table, np.full(len(table), i), np.arange(len(table))))
+
+    jobs = []
+    for table, positions, rows in tables:
+        urls = table[ImageColumn.ACCESS_URL]
+        if urls is None:
+            continue
+        formats = table[ImageColumn.FORMAT]
+        for i, row in zip(positions.tolist(), rows.tolist()):
+            if formats is not None and 'fits' not in utils.sval(formats[row]).lower():
+                continue
+            jobs.append((i, html.unescape(utils.sval(urls[row]))))
+    return jobs
+
+
+def _remote_job(url, ext, targets, size, remote_kwargs):
+    """
+    Cuts the targets [(position index, ra, dec)] out of one remote image, via Range requests.
+    """
+    from astropy.io import fits
+
+    remote = RemoteFits(url, **remote_kwargs)
+    header = remote.header(ext)
+    wcs, leading = _celestial_wcs(header)
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    results = []
+    for i, ra, dec in targets:
+        cut = _cut(lambda slices: remote.section(ext, (0,) * leading + tuple(slices)), shape, wcs, ra, dec, size)
+        if cut is not None:
+            hdu = fits.ImageHDU(data=cut[0], header=cut[1])
+            hdu.header['ORIGURL'] = url
+            results.append((i, hdu))
+    return results
+
+
+def cutout_remote(jobs, coords, size, ext=0, max_workers=8, verbose=False, **remote_kwargs):
+    """
+    Makes cutouts from remote FITS images, reading only the pixels needed
+    with HTTP Range requests (see RemoteFits).  Servers without Range
+    support cost one full download per image.
+
+    Parameters
+    ----------
+    jobs : list of (int, str)
+        (position index, access URL) pairs, as from plan_cutouts().
+    coords
+        The positions, in any form accepted by Image.query().
+    size : float or Quantity
+        Side of the square cutouts, in degrees unless given as a Quantity.
+    ext : int or str
+        The image HDU in each file.
+    max_workers : int
+        Number of images read concurrently.
+    **remote_kwargs
+        Passed to RemoteFits.
+
+    Returns
+    -------
+    Cutouts
+        The cutouts of each position; images not overlapping it are omitted.
+        Images that could not be read are listed in its errors.
+    """
+    ra, dec = utils.parse_coordinates_array(coords)
+    return _run_jobs(_remote_job, jobs, ra, dec, _size_degrees(size), ext, max_workers, verbose,
+                     concurrent.futures.ThreadPoolExecutor, remote_kwargs)
+
+
+def _local_job(path, ext, targets, size, unused):
+    """
+    Cuts the targets out of one local image, memory-mapped so that only the
+    pixels behind each cutout are read and scaled.  Runs in a worker process.
+    """
+    from astropy.io import fits
+
+    results = []
+    # astropy won't scale sections of memory-mapped images itself.
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = hdul[ext]
+        header = hdu.header
+        wcs, leading = _celestial_wcs(header)
+        shape = (header['NAXIS2'], header['NAXIS1'])
+        section = hdu.section
+        for i, ra, dec in targets:
+            cut = _cut(lambda slices: scale_image_data(section[(0,) * leading + tuple(slices)], header),
+                       shape, wcs, ra, dec, size)
+            if cut is not None:
+                cutout_hdu = fits.ImageHDU(data=cut[0], header=cut[1])
+                cutout_hdu.header['ORIGFILE'] = os.path.basename(path)
+                results.append((i, cutout_hdu))
+    return results
+
+
+def cutout_local(files, coords, size, ext=0, processes=None, verbose=False):
+    """
+    Makes cutouts from local FITS files in a process pool, memory-mapping
+    each file so that full images are never loaded.
+
+    Parameters
+    ----------
+    files : list of (int, str)
+        (position index, path) pairs; a path may appear for several positions.
+    coords, size, ext
+        As for cutout_remote().
+    processes : int
+        Number of worker processes (default: one per CPU).  0 or 1 works in
+        this process.
+
+    Returns
+    -------
+    Cutouts
+        The cutouts of each position, with the files that could not be cut in its errors.
+    """
+    ra, dec = utils.parse_coordinates_array(coords)
+    return _run_jobs(_local_job, files, ra, dec, _size_degrees(size), ext, processes, verbose,
+                     concurrent.futures.ProcessPoolExecutor, None)
+
+
+def _run_jobs(job_function, jobs, ra, dec, size, ext, workers, verbose, executor_class, extra):
+    # One task per file, with every position to cut out of it.
+    targets = {}
+    for i, source in jobs:
+        targets.setdefault(source, []).append((i, float(ra[i]), float(dec[i])))
+
+    # Cutouts of each position are returned in the order of their jobs.
+    order = {source: k for k, source in enumerate(targets)}
+    collected = [[] for _ in range(len(ra))]
+    errors = {}
+
+    def collect(source, future_result):
+        for i, hdu in future_result:
+            collected[i].append((order[source], hdu))
+        if verbose:
+            print('    Cut {} positions out of {}'.format(len(targets[source]), source))
+
+    if workers is not None and workers <= 1:
+        for source, source_targets in targets.items():
+            try:
+                collect(source, job_function(source, ext, source_targets, size, extra))
+            except Exception as e:
+                print('ERROR: cutouts from {} failed: {}'.format(source, e))
+                errors[source] = repr(e)
+    else:
+        with executor_class(max_workers=workers) as executor:
+            futures = {executor.submit(job_function, source, ext, source_targets, size, extra): source
+                       for source, source_targets in targets.items()}
+            for future in concurrent.futures.as_completed(futures):
+                source = futures[future]
+                try:
+                    collect(source, future.result())
+                except Exception as e:
+                    print('ERROR: cutouts from {} failed: {}'.format(source, e))
+                    errors[source] = repr(e)
+    return Cutouts([[hdu for k, hdu in sorted(c, key=lambda item: item[0])] for c in collected],
+                   {source: errors[source] for source in targets if source in errors})
+
+
+def query_cutouts(service, coords, size, server_side=True, directory=None, max_workers=8, verbose=False,
+                  **remote_kwargs):
+    """
+    Runs an image search and returns cutouts of every FITS image around each position.
+
+    With server_side=True the search asks the service for images of the
+    cutout size (the SIA SIZE parameter), which cutout services answer with
+    small images made on the server.  Either way each image is then trimmed
+    to the square around its position, reading only the pixels needed.
+
+    Parameters
+    ----------
+    service
+        An image service, as for Image.query().
+    coords
+        The positions, in any form accepted by Image.query().
+    size : float or Quantity
+        Side of the square cutouts, in degrees unless given as a Quantity.
+    server_side : bool
+        Search with the cutout size rather than only at the position.
+    directory : str
+        If given, write the cutouts of each position to a FITS file there (see write_stacks).
+    max_workers : int
+        Number of concurrent searches and image reads.
+    **remote_kwargs
+        Passed to RemoteFits.
+
+    Returns
+    -------
+    Cutouts
+        The cutouts of each position, with the images that could not be read in its errors.
+    """
+    ra, dec = utils.parse_coordinates_array(coords)
+    size = _size_degrees(size)
+    radius = size / 2. if server_side else 0.000001
+    images = Image.query(service, (ra, dec), radius, image_format='fits', verbose=verbose, max_workers=max_workers)
+    jobs = plan_cutouts(images, (ra, dec))
+    if verbose: print('    Making {} cutouts from {} images'.format(len(jobs), len({url for i, url in jobs})))
+    results = cutout_remote(jobs, (ra, dec), size, max_workers=max_workers, verbose=verbose, **remote_kwargs)
+    if directory is not None:
+        write_stacks(results, directory)
+    return results
+
+
+def write_stacks(cutouts, directory, prefix='cutouts', overwrite=True):
+    """
+    Writes the cutouts of each position to one multi-extension FITS file.
+
+    Parameters
+    ----------
+    cutouts : list of list of astropy.io.fits.ImageHDU
+        As returned by cutout_remote(), cutout_local() or query_cutouts().
+    directory : str
+        Output directory; created if needed.
+    prefix : str
+        Files are named <prefix>_<position index>.fits.
+
+    Returns
+    -------
+    list of str
+        The path written for each position, or None where there were no cutouts.
+    """
+    from astropy.io import fits
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, hdus in enumerate(cutouts):
+        if not hdus:
+            paths.append(None)
+            continue
+        out_path = os.path.join(directory, '{}_{:04d}.fits'.format(prefix, i))
+        fits.HDUList([fits.PrimaryHDU()] + list(hdus)).writeto(out_path, overwrite=overwrite)
+        paths.append(out_path)
+    return paths
@@ -0,0 +1,353 @@
+"""
+Local spatial index of image footprints from SIA WCS columns
+"""
+
+import numpy as np
+
+from . import utils
+
+__all__ = ['FootprintIndex']
+
+# Zenithal projections handled exactly.  Each maps the angular distance c from
+# the reference point (radians) to the radius in the projection plane (radians),
+# and back.  Other codes are treated as TAN, which agrees closely with any of
+# these over the fields of view of typical images.
+_ZENITHAL = {
+    'TAN': (np.tan, np.arctan),
+    'SIN': (np.sin, lambda r: np.arcsin(np.clip(r, -1., 1.))),
+    'ARC': (lambda c: c, lambda r: r),
+    'ZEA': (lambda c: 2. * np.sin(c / 2.), lambda r: 2. * np.arcsin(np.clip(r / 2., -1., 1.))),
+    'STG': (lambda c: 2. * np.tan(c / 2.), lambda r: 2. * np.arctan(r / 2.)),
+}
+
+# Largest distance from the reference point (degrees) at which each projection is one-to-one.
+_ZENITHAL_LIMIT = {'TAN': 90., 'SIN': 90., 'ARC': 180., 'ZEA': 180., 'STG': 180.}
+
+# Relative margin on the bounding caps used to find candidate images.
+_CAP_MARGIN = 1e-3
+
+# Number of (position, image) candidate pairs handled at once.
+_CHUNK_PAIRS = 1000000
+
+
+def _projection_codes(values, n):
+    codes = np.full(n, 'TAN', dtype='<U3')
+    if values is not None:
+        from astropy.table import Column
+        if not isinstance(values, Column):
+            values = Column(values)
+        values = np.char.upper(np.char.strip(np.asarray(utils.sval_whole_column(values), dtype=str)))
+        for code in _ZENITHAL:
+            codes[np.char.endswith(values, code)] = code
+    return codes
+
+
+def _project(ra, dec, ra0, dec0, proj):
+    """
+    Zenithal projection of positions about reference points, all in degrees,
+    broadcasting like numpy.  Returns intermediate world coordinates (x, y)
+    in degrees, with x towards the east, and a mask of the positions the
+    projection can represent.
+    """
+    ra, dec, ra0, dec0 = (np.radians(a) for a in (ra, dec, ra0, dec0))
+    dra = ra - ra0
+    cos_dec, sin_dec = np.cos(dec), np.sin(dec)
+    cos_dec0, sin_dec0 = np.cos(dec0), np.sin(dec0)
+    east = cos_dec * np.sin(dra)
+    north = cos_dec0 * sin_dec - sin_dec0 * cos_dec * np.cos(dra)
+    cos_c = sin_dec0 * sin_dec + cos_dec0 * cos_dec * np.cos(dra)
+    sin_c = np.hypot(east, north)
+    c = np.arctan2(sin_c, cos_c)
+
+    r = np.empty_like(c)
+    valid = np.zeros(c.shape, dtype=bool)
+    for code, (forward, inverse) in _ZENITHAL.items():
+        sel = proj == code
+        if np.any(sel):
+            r[sel] = forward(c[sel])
+            valid[sel] = np.degrees(c[sel]) < _ZENITHAL_LIMIT[code]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(sin_c > 0, np.degrees(r) / sin_c, 0.)
+    return east * scale, north * scale, valid
+
+
+def _deproject(x, y, ra0, dec0, proj):
+    """
+    Inverse of _project: RA and Dec in degrees of intermediate world coordinates.
+    """
+    r = np.radians(np.hypot(x, y))
+    c = np.empty_like(r)
+    for code, (forward, inverse) in _ZENITHAL.items():
+        sel = proj == code
+        if np.any(sel):
+            c[sel] = inverse(r[sel])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        east = np.where(r > 0, np.radians(x) / r, 0.)
+        north = np.where(r > 0, np.radians(y) / r, 0.)
+    dec0 = np.radians(dec0)
+    sin_c, cos_c = np.sin(c), np.cos(c)
+    sin_dec = np.sin(dec0) * cos_c + np.cos(dec0) * sin_c * north
+    dra = np.arctan2(sin_c * east, np.cos(dec0) * cos_c - np.sin(dec0) * sin_c * north)
+    ra = (ra0 + np.degrees(dra)) % 360.
+    return ra, np.degrees(np.arcsin(np.clip(sin_dec, -1., 1.)))
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    """
+    Distance from points p to segments a-b in the plane, elementwise.
+    """
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.clip(((px - ax) * dx + (py - ay) * dy) / length2, 0., 1.)
+    t = np.where(length2 > 0, t, 0.)
+    return np.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+class FootprintIndex:
+    """
+    Footprints of a set of images, indexed for containment and overlap tests.
+
+    Each footprint is the pixel rectangle 0.5 <= p <= NAXIS + 0.5 mapped to the
+    sky through the image's WCS: CRVAL, CRPIX, the CD matrix and a zenithal
+    projection (TAN, SIN, ARC, ZEA or STG).  Queries first select candidate
+    images by comparing bounding caps, using a Dec-sorted index of the cap
+    centers, and then test the candidates exactly in each image's pixel frame,
+    all in vectorized numpy.
+
+    Parameters
+    ----------
+    crval : numpy.ndarray
+        (N, 2) reference RA and Dec in degrees.
+    crpix : numpy.ndarray
+        (N, 2) reference pixels.
+    cd : numpy.ndarray
+        (N, 4) CD matrices ordered CD1_1, CD1_2, CD2_1, CD2_2, in degrees per pixel.
+    naxis : numpy.ndarray
+        (N, 2) image lengths in pixels.
+    projection : array of str
+        (N,) projection codes; None for TAN everywhere.
+
+    Images with missing or singular geometry never match.
+    """
+
+    def __init__(self, crval, crpix, cd, naxis, projection=None):
+        self.crval = np.asarray(crval, dtype=float).reshape(-1, 2)
+        n = len(self.crval)
+        self.crpix = np.asarray(crpix, dtype=float).reshape(n, 2)
+        self.cd = np.asarray(cd, dtype=float).reshape(n, 2, 2)
+        self.naxis = np.asarray(naxis, dtype=float).reshape(n, 2)
+        self.projection = _projection_codes(projection, n)
+
+        with np.errstate(invalid='ignore'):
+            det = self.cd[:, 0, 0] * self.cd[:, 1, 1] - self.cd[:, 0, 1] * self.cd[:, 1, 0]
+            self.valid = (np.isfinite(det) & (det != 0) & np.all(np.isfinite(self.crval), axis=1)
+                          & np.all(np.isfinite(self.crpix), axis=1) & np.all(self.naxis > 0, axis=1))
+        self.pixel_scale = np.sqrt(np.abs(det))
+
+        cd_inv = np.zeros_like(self.cd)
+        good = self.valid
+        cd_inv[good] = np.linalg.inv(self.cd[good])
+        self._cd_inv = cd_inv
+
+        # Corners in intermediate world coordinates, shape (N, 4, 2), in order around the rectangle.
+        lo = 0.5 - self.crpix
+        hi = self.naxis + 0.5 - self.crpix
+        pixels = np.stack([np.stack([lo[:, 0], lo[:, 1]], axis=1), np.stack([hi[:, 0], lo[:, 1]], axis=1),
+                           np.stack([hi[:, 0], hi[:, 1]], axis=1), np.stack([lo[:, 0], hi[:, 1]], axis=1)], axis=1)
+        self._corners = np.einsum('nij,nkj->nki', self.cd, pixels)
+        self._build_caps()
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Builds the index for the rows of an ImageTable.
+
+        Missing WCS columns are filled in where possible: CRVAL from the
+        image center, CRPIX from the center pixel, the CD matrix from SCALE
+        (north up, east left) and the projection as TAN.
+        """
+        from .image import ImageColumn
+
+        n = len(table)
+        naxis = table.get_array(ImageColumn.NAXIS, width=2)
+        if naxis is None:
+            naxis = np.full((n, 2), np.nan)
+
+        crval = table.crval_array()
+        if crval is None:
+            ra, dec = table.radec_arrays()
+            crval = np.full((n, 2), np.nan)
+            if ra is not None and dec is not None:
+                crval = np.stack([ra, dec], axis=1)
+
+        crpix = table.crpix_array()
+        if crpix is None:
+            crpix = (naxis + 1.) / 2.
+
+        cd = table.cdmatrix_array()
+        if cd is None:
+            scale = table.scale_array()
+            cd = np.full((n, 4), np.nan)
+            if scale is not None:
+                cd = np.zeros((n, 4))
+                cd[:, 0] = -np.abs(scale[:, 0])
+                cd[:, 3] = np.abs(scale[:, 1])
+
+        return cls(crval, crpix, cd, naxis, table[ImageColumn.PROJECTION])
+
+    def __len__(self):
+        return len(self.crval)
+
+    def _build_caps(self):
+        corners = self._corners
+        n = len(self)
+        proj = np.repeat(self.projection, 4)
+        ra, dec = _deproject(corners[..., 0].ravel(), corners[..., 1].ravel(),
+                             np.repeat(self.crval[:, 0], 4), np.repeat(self.crval[:, 1], 4), proj)
+        xyz = utils.radec_to_xyz(ra, dec).reshape(n, 4, 3)
+        center = xyz.sum(axis=1)
+        norm = np.linalg.norm(center, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            center /= norm[:, np.newaxis]
+            cos_r = np.min(np.einsum('nkj,nj->nk', xyz, center), axis=1)
+        radius = np.degrees(np.arccos(np.clip(cos_r, -1., 1.)))
+        radius = radius * (1. + _CAP_MARGIN) + 1e-9
+        self.valid &= np.isfinite(radius)
+
+        self.center_ra = np.degrees(np.arctan2(center[:, 1], center[:, 0])) % 360.
+        self.center_dec = np.degrees(np.arcsin(np.clip(center[:, 2], -1., 1.)))
+        self.radius = radius
+
+        # Candidate images of a position are found through a Dec-sorted index of the caps.
+        self._order = np.flatnonzero(self.valid)[np.argsort(self.center_dec[self.valid], kind='stable')]
+        self._sorted_dec = self.center_dec[self._order]
+        self._max_radius = float(self.radius[self._order].max()) if len(self._order) else 0.
+
+    def _candidates(self, ra, dec, radius):
+        """
+        Yields arrays (position, image) of pairs whose caps are within radius of each other,
+        in chunks of about _CHUNK_PAIRS pairs.
+        """
+        reach = self._max_radius + radius
+        lo = np.searchsorted(self._sorted_dec, dec - reach, side='left')
+        hi = np.searchsorted(self._sorted_dec, dec + reach, side='right')
+        counts = hi - lo
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(ra):
+            # Positions whose pairs fit in one chunk (at least one position).
+            base = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, base + _CHUNK_PAIRS, side='right')), start + 1)
+            stop = min(stop, len(ra))
+            chunk_counts = counts[start:stop]
+            pos = np.repeat(np.arange(start, stop), chunk_counts)
+            offsets = np.arange(len(pos)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            img = self._order[np.repeat(lo[start:stop], chunk_counts) + offsets]
+            start = stop
+            if len(pos) == 0:
+                continue
+            sep = utils.angular_separation(ra[pos], dec[pos], self.center_ra[img], self.center_dec[img])
+            near = sep <= self.radius[img] + radius[pos]
+            yield pos[near], img[near]
+
+    def _to_intermediate(self, ra, dec, img):
+        return _project(ra, dec, self.crval[img, 0], self.crval[img, 1], self.projection[img])
+
+    def _to_pixel(self, x, y, img):
+        inv = self._cd_inv[img]
+        px = inv[:, 0, 0] * x + inv[:, 0, 1] * y + self.crpix[img, 0]
+        py = inv[:, 1, 0] * x + inv[:, 1, 1] * y + self.crpix[img, 1]
+        return px, py
+
+    def contains(self, ra, dec):
+        """
+        Finds the images containing each position.
+
+        Parameters
+        ----------
+        ra, dec : numpy.ndarray
+            Positions in degrees.
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray)
+            Position indices and image indices of every (position, image)
+            pair where the image contains the position, sorted by position.
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        positions, images = [], []
+        for pos, img in self._candidates(ra, dec, np.zeros(len(ra))):
+            x, y, valid = self._to_intermediate(ra[pos], dec[pos], img)
+            px, py = self._to_pixel(x, y, img)
+            inside = (valid & (px >= 0.5) & (px <= self.naxis[img, 0] + 0.5)
+                      & (py >= 0.5) & (py <= self.naxis[img, 1] + 0.5))
+            positions.append(pos[inside])
+            images.append(img[inside])
+        return self._sorted_pairs(positions, images)
+
+    def overlaps(self, ra, dec, radius):
+        """
+        Finds the images overlapping each circular region.
+
+        The distance from the region's center to the footprint is measured in
+        the image's projection plane, which matches the angular distance
+        closely for regions and images smaller than a few degrees.
+
+        Parameters
+        ----------
+        ra, dec : numpy.ndarray
+            Region centers in degrees.
+        radius : numpy.ndarray
+            Region radii in degrees, one per region.
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray)
+            Region indices and image indices of every overlapping pair, sorted by region.
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), ra.shape)
+        positions, images = [], []
+        for pos, img in self._candidates(ra, dec, radius):
+            x, y, valid = self._to_intermediate(ra[pos], dec[pos], img)
+            px, py = self._to_pixel(x, y, img)
+            inside = ((px >= 0.5) & (px <= self.naxis[img, 0] + 0.5)
+                      & (py >= 0.5) & (py <= self.naxis[img, 1] + 0.5))
+            corners = self._corners[img]
+            distance = np.full(len(pos), np.inf)
+            for k in range(4):
+                a, b = corners[:, k], corners[:, (k + 1) % 4]
+                distance = np.minimum(distance, _segment_distance(x, y, a[:, 0], a[:, 1], b[:, 0], b[:, 1]))
+            hit = valid & (inside | (distance <= radius[pos]))
+            positions.append(pos[hit])
+            images.append(img[hit])
+        return self._sorted_pairs(positions, images)
+
+    @staticmethod
+    def _sorted_pairs(positions, images):
+        if not positions:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        positions = np.concatenate(positions)
+        images = np.concatenate(images)
+        order = np.lexsort((images, positions))
+        return positions[order], images[order]
+
+    def best_sampled(self, ra, dec):
+        """
+        Returns, for each position, the index of the image with the finest
+        pixel scale that contains it, or -1 where no image does.
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        best = np.full(len(ra), -1)
+        pos, img = self.contains(ra, dec)
+        if len(pos):
+            # Sort by position, then scale, and keep the first image of each position.
+            order = np.lexsort((self.pixel_scale[img], pos))
+            pos, img = pos[order], img[order]
+            first = np.ones(len(pos), dtype=bool)
+            first[1:] = pos[1:] != pos[:-1]
+            best[pos[first]] = img[first]
+        return best
@@ -2,12 +2,10 @@
 VO Image Queries
 """
 from enum import Enum
-from astroquery.query import BaseQuery
-from astroquery.utils import parse_coordinates
-from astropy.coordinates import SkyCoord
-from astropy.table import Table, Row
 
 from . import utils
+from .query import BaseQuery
+from .retry import RetryPolicy
 
 __all__ = ['Image', 'ImageClass', 'ImageTable']
 
@@ -19,17 +17,21 @@ class ImageClass(BaseQuery):
         super(ImageClass, self).__init__()
         self._TIMEOUT = 60 # seconds to timeout
         self._RETRIES = 3 # total number of times to try
+        self._RETRY_POLICY = RetryPolicy() # backoff, adaptive timeouts, circuit breaker, hedging
 
 
-    def query(self, service, coords, radius='0.000001', image_format=None, verbose=False):
+    def query(self, service, coords, radius='0.000001', image_format=None, verbose=False, max_workers=None, executor=None,
+              merge=False):
         """Basic image search query function
 
-        Input coords should be either a single string, a single
-        SkyCoord object, or a list. It will then loop over the objects
-        in the list, assuming each is a single source. Within the
-        _one_image_search function, it then expects likewise a single
-        string, a single SkyCoord object, or list of 2 as an RA,DEC
-        pair.
+        Input coords should be either a single string, a SkyCoord
+        object (scalar or array), an (ra, dec) tuple in degrees (of
+        scalars or arrays), an (N,2) numpy array of RA,DEC in degrees,
+        an astropy Table with ra/dec columns, or a list of strings,
+        SkyCoords or RA,DEC pairs. All positions are converted to
+        RA,DEC in one vectorized pass and then searched one by one.
+        Input radius is a single value or one per position, in degrees
+        unless given as a Quantity.
 
         Input service can be a string URL, an astropy Table returned
         from Registry.query() (or selected from it), or a single row
@@ -39,20 +41,47 @@ class ImageClass(BaseQuery):
         image_format = one of the following options: ALL, GRAPHICS,
                     FITS, PNG, JPEG/JPG (default = ALL)
 
+        max_workers = if given, run the per-position queries concurrently
+                    in a thread pool of this many workers (default = serial)
+        executor = a concurrent.futures.Executor to run the queries on
+                    instead; takes precedence over max_workers
+        merge = if True, return one table holding the rows of every
+                    position, with input_index, input_ra and input_dec
+                    columns, instead of a list of tables (see
+                    utils.merge_results; utils.group_view and
+                    utils.position_rows give back each position's rows)
+
+        """
+        if merge:
+            coords = utils.parse_coordinates_array(coords)
+        results = [image_table for j, image_table in self.iter_query(service, coords, radius, image_format=image_format,
+                                                                     verbose=verbose, max_workers=max_workers,
+                                                                     executor=executor, ordered=True)]
+        if merge:
+            from .image_table import ImageTable
+            return utils.merge_results(results, *coords, table_class=ImageTable)
+        return results
+
+    def iter_query(self, service, coords, radius='0.000001', image_format=None, verbose=False, max_workers=None,
+                   executor=None, ordered=False):
+        """Image search that yields each position's result as it arrives
+
+        Arguments are as for query().  Returns a generator of (index,
+        ImageTable) pairs, index being the position's index in coords, so
+        that e.g. downloads or cutouts of the first results can start while
+        later ones are still being fetched.
+
+        ordered = if True, yield the results in the order of coords;
+                    otherwise in the order they complete
+
         """
 
         if type(service) is str:
             service = {"access_url":service}
 
-        if type(coords) is str or isinstance(coords, SkyCoord):
-            coords = [coords]
-        assert type(coords) is list, "ERROR: Give a coordinate object that is a single string, a list/tuple (ra,dec), a SkyCoord, or a list of any of the above."
-#        Tracer()()
-        if type(radius) is not list:
-            inradius = [radius]*len(coords)
-        else:
-            inradius = radius
-            assert len(inradius) == len(coords), 'Please give either single radius or list of radii of same length as coords.'
+        # Parse all positions and radii in one vectorized pass.
+        ra, dec = utils.parse_coordinates_array(coords)
+        inradius = utils.parse_radius_array(radius, len(ra))
         # Passing along proper image format parameters:
         if image_format is not None:
             if "fits" in image_format.lower():
@@ -71,52 +100,35 @@ class ImageClass(BaseQuery):
                 raise Exception("ERROR: please give a image_format that is one of FITS, JPEG, PNG, ALL, or GRAPHICS")
 
         # Expand the input parameters to a list of input parameter dictionaries for the call to query_loop.
-        params = [{'coords':c, 'radius':inradius[i], 'image_format':image_format} for i, c in enumerate(coords)]
-
-        result_list = utils.query_loop(self._one_image_search, service=service, params=params, verbose=verbose)
-        image_result_list = []
-        for result in result_list:
-            try:
-                image_table = ImageTable(result, copy=False)
-            except:
-                image_table = Table()
-                image_table.meta=result.meta
-                image_result_list.append(image_table)
-                print("ERROR parsing result as ImageTable. Setting as empty and appending meta-data")
-            image_result_list.append(image_table)
-
-#        for result in result_list:
-#            image_table = ImageTable(result, copy=False)
-#            image_result_list.append(image_table)
-
-        return image_result_list
-
-    def _one_image_search(self, coords, radius, service, image_format=None):
-        if (type(coords) is tuple or type(coords) is list) and len(coords) == 2:
-            coords = parse_coordinates("{} {}".format(coords[0], coords[1]))
-        elif type(coords) is str:
-            coords = parse_coordinates(coords)
-        else:
-            assert isinstance(coords, SkyCoord), "ERROR: cannot parse input coordinates {}".format(coords)
+        params = [{'coords':c, 'radius':r, 'image_format':image_format, 'verbose':verbose}
+                  for c, r in zip(zip(ra.tolist(), dec.tolist()), inradius.tolist())]
+
+        results = utils.iter_query_loop(self._one_image_search, service=service, params=params, verbose=verbose,
+                                        max_workers=max_workers, executor=executor, ordered=ordered)
+        return ((j, _image_table(result)) for j, result in results)
+
+    def _one_image_search(self, coords, radius, service, image_format=None, verbose=False):
+        ra, dec = utils.parse_coordinates_array(coords)
 
         params = {
-            'POS': utils.sval(coords.ra.deg) + ',' + utils.sval(coords.dec.deg),
+            'POS': utils.sval(ra[0]) + ',' + utils.sval(dec[0]),
             'SIZE': utils.sval(2.*float(radius)),   #Note: size in SIA is diameter, not radius!
             }
         if image_format is not None:
             params['FORMAT'] = image_format
 
-        response = utils.try_query(service, get_params=params, timeout=self._TIMEOUT, retries=self._RETRIES)
-        return utils.astropy_table_from_votable_response(response)
+        return utils.query_votable(service, 'image', get_params=params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=verbose)
 
     def get_column(self, table, mnemonic):
+        from astropy.table import Table
         col = None
         if not isinstance(mnemonic, ImageColumn):
             raise ValueError('mnemonic must be an enumeration member of ImageColumn.')
         elif not isinstance(table, Table):
             raise ValueError('table must be an instance of astropy.Table.')
         else:
-            col = utils.find_column_by_ucd(table, mnemonic.value)
+            col = utils.find_column_by_ucd(table, mnemonic.value['ucd'])
         return col
 
     def get_column_name(self, table, mnemonic):
@@ -228,97 +240,22 @@ class ImageColumn(Enum):
     '''}
 
 
-#
-# Custom subclass of astropy Table.
-#
-
-class ImRow(Row):
-    """
-    This Row allows column access by ImageColumn UCD values.
-    """
-    def __getitem__(self, item):
-        if isinstance(item, ImageColumn):
-            colname = self.table.stdcol_to_colname(item)
-            val = None
-            if colname is not None:
-                val = super().__getitem__(colname)
-            return val
-        else:
-            return super().__getitem__(item)
-
-
-class ImageTable(Table):
-    """
-    Custom subclass of astropy.table.Table
-    """
-
-    Row = ImRow
-
-    __ucdmap__ = None
+def _image_table(result):
+    from astropy.table import Table
+    from .image_table import ImageTable
 
-#    def __init__(self, table,**kwargs):
-#        """ An init that attempts to trap issues and return the meta data for debugging."""
-#        try:
-#            Table.__init__(self,table,**kwargs)
-#            self.table=Table(table,**kwargs)
-#        except:
-#            print("ERROR parsing input as ImageTable. Setting as an empty table and appending meta-data")
-#            self.table=Table()
-#            self.table.meta=table.meta
+    try:
+        image_table = ImageTable(result, copy=False)
+    except:
+        image_table = Table()
+        image_table.meta=result.meta
+        print("ERROR parsing result as ImageTable. Setting as empty and appending meta-data")
+    return image_table
 
 
-    def __compute_ucd_column__(self, mnemonic):
-        col = None
-        if not isinstance(mnemonic, ImageColumn):
-            raise ValueError('mnemonic must be an enumeration member of ImageColumn.')
-        else:
-            col = utils.find_column_by_ucd(self, mnemonic.value['ucd'])
-        return col
-
-    def __compute_ucd_column_name__(self, mnemonic):
-        name = None
-        col = self.__compute_ucd_column__(mnemonic)
-        if col is not None:
-            name = col.name
-        return name
-
-    def get_ucdmap(self):
-        if not self.__ucdmap__:
-            self.__ucdmap__ = {}
-            for ucd in ImageColumn:
-                colname = self.__compute_ucd_column_name__(ucd)
-                self.__ucdmap__[ucd.name] = colname
-
-        return self.__ucdmap__
-
-    def __getitem__(self, item):
-        if isinstance(item, ImageColumn):
-            colname = self.stdcol_to_colname(item)
-            if colname is None:
-                return None
-            else:
-                return super().__getitem__(colname)
-        else:
-            return super().__getitem__(item)
-
-    def stdcol_to_colname(self, mnemonic):
-        if not isinstance(mnemonic, ImageColumn):
-            raise ValueError('mnemonic must be an enumeration member of ImageColumn.')
-        else:
-            ucdmap = self.get_ucdmap()
-            name = ucdmap.get(mnemonic.name)
-        return name
-
-    def colname_to_stdcol(self, colname):
-        imgcol = None
-        if colname not in self.colnames:
-            raise ValueError(f'colname {colname} is not the name of a column in this table.')
-        else:
-            ucdmap = self.get_ucdmap()
-            for img, col in ucdmap.items():
-                if colname == col:
-                    for e in ImageColumn:
-                        if e.name == img:
-                            imgcol = e
-
-        return imgcol
+def __getattr__(name):
+    # The Table subclasses load astropy.table, so they are only imported when first used.
+    if name in ('ImageTable', 'ImRow'):
+        from . import image_table
+        return getattr(image_table, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,251 @@
+"""
+Table of VO image query results
+"""
+import numpy as np
+from astropy.table import Table, Row
+
+from . import utils
+from .footprint import FootprintIndex
+from .image import ImageColumn
+
+__all__ = ['ImageTable', 'ImRow']
+
+
+#
+# Custom subclass of astropy Table.
+#
+
+class ImRow(Row):
+    """
+    This Row allows column access by ImageColumn UCD values.
+    """
+    def __getitem__(self, item):
+        if isinstance(item, ImageColumn):
+            colname = self.table.stdcol_to_colname(item)
+            val = None
+            if colname is not None:
+                val = super().__getitem__(colname)
+            return val
+        else:
+            return super().__getitem__(item)
+
+
+class ImageTable(Table):
+    """
+    Custom subclass of astropy.table.Table
+    """
+
+    Row = ImRow
+
+    def _stdcol_maps(self):
+        # Taken from the process-wide index for this schema, and looked up
+        # again when columns have been added, removed or renamed.
+        colnames = tuple(self.colnames)
+        cached = getattr(self, '_stdcol_maps_cache', None)
+        if cached is None or cached[0] != colnames:
+            cached = self._stdcol_maps_cache = (colnames, utils.stdcol_maps(self, ImageColumn, 'ucd'))
+        return cached[1]
+
+    def get_ucdmap(self):
+        return self._stdcol_maps()[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, ImageColumn):
+            colname = self.stdcol_to_colname(item)
+            if colname is None:
+                return None
+            else:
+                return super().__getitem__(colname)
+        else:
+            return super().__getitem__(item)
+
+    def stdcol_to_colname(self, mnemonic):
+        if not isinstance(mnemonic, ImageColumn):
+            raise ValueError('mnemonic must be an enumeration member of ImageColumn.')
+        else:
+            ucdmap = self.get_ucdmap()
+            name = ucdmap.get(mnemonic.name)
+        return name
+
+    def colname_to_stdcol(self, colname):
+        if colname not in self.colnames:
+            raise ValueError(f'colname {colname} is not the name of a column in this table.')
+        return self._stdcol_maps()[1].get(colname)
+
+    #
+    # Columnar access to standard columns as numeric arrays.
+    #
+
+    def get_array(self, mnemonic, width=None, dtype=float):
+        """
+        Returns a whole standard column as a numeric numpy array.
+
+        Columns holding space-separated lists (NAXIS, SCALE, CRPIX, CRVAL,
+        CDMATRIX) are parsed in one pass over the column into an (N, width)
+        array; scalar columns give an (N,) array.  Missing or unparsable
+        entries are NaN for float dtypes.  Results are cached on the table;
+        call clear_array_cache() after modifying it.
+
+        Parameters
+        ----------
+        mnemonic : ImageColumn
+            The standard column.
+        width : int
+            Number of values per row for list columns; None for scalar columns.
+        dtype : numpy dtype
+            dtype of the returned array.
+
+        Returns
+        -------
+        numpy.ndarray
+            The values, or None if the table doesn't have the column.
+        """
+        cache = getattr(self, '_stdcol_array_cache', None)
+        if cache is None:
+            cache = self._stdcol_array_cache = {}
+        key = (mnemonic, width, np.dtype(dtype))
+        if key not in cache:
+            col = self[mnemonic]
+            cache[key] = None if col is None else _parse_value_lists(col, width).astype(dtype)
+        return cache[key]
+
+    def clear_array_cache(self):
+        """Discards the arrays cached by get_array(), the footprint index and the standard column maps."""
+        self._stdcol_array_cache = {}
+        self._footprint_index = None
+        self._stdcol_maps_cache = None
+
+    def naxis_array(self):
+        """(N, 2) array of image lengths in pixels along each axis."""
+        naxis = self.get_array(ImageColumn.NAXIS, width=2)
+        return None if naxis is None else np.nan_to_num(naxis, nan=0).astype(int)
+
+    def scale_array(self):
+        """(N, 2) array of image scales in degrees per pixel."""
+        return self.get_array(ImageColumn.SCALE, width=2)
+
+    def crpix_array(self):
+        """(N, 2) array of WCS reference pixels."""
+        return self.get_array(ImageColumn.CRPIX, width=2)
+
+    def crval_array(self):
+        """(N, 2) array of WCS reference values (RA, Dec) in degrees."""
+        return self.get_array(ImageColumn.CRVAL, width=2)
+
+    def cdmatrix_array(self):
+        """(N, 4) array of WCS CD matrices, ordered CD1_1, CD1_2, CD2_1, CD2_2."""
+        return self.get_array(ImageColumn.CDMATRIX, width=4)
+
+    def radec_arrays(self):
+        """RA and Dec of the image centers as (N,) float arrays in degrees."""
+        return self.get_array(ImageColumn.RA), self.get_array(ImageColumn.DEC)
+
+    #
+    # Local footprint queries.
+    #
+
+    def footprint_index(self):
+        """
+        Returns the FootprintIndex of the images in this table, built from the
+        WCS columns on first use and cached like get_array().
+        """
+        index = getattr(self, '_footprint_index', None)
+        if index is None:
+            index = self._footprint_index = FootprintIndex.from_table(self)
+        return index
+
+    def contains(self, coords):
+        """
+        Finds the images containing each of the given positions, without
+        querying the service again.
+
+        Parameters
+        ----------
+        coords
+            Positions in any form accepted by Image.query().
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray)
+            Position indices and row indices of every (position, image) pair
+            where the image contains the position, sorted by position.  For
+            example, table[rows[points == 0]] are the images containing the
+            first position.
+        """
+        ra, dec = utils.parse_coordinates_array(coords)
+        return self.footprint_index().contains(ra, dec)
+
+    def overlaps(self, coords, radius):
+        """
+        Finds the images overlapping each of the given circular regions.
+
+        Parameters
+        ----------
+        coords
+            Region centers in any form accepted by Image.query().
+        radius
+            A single radius or one per region, in degrees unless given as a Quantity.
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray)
+            Region indices and row indices of every overlapping pair, sorted by region.
+        """
+        ra, dec = utils.parse_coordinates_array(coords)
+        radius = utils.parse_radius_array(radius, len(ra))
+        return self.footprint_index().overlaps(ra, dec, radius)
+
+    def best_sampled(self, coords):
+        """
+        Returns, for each position, the row index of the containing image with
+        the finest pixel scale, or -1 where no image contains the position.
+        """
+        ra, dec = utils.parse_coordinates_array(coords)
+        return self.footprint_index().best_sampled(ra, dec)
+
+
+def _parse_value_lists(col, width=None):
+    """
+    Parses a column of numbers, or of space-separated lists of numbers, into a
+    float array: (N,) for scalars (width None) or (N, width) for lists.
+    """
+    mask = np.ma.getmaskarray(col)
+    data = np.ma.getdata(col)
+    n = len(data)
+
+    # Numeric columns were already parsed by the VOTABLE reader.
+    if data.dtype.kind in 'iuf':
+        values = data.astype(float)
+        values[mask] = np.nan
+        return values
+
+    if data.dtype.kind == 'O':
+        # str, bytes, or numeric arrays from variable-length VOTABLE fields.
+        strings = [' '.join(str(x) for x in np.ravel(v)) if isinstance(v, np.ndarray) else utils.sval(v)
+                   for v in data]
+    else:
+        strings = data.astype(str).tolist()
+    for i in np.flatnonzero(mask):
+        strings[i] = ''
+
+    # One split and one conversion over the whole column when every row has
+    # exactly k single-space-separated values; anything else takes the slow path.
+    k = 1 if width is None else width
+    stripped = np.char.strip(np.array(strings, dtype=str))
+    if n and np.all(np.char.count(stripped, ' ') == k - 1) and np.all(np.char.str_len(stripped) > 0):
+        tokens = ' '.join(stripped.tolist()).split(' ')
+        try:
+            values = np.array(tokens, dtype=float)
+            return values if width is None else values.reshape(n, k)
+        except ValueError:
+            pass
+
+    # Ragged, missing or unparsable entries: row by row, padding with NaN.
+    values = np.full((n, k), np.nan)
+    for i, string in enumerate(strings):
+        try:
+            row = np.array(string.split()[:k], dtype=float)
+        except ValueError:
+            continue
+        values[i, :len(row)] = row
+    return values[:, 0] if width is None else values
@@ -0,0 +1,407 @@
+"""
+Per-request timing and metrics.
+
+Queries record, for each request, the service URL, the time spent in each
+phase (connect, time to first byte, transfer, VOTABLE parse, stringify),
+the bytes moved and the number of retries.  Records go to every registered
+sink; with no sinks nothing is measured.
+
+    from navo_utils import metrics
+    sink = metrics.add_sink(metrics.MemorySink())
+    ... run queries ...
+    sink.summary()
+
+Sinks are objects with an emit(record) method, or plain callables taking the
+record dict.  MemorySink aggregates in memory, JsonlSink appends one JSON line
+per record and PrometheusSink renders the Prometheus text exposition format.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+__all__ = ['PHASES', 'MemorySink', 'JsonlSink', 'PrometheusSink', 'add_sink', 'remove_sink', 'clear_sinks',
+           'active', 'span', 'current', 'emit']
+
+PHASES = ('connect', 'ttfb', 'transfer', 'parse', 'stringify')
+
+_sinks = []
+_sinks_lock = threading.Lock()
+_local = threading.local()
+
+
+def add_sink(sink):
+    """
+    Sends all future records to sink, and returns it.
+    """
+    with _sinks_lock:
+        _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+def clear_sinks():
+    with _sinks_lock:
+        del _sinks[:]
+
+
+def active():
+    """
+    Returns True if any sink is registered, i.e. if measurements are wanted.
+    """
+    return bool(_sinks)
+
+
+def emit(record):
+    """
+    Sends a record to every sink.  A failing sink is reported and skipped.
+    """
+    for sink in list(_sinks):
+        try:
+            if hasattr(sink, 'emit'):
+                sink.emit(record)
+            else:
+                sink(record)
+        except Exception as e:
+            print('ERROR: metrics sink {!r} failed: {}'.format(sink, e))
+
+
+def new_record(kind, url, method=None):
+    """
+    Returns an empty record for a request of the given kind ('cone', 'tap', ...) to url.
+    """
+    record = {
+        'time': time.time(),
+        'kind': kind,
+        'url': url,
+        'host': urllib.parse.urlsplit(url).netloc.lower() if url else None,
+        'method': method,
+        'status': None,
+        'retries': 0,
+        'hedged': False,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'rows': None,
+        'error': None,
+        'total': None,
+    }
+    for phase in PHASES:
+        record[phase] = None
+    return record
+
+
+def current():
+    """
+    Returns the record of the span open in this thread, or None.
+    """
+    return getattr(_local, 'record', None)
+
+
+@contextlib.contextmanager
+def span(kind, url, method=None):
+    """
+    Context manager covering one logical request.  Instrumented code running
+    inside it (try_query, astropy_table_from_votable_response) adds its
+    phases to the same record, which is emitted when the span ends.  Yields
+    the record, or None when no sink is registered.
+    """
+    if not _sinks or current() is not None:
+        yield current()
+        return
+    record = new_record(kind, url, method)
+    _local.record = record
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        _local.record = None
+        record['total'] = time.perf_counter() - start
+        emit(record)
+
+
+def add_phase(record, phase, seconds):
+    record[phase] = (record[phase] or 0.) + seconds
+
+
+def note_response(record, response, latency, connect, stream):
+    """
+    Adds the network phases of a finished request attempt to a record.
+
+    Parameters
+    ----------
+    record : dict
+        The record to fill.
+    response : requests.Response
+        The response of the attempt.
+    latency : float
+        Seconds spent in session.request().
+    connect : float
+        Seconds spent opening new connections, including TLS handshakes.
+    stream : bool
+        Whether the body was left unread.
+    """
+    ttfb = response.elapsed.total_seconds() if response.elapsed is not None else latency
+    record['status'] = response.status_code
+    add_phase(record, 'connect', connect)
+    add_phase(record, 'ttfb', max(ttfb - connect, 0.))
+    if not stream:
+        add_phase(record, 'transfer', max(latency - ttfb, 0.))
+        record['bytes_received'] += len(response.content)
+    else:
+        record['bytes_received'] += int(response.headers.get('Content-Length', 0) or 0)
+    body = response.request.body if response.request is not None else None
+    if body is not None:
+        record['bytes_sent'] += len(body)
+
+
+#
+# Connection timing, for the connect phase
+#
+
+def connect_time():
+    """
+    Returns the seconds this thread has spent opening connections so far.
+    """
+    return getattr(_local, 'connect', 0.)
+
+
+_adapter_class = None
+
+
+def timed_adapter(**kwargs):
+    """
+    Returns a requests HTTPAdapter whose connections add the time spent
+    connecting (and in the TLS handshake) to connect_time().
+    """
+    global _adapter_class
+    if _adapter_class is None:
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        def timed(connection_class):
+            class TimedConnection(connection_class):
+                def connect(self):
+                    start = time.perf_counter()
+                    try:
+                        super().connect()
+                    finally:
+                        _local.connect = connect_time() + time.perf_counter() - start
+            return TimedConnection
+
+        class TimedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = timed(HTTPConnection)
+
+        class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = timed(HTTPSConnection)
+
+        class TimedHTTPAdapter(HTTPAdapter):
+            def init_poolmanager(self, *args, **pool_kwargs):
+                super().init_poolmanager(*args, **pool_kwargs)
+                self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                           'https': TimedHTTPSConnectionPool}
+
+        _adapter_class = TimedHTTPAdapter
+    return _adapter_class(**kwargs)
+
+
+#
+# Sinks
+#
+
+class MemorySink:
+    """
+    Keeps records in memory and summarizes them per service.
+
+    Parameters
+    ----------
+    max_records : int
+        Only the most recent records are kept.
+    """
+
+    def __init__(self, max_records=100000):
+        self.records = collections.deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+    def summary(self, by='url'):
+        """
+        Summarizes the records per service.
+
+        Parameters
+        ----------
+        by : str
+            Record field to group on: 'url', 'host' or 'kind'.
+
+        Returns
+        -------
+        dict
+            For each group: count, errors, retries, bytes received, and the
+            mean and 50th/95th/99th percentile seconds of each phase and of the total.
+        """
+        with self._lock:
+            records = list(self.records)
+        groups = collections.defaultdict(list)
+        for record in records:
+            groups[record.get(by)].append(record)
+
+        summary = {}
+        for key, group in groups.items():
+            entry = {
+                'count': len(group),
+                'errors': sum(1 for r in group if r.get('error') or (r.get('status') or 0) >= 400),
+                'retries': sum(r.get('retries') or 0 for r in group),
+                'bytes_received': sum(r.get('bytes_received') or 0 for r in group),
+            }
+            for phase in PHASES + ('total',):
+                values = np.array([r[phase] for r in group if r.get(phase) is not None], dtype=float)
+                if len(values):
+                    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                    entry[phase] = {'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95),
+                                    'p99': float(p99)}
+            summary[key] = entry
+        return summary
+
+    def slowest(self, n=10, phase='total'):
+        """
+        Returns the n records with the most time in the given phase.
+        """
+        with self._lock:
+            records = [r for r in self.records if r.get(phase) is not None]
+        return sorted(records, key=lambda r: r[phase], reverse=True)[:n]
+
+
+class JsonlSink:
+    """
+    Appends each record to a file as one line of JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class PrometheusSink:
+    """
+    Aggregates records into counters and histograms, rendered in the
+    Prometheus text exposition format by render(), e.g. for a textfile
+    collector or a /metrics endpoint.
+
+    Parameters
+    ----------
+    buckets : sequence of float
+        Upper bounds in seconds of the latency histogram buckets.
+    prefix : str
+        Prefix of the metric names.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='navo'):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self._requests = collections.Counter()
+        self._retries = collections.Counter()
+        self._bytes = collections.Counter()
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        host = record.get('host') or ''
+        kind = record.get('kind') or ''
+        status = str(record.get('status') or ('error' if record.get('error') else ''))
+        with self._lock:
+            # Batch records from query_loop only contribute their total time.
+            if kind != 'query_loop':
+                self._requests[(kind, host, status)] += 1
+                self._retries[(kind, host)] += record.get('retries') or 0
+                self._bytes[(kind, host, 'received')] += record.get('bytes_received') or 0
+                self._bytes[(kind, host, 'sent')] += record.get('bytes_sent') or 0
+            for phase in PHASES + ('total',):
+                seconds = record.get(phase)
+                if seconds is None:
+                    continue
+                key = (kind, host, phase)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0.]
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        histogram[0][i] += 1
+                histogram[1] += 1
+                histogram[2] += seconds
+
+    @staticmethod
+    def _labels(**labels):
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in labels.items()) + '}'
+
+    def render(self):
+        """
+        Returns the metrics as Prometheus exposition text.
+        """
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines.append('# HELP {}_requests_total Requests sent to VO services.'.format(p))
+            lines.append('# TYPE {}_requests_total counter'.format(p))
+            for (kind, host, status), n in sorted(self._requests.items()):
+                lines.append('{}_requests_total{} {}'.format(p, self._labels(kind=kind, host=host, status=status), n))
+            lines.append('# HELP {}_retries_total Retried request attempts.'.format(p))
+            lines.append('# TYPE {}_retries_total counter'.format(p))
+            for (kind, host), n in sorted(self._retries.items()):
+                lines.append('{}_retries_total{} {}'.format(p, self._labels(kind=kind, host=host), n))
+            lines.append('# HELP {}_bytes_total Bytes moved to and from VO services.'.format(p))
+            lines.append('# TYPE {}_bytes_total counter'.format(p))
+            for (kind, host, direction), n in sorted(self._bytes.items()):
+                lines.append('{}_bytes_total{} {}'.format(
+                    p, self._labels(kind=kind, host=host, direction=direction), n))
+            lines.append('# HELP {}_phase_seconds Time spent in each phase of a request.'.format(p))
+            lines.append('# TYPE {}_phase_seconds histogram'.format(p))
+            for (kind, host, phase), (counts, count, total) in sorted(self._histograms.items()):
+                for bound, n in zip(self.buckets, counts):
+                    lines.append('{}_phase_seconds_bucket{} {}'.format(
+                        p, self._labels(kind=kind, host=host, phase=phase, le=repr(float(bound))), n))
+                lines.append('{}_phase_seconds_bucket{} {}'.format(
+                    p, self._labels(kind=kind, host=host, phase=phase, le='+Inf'), count))
+                lines.append('{}_phase_seconds_sum{} {!r}'.format(p, self._labels(kind=kind, host=host, phase=phase),
+                                                                   total))
+                lines.append('{}_phase_seconds_count{} {}'.format(
+                    p, self._labels(kind=kind, host=host, phase=phase), count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes render() to a file atomically, as the node_exporter textfile collector expects.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
@@ -0,0 +1,198 @@
+"""
+Parsing of VOTABLE responses in a pool of worker processes.
+
+Table.read(format='votable') is pure Python and holds the GIL, so however
+many threads fetch results, their parsing runs on one core.  Once a pool is
+enabled, astropy_table_from_votable_response hands the raw response bytes
+to a worker process, which parses and stringifies the table and sends it
+back in a compact form; the fetching thread waits without holding the GIL.
+
+    from navo_utils import parse_pool
+    parse_pool.enable()          # one worker per CPU
+    results = Cone.query(service, coords, radius, max_workers=16)
+"""
+
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+
+__all__ = ['enable', 'disable', 'get_pool', 'parse']
+
+_pool = None
+_own_pool = False
+_pool_lock = threading.Lock()
+
+
+def enable(processes=None, executor=None):
+    """
+    Parses every VOTABLE response in worker processes from now on.
+
+    Parameters
+    ----------
+    processes : int
+        Number of worker processes (default: one per CPU).
+    executor : concurrent.futures.ProcessPoolExecutor
+        A pool to use instead of starting one; disable() leaves it running.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+        The pool in use.
+    """
+    global _pool, _own_pool
+    disable()
+    with _pool_lock:
+        if executor is None:
+            # Spawned rather than forked: the parent runs network threads.
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes or os.cpu_count(), mp_context=multiprocessing.get_context('spawn'),
+                initializer=_warm_up)
+            _own_pool = True
+        else:
+            _own_pool = False
+        _pool = executor
+    return executor
+
+
+def disable():
+    """
+    Parses responses in the calling thread again, shutting down the pool started by enable().
+    """
+    global _pool, _own_pool
+    with _pool_lock:
+        pool, own = _pool, _own_pool
+        _pool, _own_pool = None, False
+    if pool is not None and own:
+        pool.shutdown(wait=True)
+
+
+def get_pool():
+    """
+    Returns the pool responses are parsed in, or None if parsing in-process.
+    """
+    return _pool
+
+
+def _warm_up():
+    # Import the parser when a worker starts rather than on its first response.
+    import astropy.io.votable
+    import astropy.table
+
+
+def parse(content):
+    """
+    Parses VOTABLE bytes into a table with string columns, in the pool if one is enabled.
+
+    Parameters
+    ----------
+    content : bytes
+        The VOTABLE document.
+
+    Returns
+    -------
+    (astropy.table.Table or None, float, float)
+        The table (None if the content could not be parsed) and the seconds
+        the worker spent parsing and stringifying it.
+    """
+    pool = _pool
+    if pool is not None:
+        try:
+            encoded, parse_time, stringify_time = pool.submit(_parse_in_worker, content).result()
+            return (_decode(encoded) if encoded is not None else None), parse_time, stringify_time
+        except concurrent.futures.process.BrokenProcessPool as e:
+            print('ERROR: VOTABLE parse pool failed ({}); parsing in this process.'.format(e))
+    return _parse(content)
+
+
+def _parse(content):
+    from astropy.table import Table
+    from . import utils
+
+    start = time.perf_counter()
+    try:
+        table = Table.read(io.BytesIO(content), format='votable')
+    except Exception:
+        return None, time.perf_counter() - start, 0.
+    parsed = time.perf_counter()
+    utils.stringify_table(table)
+    return table, parsed - start, time.perf_counter() - parsed
+
+
+def _parse_in_worker(content):
+    table, parse_time, stringify_time = _parse(content)
+    return (_encode(table) if table is not None else None), parse_time, stringify_time
+
+
+#
+# Compact form of a table for the trip back from the worker.  Pickling the
+# Table itself works, but variable-length array columns hold one numpy
+# (masked) array per row, which unpickle slowly; they travel as one flat array.
+#
+
+def _encode(table):
+    columns = []
+    for col in table.itercols():
+        masked = hasattr(col, 'mask')
+        data = np.ma.getdata(col.data)
+        mask = np.ma.getmaskarray(col.data) if masked else None
+        if mask is not None and not mask.any():
+            mask = None
+        cells = None
+        if data.dtype == object:
+            data, cells = _pack_cells(data)
+        attrs = {'name': col.name, 'unit': col.unit, 'description': col.description, 'format': col.format,
+                 'meta': dict(col.meta)}
+        columns.append((attrs, masked, data, mask, cells))
+    return dict(table.meta), table.masked, columns
+
+
+def _decode(encoded):
+    from astropy.table import Column, MaskedColumn, Table
+
+    meta, table_masked, columns = encoded
+    cols = []
+    for attrs, masked, data, mask, cells in columns:
+        if cells is not None:
+            data = _unpack_cells(data, cells)
+        if masked:
+            cols.append(MaskedColumn(data, mask=mask, copy=False, **attrs))
+        else:
+            cols.append(Column(data, copy=False, **attrs))
+    return Table(cols, meta=meta, masked=table_masked, copy=False)
+
+
+def _pack_cells(values):
+    """
+    Returns (flat data, (lengths, flat mask, masked)) for an object column
+    whose cells are all 1-d arrays of one type and dtype, or (values, None).
+    """
+    if len(values) == 0:
+        return values, None
+    first = values[0]
+    cell_type = type(first)
+    if not isinstance(first, np.ndarray) or not all(
+            type(v) is cell_type and v.ndim == 1 and v.dtype == first.dtype for v in values):
+        return values, None
+    lengths = np.fromiter((v.size for v in values), dtype=np.int64, count=len(values))
+    flat = np.concatenate([np.ma.getdata(v) for v in values])
+    masked = isinstance(first, np.ma.MaskedArray)
+    mask = np.concatenate([np.ma.getmaskarray(v) for v in values]) if masked else None
+    return flat, (lengths, mask, masked)
+
+
+def _unpack_cells(flat, cells):
+    lengths, mask, masked = cells
+    bounds = np.cumsum(lengths)[:-1]
+    values = np.empty(len(lengths), dtype=object)
+    if masked:
+        for i, (data, cell_mask) in enumerate(zip(np.split(flat, bounds), np.split(mask, bounds))):
+            values[i] = np.ma.MaskedArray(data, mask=cell_mask)
+    else:
+        for i, data in enumerate(np.split(flat, bounds)):
+            values[i] = data
+    return values
@@ -0,0 +1,150 @@
+"""
+Planning of coalesced cone searches
+"""
+
+import numpy as np
+
+from . import utils
+
+__all__ = ['ConeGroup', 'plan_cone_groups', 'split_group_result']
+
+# An enclosing cone is only used if its area is at most this multiple of the
+# summed areas of the cones it replaces, so that coalescing does not make the
+# services send back many more rows than the separate searches would.
+DEFAULT_AREA_SLACK = 1.5
+
+
+class ConeGroup:
+    """
+    One enclosing cone search standing in for the searches of several positions.
+
+    Attributes
+    ----------
+    ra, dec, radius : float
+        The enclosing cone, in degrees.
+    members : numpy.ndarray
+        Indices of the input positions the cone covers.
+    """
+
+    def __init__(self, ra, dec, radius, members):
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius
+        self.members = members
+
+    def __repr__(self):
+        return 'ConeGroup(ra={:.6f}, dec={:.6f}, radius={:.6f}, members={})'.format(
+            self.ra, self.dec, self.radius, list(self.members))
+
+
+def _enclosing_cone(xyz, radius):
+    """
+    Returns (ra, dec, radius) of a cone around the mean direction that contains every given cone.
+    """
+    center = xyz.sum(axis=0)
+    center /= np.linalg.norm(center)
+    ra = np.degrees(np.arctan2(center[1], center[0])) % 360.
+    dec = np.degrees(np.arcsin(np.clip(center[2], -1., 1.)))
+    dist = np.degrees(np.arccos(np.clip(xyz @ center, -1., 1.)))
+    return ra, dec, float(np.max(dist + radius))
+
+
+def plan_cone_groups(ra, dec, radius, max_group_radius=None, area_slack=DEFAULT_AREA_SLACK):
+    """
+    Groups nearby positions so that each group can be served by one enclosing cone search.
+
+    Positions are bucketed by a 3-d grid over their unit vectors (which has no
+    trouble at RA=0 or the poles) with a cell size of about twice the largest
+    radius.  A bucket becomes one group if its enclosing cone is no larger than
+    max_group_radius and its area is at most area_slack times the summed areas
+    of its members' cones; otherwise its positions are searched separately.
+
+    Parameters
+    ----------
+    ra, dec, radius : numpy.ndarray
+        Positions and search radii, in degrees.
+    max_group_radius : float
+        Largest enclosing cone radius to send, in degrees.  Defaults to four
+        times the largest search radius.
+    area_slack : float
+        See above.
+
+    Returns
+    -------
+    list of ConeGroup
+        Every position is a member of exactly one group.
+    """
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    radius = np.asarray(radius, dtype=float)
+    n = len(ra)
+    if n == 0:
+        return []
+
+    r_max = float(radius.max())
+    if max_group_radius is None:
+        max_group_radius = 4 * r_max
+    xyz = utils.radec_to_xyz(ra, dec)
+
+    # Chord length is close to the angle in radians at these scales.
+    cell = max(2 * np.radians(r_max), 1e-9)
+    keys = np.floor(xyz / cell).astype(np.int64)
+    _, bucket = np.unique(keys, axis=0, return_inverse=True)
+    bucket = bucket.reshape(-1)
+    order = np.argsort(bucket, kind='stable')
+    bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+
+    groups = []
+    for members in np.split(order, bounds):
+        if len(members) > 1:
+            g_ra, g_dec, g_radius = _enclosing_cone(xyz[members], radius[members])
+            enclosing_area = 1. - np.cos(np.radians(g_radius))
+            member_area = np.sum(1. - np.cos(np.radians(radius[members])))
+            if g_radius <= max_group_radius and enclosing_area <= area_slack * member_area:
+                groups.append(ConeGroup(g_ra, g_dec, g_radius, members))
+                continue
+        for i in members:
+            groups.append(ConeGroup(float(ra[i]), float(dec[i]), float(radius[i]), np.array([i])))
+
+    # Keep the input order for the first member of each group.
+    groups.sort(key=lambda g: g.members.min())
+    return groups
+
+
+def split_group_result(table, group, ra, dec, radius):
+    """
+    Splits the result of an enclosing cone search into the result each member
+    position would have got from its own search, by exact angular distance.
+
+    Parameters
+    ----------
+    table : astropy.table.Table
+        Result of the search with the group's enclosing cone.
+    group : ConeGroup
+        The group searched.
+    ra, dec, radius : numpy.ndarray
+        All input positions and radii, in degrees.
+
+    Returns
+    -------
+    list of astropy.table.Table or None
+        One table per member, in the order of group.members, or None if the
+        result has no recognizable RA/Dec columns or was cut short by the
+        service's row limit (then rows of some members may be missing).
+    """
+    if len(group.members) == 1:
+        return [table]
+
+    if utils.is_truncated(table):
+        return None
+    ra_col, dec_col = utils.find_radec_columns(table)
+    if ra_col is None or dec_col is None:
+        return None
+
+    row_ra = np.asarray(table[ra_col], dtype=float)
+    row_dec = np.asarray(table[dec_col], dtype=float)
+    members = group.members
+    sep = utils.angular_separation(row_ra[:, np.newaxis], row_dec[:, np.newaxis],
+                                   ra[members][np.newaxis, :], dec[members][np.newaxis, :])
+    inside = sep <= radius[members][np.newaxis, :]
+    return [table[inside[:, k]] for k in range(len(members))]
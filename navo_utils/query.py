@@ -0,0 +1,25 @@
+"""
+Base class of the query classes
+"""
+
+__all__ = ['BaseQuery']
+
+
+class BaseQuery:
+    """
+    Lightweight base of ConeClass, ImageClass, SpectraClass, TapClass and
+    RegistryClass.
+
+    The classes used to derive from astroquery's BaseQuery, but send every
+    request through utils.try_query on the shared session instead of its
+    per-instance session and download cache; importing astroquery only for
+    the base class cost most of a second on each cold start.  This keeps the
+    parts they rely on.
+    """
+
+    def __init__(self):
+        self.name = self.__class__.__name__.split("Class")[0]
+
+    def __call__(self, *args, **kwargs):
+        """ init a fresh copy of self """
+        return self.__class__(*args, **kwargs)
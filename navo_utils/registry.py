@@ -4,10 +4,9 @@ VO Queries
 """
 
 from __future__ import print_function, division
-#from IPython.core.debugger import Tracer
-from astroquery.query import BaseQuery
-
 from . import utils
+from .query import BaseQuery
+from .retry import RetryPolicy
 
 __all__ = ['Registry', 'RegistryClass']
 
@@ -22,7 +21,37 @@ class RegistryClass(BaseQuery):
         super(RegistryClass, self).__init__()
         self._TIMEOUT = 60 # seconds
         self._RETRIES = 2 # total number of times to try
+        self._RETRY_POLICY = RetryPolicy() # backoff, adaptive timeouts, circuit breaker, hedging
         self._REGISTRY_TAP_SYNC_URL = "http://vao.stsci.edu/RegTAP/TapService.aspx/sync"
+        self._snapshot = None
+
+    def use_snapshot(self, path=None, refresh=True, max_age=24*3600, verbose=False):
+        """
+        Answer query() and query_counts() from a local snapshot of the
+        Registry tables instead of sending each query to the Registry service.
+
+        The snapshot is downloaded on first use and, when refresh is True,
+        brought up to date if it is older than max_age seconds.
+
+        Returns the RegistrySnapshot.
+        """
+        from .registry_snapshot import RegistrySnapshot, DEFAULT_PATH
+
+        snapshot = RegistrySnapshot(path or DEFAULT_PATH, tap_sync_url=self._REGISTRY_TAP_SYNC_URL)
+        if refresh or snapshot.is_empty():
+            snapshot.refresh(max_age=max_age, verbose=verbose)
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = snapshot
+        return snapshot
+
+    def use_service(self):
+        """
+        Send queries to the Registry service again after use_snapshot().
+        """
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = None
 
     def query(self, **kwargs):
 
@@ -33,6 +62,9 @@ class RegistryClass(BaseQuery):
         if kwargs.get('verbose'):
             print('Registry:  sending query ADQL = {}\n'.format(adql))
 
+        if self._snapshot is not None:
+            return self._snapshot.query(adql)
+
         url = self._REGISTRY_TAP_SYNC_URL
 
         tap_params = {
@@ -41,12 +73,12 @@ class RegistryClass(BaseQuery):
             "query": adql
         }
 
-        response = utils.try_query(url, post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES)
+        aptable = utils.query_votable(url, 'registry', post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                      policy=self._RETRY_POLICY, verbose=kwargs.get('verbose', False))
 
         if kwargs.get('verbose'):
-            print('Queried: {}\n'.format(response.url))
+            print('Queried: {}\n'.format(aptable.meta.get('url')))
 
-        aptable = utils.astropy_table_from_votable_response(response)
         return aptable
 
     # TBD support list of wavebands
@@ -152,6 +184,9 @@ class RegistryClass(BaseQuery):
         if kwargs.get('verbose'):
             print('Registry:  sending query ADQL = {}\n'.format(adql))
 
+        if self._snapshot is not None:
+            return self._snapshot.query(adql)
+
         url = self._REGISTRY_TAP_SYNC_URL
 
         tap_params = {
@@ -160,12 +195,12 @@ class RegistryClass(BaseQuery):
             "query": adql
         }
 
-        response = self._request('POST', url, data=tap_params, cache=False)
+        aptable = utils.query_votable(url, 'registry', post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                      policy=self._RETRY_POLICY, verbose=kwargs.get('verbose', False))
 
         if kwargs.get('verbose'):
-            print('Queried: {}\n'.format(response.url))
+            print('Queried: {}\n'.format(aptable.meta.get('url')))
 
-        aptable = utils.astropy_table_from_votable_response(response)
         return aptable
 
 
@@ -0,0 +1,258 @@
+"""
+Local snapshot of the Registry relational tables
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from . import utils
+
+__all__ = ['RegistrySnapshot']
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.navo_utils', 'registry.sqlite')
+
+# The RegTAP tables and columns needed to answer RegistryClass queries.
+# Only these columns are copied, so that the natural joins in the ADQL built by
+# RegistryClass._build_adql join on exactly the same columns as on the server.
+SNAPSHOT_TABLES = {
+    'capability': ['ivoid', 'cap_index', 'cap_type', 'standard_id'],
+    'resource': ['ivoid', 'short_name', 'res_title', 'res_description', 'reference_url', 'waveband', 'updated'],
+    'interface': ['ivoid', 'cap_index', 'intf_index', 'access_url'],
+    'res_role': ['ivoid', 'role_name', 'base_role'],
+}
+
+SNAPSHOT_INDEXES = [
+    'create index if not exists capability_ivoid on capability (ivoid, cap_index)',
+    'create index if not exists capability_cap_type on capability (cap_type)',
+    'create index if not exists resource_ivoid on resource (ivoid)',
+    'create index if not exists interface_ivoid on interface (ivoid, cap_index)',
+    'create index if not exists res_role_ivoid on res_role (ivoid, base_role)',
+]
+
+# Resources deleted from the Registry are only noticed by a full download.
+FULL_REFRESH_AGE = 30 * 24 * 3600
+
+# Upper limit on rows sent back by the Registry TAP service for one table.
+MAXREC = 10000000
+
+
+def _masked_column(name, values):
+    """
+    Returns the SQLite values of one result column as a MaskedColumn of the
+    dtype they would have been parsed to from a VOTABLE, with None masked.
+    """
+    from astropy.table import MaskedColumn
+
+    mask = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+    present = [v for v in values if v is not None]
+    if present and all(isinstance(v, int) for v in present):
+        data = np.array([0 if v is None else v for v in values], dtype=np.int64)
+    elif present and all(isinstance(v, (int, float)) for v in present):
+        data = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    else:
+        data = np.array(['' if v is None else str(v) for v in values], dtype=np.str_)
+    return MaskedColumn(data, name=name, mask=mask)
+
+
+class RegistrySnapshot:
+    """
+    A local SQLite copy of rr.capability, rr.resource, rr.interface and rr.res_role.
+
+    The tables are attached under the schema name rr, so the ADQL produced
+    by RegistryClass runs against the snapshot unchanged and gives the same
+    keyword, waveband, publisher and source matching as the remote service.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, tap_sync_url=None, timeout=300, retries=2):
+        if tap_sync_url is None:
+            from .registry import Registry
+            tap_sync_url = Registry._REGISTRY_TAP_SYNC_URL
+        self.path = path
+        self.tap_sync_url = tap_sync_url
+        self.timeout = timeout
+        self.retries = retries
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._attach()
+
+    def _attach(self):
+        self._conn.execute('attach database ? as rr', (self.path,))
+        self._create_tables(self._conn, 'rr')
+
+    @staticmethod
+    def _create_tables(conn, schema):
+        for table, columns in SNAPSHOT_TABLES.items():
+            conn.execute('create table if not exists {}.{} ({})'.format(schema, table, ', '.join(columns)))
+        for index in SNAPSHOT_INDEXES:
+            conn.execute(index.replace(' index if not exists ', ' index if not exists {}.'.format(schema), 1))
+        conn.execute('create table if not exists {}.snapshot_info (key primary key, value)'.format(schema))
+        conn.commit()
+
+    def _info(self, key):
+        row = self._conn.execute('select value from rr.snapshot_info where key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def is_empty(self):
+        """
+        Returns True if nothing has been downloaded into the snapshot yet.
+        """
+        return self._info('last_full') is None
+
+    def age(self):
+        """
+        Returns the number of seconds since the snapshot was last refreshed.
+        """
+        last = self._info('last_refresh')
+        return float('inf') if last is None else time.time() - float(last)
+
+    def refresh(self, max_age=24 * 3600, full=False, verbose=False):
+        """
+        Brings the snapshot up to date with the Registry.
+
+        Parameters
+        ----------
+        max_age : float
+            Do nothing if the snapshot was refreshed less than this many seconds ago.
+        full : bool
+            Download every table from scratch.  This also happens when the
+            snapshot is empty or its last full download is older than FULL_REFRESH_AGE.
+        verbose : bool
+            Print progress.
+        """
+        with self._lock:
+            last_full = self._info('last_full')
+            if full or last_full is None or time.time() - float(last_full) > FULL_REFRESH_AGE:
+                self._full_refresh(verbose)
+            elif self.age() > max_age:
+                self._incremental_refresh(verbose)
+
+    def _download(self, adql, verbose=False):
+        tap_params = {
+            "request": "doQuery",
+            "lang": "ADQL",
+            "query": adql,
+            "maxrec": MAXREC,
+        }
+        response = utils.try_query(self.tap_sync_url, post_data=tap_params, timeout=self.timeout,
+                                   retries=self.retries, stream=True, verbose=verbose, idempotent=True)
+        try:
+            for batch in utils.iter_votable_batches(response, batch_size=50000):
+                yield batch
+        finally:
+            response.close()
+
+    def _insert(self, conn, schema, table, adql, verbose=False):
+        columns = SNAPSHOT_TABLES[table]
+        insert = 'insert into {}.{} ({}) values ({})'.format(schema, table, ', '.join(columns),
+                                                               ', '.join('?' * len(columns)))
+        nrows = 0
+        for batch in self._download(adql, verbose):
+            values = []
+            for name in columns:
+                col = batch[name]
+                data = np.ma.getdata(col).tolist()
+                if np.ma.is_masked(col):
+                    for i in np.flatnonzero(np.ma.getmaskarray(col)):
+                        data[i] = None
+                values.append(data)
+            conn.executemany(insert, zip(*values))
+            nrows += len(batch)
+        if verbose:
+            print('    {} rows of rr.{}'.format(nrows, table))
+
+    def _full_refresh(self, verbose=False):
+        if verbose:
+            print('Registry snapshot: full download into {}'.format(self.path))
+        # Build the new snapshot beside the old one, then swap it into place.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(tmp_path)
+            try:
+                self._create_tables(conn, 'main')
+                for table, columns in SNAPSHOT_TABLES.items():
+                    adql = 'select {} from rr.{}'.format(', '.join(columns), table)
+                    self._insert(conn, 'main', table, adql, verbose=verbose)
+                now = repr(time.time())
+                conn.executemany('insert or replace into snapshot_info values (?, ?)',
+                                 [('last_full', now), ('last_refresh', now)])
+                conn.commit()
+            finally:
+                conn.close()
+            self._conn.execute('detach database rr')
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if not any(row[1] == 'rr' for row in self._conn.execute('pragma database_list')):
+                self._attach()
+
+    def _incremental_refresh(self, verbose=False):
+        since = self._conn.execute('select max(updated) from rr.resource').fetchone()[0]
+        if since is None:
+            self._full_refresh(verbose)
+            return
+        if verbose:
+            print('Registry snapshot: fetching resources updated after {}'.format(since))
+
+        changed = "r.updated > '{}'".format(since)
+        conn = self._conn
+        try:
+            # Replace every row belonging to a changed resource.
+            conn.execute('create temp table changed (ivoid primary key)')
+            for batch in self._download('select r.ivoid from rr.resource as r where {}'.format(changed), verbose):
+                conn.executemany('insert or ignore into temp.changed values (?)',
+                                 [(ivoid,) for ivoid in np.ma.getdata(batch['ivoid']).tolist()])
+            for table, columns in SNAPSHOT_TABLES.items():
+                conn.execute('delete from rr.{} where ivoid in (select ivoid from temp.changed)'.format(table))
+                adql = 'select {} from rr.{} as x join rr.resource as r on x.ivoid = r.ivoid where {}'.format(
+                    ', '.join('x.' + c for c in columns), table, changed)
+                self._insert(conn, 'rr', table, adql, verbose=verbose)
+            conn.execute('insert or replace into rr.snapshot_info values (?, ?)', ('last_refresh', repr(time.time())))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('drop table if exists temp.changed')
+
+    def query(self, adql):
+        """
+        Runs a query written for the Registry TAP service against the snapshot.
+
+        Parameters
+        ----------
+        adql : str
+            A query as built by RegistryClass._build_adql or _build_counts_adql.
+
+        Returns
+        -------
+        astropy.table.Table
+            The query result, with masked columns as parsed from the
+            Registry's VOTABLE: int64 for integers, float64 for reals and str
+            otherwise, with NULLs masked.
+        """
+        from astropy.table import Table
+
+        with self._lock:
+            cursor = self._conn.execute(adql)
+            rows = cursor.fetchall()
+            names = [d[0] for d in cursor.description]
+
+        values = list(zip(*rows)) if rows else [()] * len(names)
+        table = Table([_masked_column(name, column) for name, column in zip(names, values)])
+        table.meta['url'] = self.path
+        return table
+
+    def close(self):
+        self._conn.close()
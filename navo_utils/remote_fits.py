@@ -0,0 +1,456 @@
+"""
+Partial reads of remote FITS files with HTTP Range requests
+"""
+
+import collections
+import re
+import threading
+
+import numpy as np
+
+from . import utils
+
+__all__ = ['RemoteFits', 'open_remote', 'scale_image_data']
+
+FITS_BLOCK = 2880
+
+# Bytes fetched per cache block.  A multiple of the FITS block, large enough
+# that a header or a small image section usually takes one request.
+DEFAULT_BLOCK_SIZE = 64 * FITS_BLOCK
+
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024**2
+
+_CONTENT_RANGE = re.compile(r'\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$')
+
+_BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+_EMPTY_PRIMARY = (b''.join(card.ljust(80).encode('ascii') for card in
+                           ['SIMPLE  =                    T', 'BITPIX  =                    8',
+                            'NAXIS   =                    0', 'EXTEND  =                    T', 'END'])
+                  .ljust(FITS_BLOCK, b' '))
+
+
+class _HduInfo:
+    __slots__ = ('header_offset', 'data_offset', 'data_size', 'header')
+
+    def __init__(self, header_offset, data_offset, data_size, header):
+        self.header_offset = header_offset
+        self.data_offset = data_offset
+        self.data_size = data_size
+        self.header = header
+
+
+def _padded(nbytes):
+    return -(-nbytes // FITS_BLOCK) * FITS_BLOCK
+
+
+def _data_size(header):
+    """
+    Size in bytes of the data following a header, before padding (FITS standard 4.4.1.1).
+    """
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    n = 1
+    for i in range(1, naxis + 1):
+        n *= header.get('NAXIS{}'.format(i), 0)
+    # Random groups have NAXIS1 = 0.
+    if header.get('GROUPS', False) and header.get('NAXIS1', 0) == 0:
+        n = 1
+        for i in range(2, naxis + 1):
+            n *= header['NAXIS{}'.format(i)]
+    bits = abs(header['BITPIX'])
+    return bits // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + n)
+
+
+class RemoteFits:
+    """
+    A FITS file at a URL, read in pieces with HTTP Range requests.
+
+    Bytes are fetched in blocks of block_size and kept in an LRU block cache,
+    so headers, single HDUs and pixel sections of uncompressed images cost
+    only the bytes behind them.  If the server ignores Range requests, the
+    first response is the whole file, which is then kept and used for every
+    later read; so is the whole file fetched if a server answers a Range
+    request with other bytes than asked for.
+
+    Parameters
+    ----------
+    url : str
+        The file URL, e.g. an ImageColumn.ACCESS_URL value.
+    block_size : int
+        Bytes per cached block.
+    max_cache_bytes : int
+        Size cap of the block cache.
+    timeout : float
+        Seconds to wait for the server to respond.
+    retries : int
+        Total number of times to try each request.
+    policy : navo_utils.retry.RetryPolicy
+        Backoff, timeout and hedging settings for the requests.
+    """
+
+    def __init__(self, url, block_size=DEFAULT_BLOCK_SIZE, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                 timeout=60, retries=3, policy=None):
+        self.url = url
+        self.block_size = block_size
+        self.max_cache_bytes = max_cache_bytes
+        self.timeout = timeout
+        self.retries = retries
+        self.policy = policy
+        self.size = None
+        self.range_supported = None
+        self.bytes_fetched = 0
+        self.requests = 0
+        self._full = None
+        self._blocks = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._hdus = []
+        self._hdus_complete = False
+        self._lock = threading.RLock()
+
+    #
+    # Byte access
+    #
+
+    def _get(self, start=None, stop=None):
+        # Without start and stop, the whole file.
+        headers = {'Accept-Encoding': 'identity'}
+        if start is not None:
+            headers['Range'] = 'bytes={}-{}'.format(start, stop - 1)
+        response = utils.try_query(self.url, retries=self.retries, timeout=self.timeout, get_params={},
+                                   headers=headers, policy=self.policy)
+        self.requests += 1
+        self.bytes_fetched += len(response.content)
+        return response
+
+    def _fetch_blocks(self, first, last):
+        """
+        Fetches blocks first..last (inclusive) in one request into the cache.
+        """
+        bs = self.block_size
+        response = self._get(first * bs, (last + 1) * bs)
+        if response.status_code == 416:
+            # Entirely past the end of the file.
+            return
+        response.raise_for_status()
+
+        if response.status_code != 206:
+            # No Range support: keep the whole file.
+            return self._keep_full(response.content)
+
+        content = response.content
+        match = _CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+        size = int(match.group(3)) if match is not None and match.group(3) != '*' else None
+        start, stop = first * bs, (last + 1) * bs if size is None else min((last + 1) * bs, size)
+        if match is None or (int(match.group(1)), int(match.group(2)) + 1, len(content)) != (start, stop, stop - start):
+            # Not the bytes asked for, which would corrupt the cache: read
+            # the whole file instead.
+            response = self._get()
+            response.raise_for_status()
+            return self._keep_full(response.content)
+
+        self.range_supported = True
+        if size is not None:
+            self.size = size
+        for k in range(first, last + 1):
+            block = content[(k - first) * bs:(k - first + 1) * bs]
+            if not block:
+                break
+            self._blocks[k] = block
+            self._cached_bytes += len(block)
+
+    def _keep_full(self, content):
+        self.range_supported = False
+        self._full = content
+        self.size = len(content)
+        self._blocks.clear()
+        self._cached_bytes = 0
+
+    def read(self, offset, length):
+        """
+        Returns length bytes from offset, or fewer at the end of the file.
+        """
+        return self.read_ranges([(offset, offset + length)])[0]
+
+    def read_ranges(self, ranges):
+        """
+        Returns the bytes of several (start, stop) ranges, fetching each run
+        of missing blocks with one request.
+        """
+        with self._lock:
+            if self._full is None:
+                bs = self.block_size
+                needed = set()
+                for start, stop in ranges:
+                    if self.size is not None:
+                        stop = min(stop, self.size)
+                    if stop > start:
+                        needed.update(range(start // bs, (stop - 1) // bs + 1))
+                missing = sorted(k for k in needed if k not in self._blocks)
+                run_start = None
+                for i, k in enumerate(missing):
+                    if run_start is None:
+                        run_start = k
+                    if i + 1 == len(missing) or missing[i + 1] != k + 1:
+                        self._fetch_blocks(run_start, k)
+                        run_start = None
+                        if self._full is not None:
+                            break
+
+            if self._full is not None:
+                return [self._full[start:stop] for start, stop in ranges]
+            result = [self._from_blocks(start, stop) for start, stop in ranges]
+            # Evict only now, so that one large read can't drop its own blocks.
+            while self._cached_bytes > self.max_cache_bytes and len(self._blocks) > 1:
+                _, block = self._blocks.popitem(last=False)
+                self._cached_bytes -= len(block)
+            return result
+
+    def _from_blocks(self, start, stop):
+        bs = self.block_size
+        if self.size is not None:
+            stop = min(stop, self.size)
+        if stop <= start:
+            return b''
+        pieces = []
+        for k in range(start // bs, (stop - 1) // bs + 1):
+            block = self._blocks.get(k)
+            if block is None:
+                break
+            self._blocks.move_to_end(k)
+            pieces.append(block[max(start - k * bs, 0):stop - k * bs])
+        return b''.join(pieces)
+
+    #
+    # HDU structure
+    #
+
+    def _read_header(self, offset):
+        """
+        Reads the header starting at offset; returns (Header, data offset), or None at the end of the file.
+        """
+        from astropy.io import fits
+
+        cards = []
+        position = offset
+        while True:
+            chunk = self.read(position, FITS_BLOCK)
+            if len(chunk) < FITS_BLOCK:
+                return None
+            cards.append(chunk)
+            position += FITS_BLOCK
+            # END is the keyword of some 80-character card.
+            if any(chunk[i:i + 8] == b'END     ' for i in range(0, FITS_BLOCK, 80)):
+                break
+        header = fits.Header.fromstring(b''.join(cards).decode('ascii', errors='replace'))
+        return header, position
+
+    def _hdu_info(self, index):
+        with self._lock:
+            while len(self._hdus) <= index and not self._hdus_complete:
+                if self._hdus:
+                    last = self._hdus[-1]
+                    offset = last.data_offset + _padded(last.data_size)
+                else:
+                    offset = 0
+                if self.size is not None and offset >= self.size:
+                    self._hdus_complete = True
+                    break
+                result = self._read_header(offset)
+                if result is None:
+                    self._hdus_complete = True
+                    break
+                header, data_offset = result
+                self._hdus.append(_HduInfo(offset, data_offset, _data_size(header), header))
+            if index >= len(self._hdus):
+                raise IndexError('{} has no HDU {}'.format(self.url, index))
+            return self._hdus[index]
+
+    def index_of(self, ext):
+        """
+        Returns the HDU index for ext: an int, an EXTNAME, or an (EXTNAME, EXTVER) tuple.
+        """
+        if isinstance(ext, (int, np.integer)):
+            return int(ext)
+        name, ver = (ext, None) if isinstance(ext, str) else ext
+        i = 0
+        while True:
+            header = self._hdu_info(i).header
+            if (str(header.get('EXTNAME', '')).strip().upper() == name.upper()
+                    and (ver is None or header.get('EXTVER', 1) == ver)):
+                return i
+            i += 1
+
+    def __len__(self):
+        i = len(self._hdus)
+        while True:
+            try:
+                self._hdu_info(i)
+            except IndexError:
+                return len(self._hdus)
+            i += 1
+
+    def header(self, ext=0):
+        """
+        Returns the astropy Header of an HDU, reading only its header blocks.
+        """
+        return self._hdu_info(self.index_of(ext)).header.copy()
+
+    def wcs(self, ext=0):
+        """
+        Returns the astropy WCS of an HDU's header.
+        """
+        from astropy.wcs import WCS
+
+        return WCS(self.header(ext))
+
+    def read_hdu(self, ext=0):
+        """
+        Returns one HDU, reading only its header and data bytes.
+        """
+        from astropy.io import fits
+
+        info = self._hdu_info(self.index_of(ext))
+        raw = self.read(info.header_offset, info.data_offset - info.header_offset + _padded(info.data_size))
+        if info.header_offset == 0:
+            return fits.HDUList.fromstring(raw)[0]
+        # Behind an empty primary HDU, astropy picks the extension's class
+        # (ImageHDU, BinTableHDU, CompImageHDU, ...) as when opening the file.
+        return fits.HDUList.fromstring(_EMPTY_PRIMARY + raw)[1]
+
+    def open(self):
+        """
+        Returns the whole file as an astropy HDUList, reading every HDU.
+        """
+        from astropy.io import fits
+
+        return fits.HDUList([self.read_hdu(i) for i in range(len(self))])
+
+    #
+    # Pixel sections
+    #
+
+    def section(self, ext=0, slices=None):
+        """
+        Reads a section of an image HDU, fetching only the bytes behind it.
+
+        Parameters
+        ----------
+        ext : int, str or tuple
+            The HDU, as for index_of().
+        slices : tuple of int or slice
+            The section in numpy axis order (the last axis is NAXIS1), as for
+            astropy's ImageHDU.section.  Steps are allowed.
+
+        Returns
+        -------
+        numpy.ndarray
+            The section, scaled by BSCALE/BZERO like astropy.  Compressed
+            images and other HDU types are read whole and then sliced.
+        """
+        info = self._hdu_info(self.index_of(ext))
+        header = info.header
+        naxis = header.get('NAXIS', 0)
+        if slices is None:
+            slices = ()
+        if not isinstance(slices, tuple):
+            slices = (slices,)
+
+        if header.get('XTENSION', 'IMAGE').strip() != 'IMAGE' or header.get('ZIMAGE', False) or naxis == 0:
+            return self.read_hdu(ext).data[slices]
+
+        shape = tuple(header['NAXIS{}'.format(i)] for i in range(naxis, 0, -1))
+        slices = slices + (slice(None),) * (naxis - len(slices))
+        dtype = np.dtype(_BITPIX_DTYPES[header['BITPIX']])
+        itemsize = dtype.itemsize
+
+        indices = []
+        squeeze = []
+        for axis, (s, n) in enumerate(zip(slices, shape)):
+            if isinstance(s, slice):
+                indices.append(np.arange(n)[s])
+            else:
+                i = int(s)
+                indices.append(np.array([i + n if i < 0 else i]))
+                if not 0 <= indices[-1][0] < n:
+                    raise IndexError('index {} is out of bounds for axis {} with size {}'.format(s, axis, n))
+                squeeze.append(axis)
+        out_shape = tuple(len(i) for i in indices)
+        keep = tuple(0 if axis in squeeze else slice(None) for axis in range(naxis))
+        if 0 in out_shape:
+            return scale_image_data(np.zeros(out_shape, dtype=dtype), header)[keep]
+
+        # One contiguous run along NAXIS1 per combination of the other axes.
+        strides = np.cumprod((1,) + shape[:0:-1])[::-1]
+        row_start = np.zeros(out_shape[:-1], dtype=np.int64)
+        for axis in range(naxis - 1):
+            expand = [np.newaxis] * (naxis - 1)
+            expand[axis] = slice(None)
+            row_start = row_start + indices[axis][tuple(expand)] * strides[axis]
+        last = indices[-1]
+        lo, hi = int(last.min()), int(last.max()) + 1
+        starts = info.data_offset + (row_start.ravel() + lo) * itemsize
+        ranges = [(int(s), int(s) + (hi - lo) * itemsize) for s in starts]
+        chunks = self.read_ranges(ranges)
+
+        data = np.frombuffer(b''.join(chunks), dtype=dtype).reshape(out_shape[:-1] + (hi - lo,))
+        data = data[..., last - lo]
+        return scale_image_data(data, header)[keep]
+
+
+def scale_image_data(data, header):
+    """
+    Applies BSCALE and BZERO to raw image pixels, giving the dtype astropy
+    reads them as.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Pixels as stored, in the dtype of the header's BITPIX.
+    header : astropy.io.fits.Header
+        The image header.
+
+    Returns
+    -------
+    numpy.ndarray
+        The physical values in native byte order.  Unscaled pixels keep
+        their type; integers stored with the usual sign offsets become
+        unsigned (or int8, for BITPIX 8 with BZERO -128); other scaled
+        integers become float32 up to 16 bits and float64 beyond.
+    """
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return data.astype(data.dtype.newbyteorder('='))
+    bits = data.dtype.itemsize * 8
+    kind = data.dtype.kind
+    if kind in 'iu' and bscale == 1 and bzero == (2**(bits - 1) if kind == 'i' else -2**(bits - 1)):
+        # Unsigned integers (or, for BITPIX 8, signed bytes) stored with an
+        # offset, as astropy reads them: flip the sign bit.
+        flipped = np.dtype('{}{}'.format('u' if kind == 'i' else 'i', bits // 8))
+        sign_bit = np.array(2**(bits - 1), dtype='u{}'.format(bits // 8)).view(flipped)
+        return data.astype(data.dtype.newbyteorder('=')).view(flipped) ^ sign_bit
+    if kind == 'f':
+        ftype = data.dtype.newbyteorder('=')
+    else:
+        ftype = np.dtype(np.float32 if data.dtype.itemsize <= 2 else np.float64)
+    return data.astype(ftype) * ftype.type(bscale) + ftype.type(bzero)
+
+
+def open_remote(source, **kwargs):
+    """
+    Returns a RemoteFits for a URL, or for the ACCESS_URL of an ImageTable row.
+
+    Parameters
+    ----------
+    source : str or ImRow
+        The file URL or a row of an Image.query() result.
+    **kwargs
+        Passed to RemoteFits.
+    """
+    if not isinstance(source, str):
+        from .image import ImageColumn
+
+        source = utils.sval(source[ImageColumn.ACCESS_URL])
+    return RemoteFits(source, **kwargs)
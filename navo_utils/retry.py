@@ -0,0 +1,446 @@
+"""
+Retries with backoff, adaptive timeouts, circuit breaking and hedged requests
+"""
+
+import collections
+import concurrent.futures
+import random
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from . import metrics
+
+__all__ = ['RetryPolicy', 'CircuitOpenError', 'host_stats', 'reset_host_stats', 'send']
+
+# HTTP statuses worth retrying: rate limiting and transient gateway/server trouble.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Latencies kept per host, and per endpoint (path) of the host, for the
+# adaptive timeout and hedge delay; the endpoints least recently answered
+# are forgotten beyond MAX_ENDPOINTS per host.
+LATENCY_WINDOW = 200
+MAX_ENDPOINTS = 256
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised without contacting a host whose circuit breaker is open because
+    its recent requests kept failing.
+    """
+
+
+class RetryPolicy:
+    """
+    How try_query retries, times out and hedges requests.
+
+    Each query class holds one in its _RETRY_POLICY attribute, so services can
+    be tuned separately, e.g. Cone._RETRY_POLICY = RetryPolicy(hedge_after='auto').
+    The number of tries and the timeout ceiling stay the try_query arguments
+    (the classes' _RETRIES and _TIMEOUT).
+
+    Parameters
+    ----------
+    backoff_base : float
+        Seconds of the first backoff; doubled on each further retry.
+    backoff_max : float
+        Largest backoff in seconds.  Each sleep is drawn uniformly from
+        zero to the backoff ("full jitter"), so that many clients retrying
+        together spread out.
+    adaptive_timeout : bool
+        Once an endpoint (host and path) has min_samples latencies, time
+        requests to it out after timeout_multiplier times its
+        timeout_percentile latency (within min_timeout and the timeout
+        argument), doubling on each retry.  Off by default: queries to one
+        endpoint, such as TAP /sync, can take far longer than the ones before.
+    timeout_percentile, timeout_multiplier, min_timeout, min_samples
+        See adaptive_timeout.
+    breaker_threshold : int
+        Consecutive failures (connection errors, timeouts, other request
+        errors such as broken chunked bodies, 5xx) after which a
+        host's circuit opens and requests to it fail fast with CircuitOpenError.
+        None disables the breaker.
+    breaker_reset : float
+        Seconds the circuit stays open before one trial request is let through.
+    hedge_after : float or 'auto' or None
+        If set, a GET not answered after this many seconds is sent again on a
+        second connection, and the first answer wins.  'auto' waits for the
+        endpoint's hedge_percentile latency.  None disables hedging.
+    hedge_percentile : float
+        See hedge_after.
+    retry_statuses : tuple of int
+        HTTP statuses that are retried like timeouts.
+    """
+
+    def __init__(self, backoff_base=0.5, backoff_max=30., adaptive_timeout=False, timeout_percentile=99.,
+                 timeout_multiplier=4., min_timeout=5., min_samples=20, breaker_threshold=5, breaker_reset=30.,
+                 hedge_after=None, hedge_percentile=95., retry_statuses=RETRY_STATUSES):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.adaptive_timeout = adaptive_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        self.retry_statuses = tuple(retry_statuses)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Returns the seconds to sleep before retry number attempt (1 for the first retry).
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def timeout_for(self, state, timeout, attempt, path=None):
+        """
+        Returns the timeout for try number attempt (0 for the first) to an endpoint of a host.
+        """
+        if not self.adaptive_timeout or timeout is None:
+            return timeout
+        p = state.latency_percentile(self.timeout_percentile, self.min_samples, path)
+        if p is None:
+            return timeout
+        adaptive = max(self.min_timeout, self.timeout_multiplier * p) * 2 ** attempt
+        return min(adaptive, timeout)
+
+    def hedge_delay(self, state, path=None):
+        """
+        Returns the seconds to wait before hedging a request to an endpoint of a host, or None not to hedge.
+        """
+        if self.hedge_after is None:
+            return None
+        if self.hedge_after == 'auto':
+            return state.latency_percentile(self.hedge_percentile, self.min_samples, path)
+        return float(self.hedge_after)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class _HostState:
+    """
+    Latencies and circuit breaker state of one host.
+    """
+
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.endpoint_latencies = collections.OrderedDict()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def latency_percentile(self, percentile, min_samples=1, path=None):
+        """
+        Returns a percentile of the host's latencies, or of one endpoint's if path is given.
+        """
+        with self.lock:
+            latencies = self.latencies if path is None else self.endpoint_latencies.get(path, ())
+            if len(latencies) < max(min_samples, 1):
+                return None
+            return float(np.percentile(latencies, percentile))
+
+    def check(self, policy):
+        """
+        Raises CircuitOpenError if the circuit is open; lets one trial through after breaker_reset.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < policy.breaker_reset or self.trial_in_flight:
+                raise CircuitOpenError('circuit open after {} consecutive failures'.format(self.failures))
+            self.trial_in_flight = True
+
+    def success(self, latency, path=None):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if path is not None:
+                latencies = self.endpoint_latencies.pop(path, None)
+                if latencies is None:
+                    latencies = collections.deque(maxlen=LATENCY_WINDOW)
+                    if len(self.endpoint_latencies) >= MAX_ENDPOINTS:
+                        self.endpoint_latencies.popitem(last=False)
+                latencies.append(latency)
+                self.endpoint_latencies[path] = latencies
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def failure(self, policy):
+        with self.lock:
+            self.requests += 1
+            self.errors += 1
+            self.failures += 1
+            self.trial_in_flight = False
+            if policy.breaker_threshold is not None and self.failures >= policy.breaker_threshold:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Ends a trial that neither succeeded nor failed, so the next request can be the trial.
+        """
+        with self.lock:
+            self.trial_in_flight = False
+
+
+_host_states = {}
+_host_states_lock = threading.Lock()
+
+
+def _host(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+def _host_state(url):
+    host = _host(url)
+    with _host_states_lock:
+        state = _host_states.get(host)
+        if state is None:
+            state = _host_states[host] = _HostState()
+        return state
+
+
+def host_stats(url=None):
+    """
+    Returns request statistics and circuit state per host.
+
+    Parameters
+    ----------
+    url : str
+        If given, only the host of this URL.
+
+    Returns
+    -------
+    dict
+        {host: {'requests', 'errors', 'hedges', 'p50', 'p95', 'circuit'}}, with
+        latency percentiles in seconds and circuit 'closed' or 'open'.
+    """
+    with _host_states_lock:
+        items = list(_host_states.items())
+    if url is not None:
+        items = [(host, state) for host, state in items if host == _host(url)]
+    stats = {}
+    for host, state in items:
+        stats[host] = {
+            'requests': state.requests,
+            'errors': state.errors,
+            'hedges': state.hedges,
+            'p50': state.latency_percentile(50),
+            'p95': state.latency_percentile(95),
+            'circuit': 'closed' if state.opened_at is None else 'open',
+        }
+    return stats
+
+
+def reset_host_stats():
+    """
+    Forgets all latencies and closes every circuit.
+    """
+    with _host_states_lock:
+        _host_states.clear()
+
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=32,
+                                                                    thread_name_prefix='navo_utils-hedge')
+        return _hedge_executor
+
+
+def _discard(future):
+    # Close the losing response of a hedged pair so its connection goes back to the pool.
+    try:
+        future.result().close()
+    except Exception:
+        pass
+
+
+def _timed_request(session, method, url, timeout, kwargs):
+    # Returns the response, the seconds taken and the seconds of those spent connecting.
+    connect_start = metrics.connect_time()
+    start = time.monotonic()
+    response = session.request(method, url, timeout=timeout, **kwargs)
+    return response, time.monotonic() - start, metrics.connect_time() - connect_start
+
+
+def _hedged_request(session, method, url, timeout, delay, state, record, kwargs):
+    """
+    Sends a request, and a duplicate if the first is unanswered after delay
+    seconds; returns the result of _timed_request for the first success.
+    """
+    executor = _get_hedge_executor()
+    first = executor.submit(_timed_request, session, method, url, timeout, kwargs)
+    done, _ = concurrent.futures.wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    with state.lock:
+        state.hedges += 1
+    if record is not None:
+        record['hedged'] = True
+    second = executor.submit(_timed_request, session, method, url, timeout, kwargs)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            for other in pending:
+                other.add_done_callback(_discard)
+            return result
+    raise error
+
+
+def send(session, method, url, retries=3, timeout=60, policy=None, verbose=False, idempotent=None, **kwargs):
+    """
+    Sends a request on a requests session following a RetryPolicy.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session to send on.
+    method : str
+        'GET' or 'POST'.  Only GET requests are hedged.
+    url : str
+        The URL.
+    retries : int
+        Total number of times to try.
+    timeout : float
+        Timeout in seconds, and the ceiling of the adaptive timeout.
+    policy : RetryPolicy
+        Defaults to DEFAULT_POLICY.
+    verbose : bool
+        Print a warning before each retry.
+    idempotent : bool
+        Whether sending the request twice does no harm (default: for any
+        method but POST).  Other requests are retried after a timeout or a
+        lost connection only if they never reached the server, i.e. the
+        connection could not be made, so that e.g. a UWS job submitted just
+        before a read timeout is not created twice.  Retried statuses are
+        retried either way.
+    **kwargs
+        Passed to session.request().
+
+    Returns
+    -------
+    requests.Response
+        The response.  Responses with a retried status are returned as they
+        are once the tries run out.
+
+    Raises
+    ------
+    CircuitOpenError
+        If the host's circuit is open.
+    requests.exceptions.RequestException
+        The error of the last try, if every try failed.
+    """
+    if policy is None:
+        policy = DEFAULT_POLICY
+
+    if idempotent is None:
+        idempotent = method.upper() != 'POST'
+
+    # Inside a metrics span the attempts add to its record; otherwise they get their own.
+    record = metrics.current()
+    if record is not None or not metrics.active():
+        return _send(session, method, url, retries, timeout, policy, verbose, idempotent, record, kwargs)
+    with metrics.span('request', url, method) as record:
+        return _send(session, method, url, retries, timeout, policy, verbose, idempotent, record, kwargs)
+
+
+def _not_sent(error):
+    """
+    Returns whether a request error happened while connecting, before any of the request was sent.
+    """
+    from requests.exceptions import ConnectTimeout
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+
+
+def _send(session, method, url, retries, timeout, policy, verbose, idempotent, record, kwargs):
+    from requests.exceptions import ConnectionError as RequestsConnectionError, RequestException, Timeout
+
+    state = _host_state(url)
+    path = urllib.parse.urlsplit(url).path
+    retries = max(int(retries), 1)
+    if record is not None:
+        record['method'] = method
+
+    for attempt in range(retries):
+        if record is not None:
+            record['retries'] = attempt
+        state.check(policy)
+        attempt_timeout = policy.timeout_for(state, timeout, attempt, path)
+        delay = policy.hedge_delay(state, path) if method.upper() == 'GET' else None
+        try:
+            if delay is not None and delay < (attempt_timeout or float('inf')):
+                response, latency, connect = _hedged_request(session, method, url, attempt_timeout, delay, state,
+                                                             record, kwargs)
+            else:
+                response, latency, connect = _timed_request(session, method, url, attempt_timeout, kwargs)
+        except (Timeout, RequestsConnectionError) as e:
+            state.failure(policy)
+            if attempt == retries - 1 or not (idempotent or _not_sent(e)):
+                raise
+            wait = policy.backoff(attempt + 1)
+            if verbose:
+                print('WARNING: {} from {}; retrying in {:.1f} s.'.format(type(e).__name__, _host(url), wait))
+            time.sleep(wait)
+            continue
+        except RequestException:
+            # Not retried (e.g. a broken chunked body or too many redirects),
+            # but a failure all the same, which also ends a half-open trial.
+            state.failure(policy)
+            raise
+        except BaseException:
+            # Whatever else stopped the request, a half-open trial must not
+            # stay in flight, or the circuit would never close again.
+            state.release()
+            raise
+
+        if response.status_code >= 500:
+            state.failure(policy)
+        else:
+            state.success(response.elapsed.total_seconds() if response.elapsed else latency, path)
+        if record is not None:
+            metrics.note_response(record, response, latency, connect, kwargs.get('stream', False))
+
+        if response.status_code not in policy.retry_statuses or attempt == retries - 1:
+            return response
+
+        retry_after = response.headers.get('Retry-After')
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        wait = policy.backoff(attempt + 1, retry_after)
+        if verbose:
+            print('WARNING: HTTP {} from {}; retrying in {:.1f} s.'.format(response.status_code, _host(url), wait))
+        response.close()
+        time.sleep(wait)
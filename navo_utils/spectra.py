@@ -1,10 +1,8 @@
-from astroquery.query import BaseQuery
-from astroquery.utils import parse_coordinates
-from astropy.coordinates import SkyCoord
-from astropy.table import Table, Row
 from enum import Enum
 
 from . import utils
+from .query import BaseQuery
+from .retry import RetryPolicy
 
 __all__ = ['Spectra', 'SpectraClass']
 
@@ -13,37 +11,69 @@ class SpectraClass(BaseQuery):
         super(SpectraClass, self).__init__()
         self._TIMEOUT = 60 # seconds to timeout
         self._RETRIES = 3 # total number of times to try
+        self._RETRY_POLICY = RetryPolicy() # backoff, adaptive timeouts, circuit breaker, hedging
 
 
-    def query(self, service, coords, radius='0.000001', image_format=None, verbose=False):
+    def query(self, service, coords, radius='0.000001', image_format=None, verbose=False, max_workers=None, executor=None,
+              merge=False):
         """Basic spectra search query function
 
-        Input coords should be either a single string, a single
-        SkyCoord object, or a list. It will then loop over the objects
-        in the list, assuming each is a single source. Within the
-        _one_image_search function, it then expects likewise a single
-        string, a single SkyCoord object, or list of 2 as an RA,DEC
-        pair.
+        Input coords should be either a single string, a SkyCoord
+        object (scalar or array), an (ra, dec) tuple in degrees (of
+        scalars or arrays), an (N,2) numpy array of RA,DEC in degrees,
+        an astropy Table with ra/dec columns, or a list of strings,
+        SkyCoords or RA,DEC pairs. All positions are converted to
+        RA,DEC in one vectorized pass and then searched one by one.
+        Input radius is a single value or one per position, in degrees
+        unless given as a Quantity.
 
         Input service can be a string URL, an astropy Table returned
         from Registry.query() (or selected from it), or a single row
         of an astropy Table. If none is given, the kwargs will be
         passed to a Registry.query() call.
 
+        max_workers = if given, run the per-position queries concurrently
+                    in a thread pool of this many workers (default = serial)
+        executor = a concurrent.futures.Executor to run the queries on
+                    instead; takes precedence over max_workers
+        merge = if True, return one table holding the rows of every
+                    position, with input_index, input_ra and input_dec
+                    columns, instead of a list of tables (see
+                    utils.merge_results; utils.group_view and
+                    utils.position_rows give back each position's rows)
+
+        """
+        if merge:
+            coords = utils.parse_coordinates_array(coords)
+        results = [spectra_table for j, spectra_table in self.iter_query(service, coords, radius,
+                                                                         image_format=image_format, verbose=verbose,
+                                                                         max_workers=max_workers, executor=executor,
+                                                                         ordered=True)]
+        if merge:
+            from .spectra_table import SpectraTable
+            return utils.merge_results(results, *coords, table_class=SpectraTable)
+        return results
+
+    def iter_query(self, service, coords, radius='0.000001', image_format=None, verbose=False, max_workers=None,
+                   executor=None, ordered=False):
+        """Spectra search that yields each position's result as it arrives
+
+        Arguments are as for query().  Returns a generator of (index,
+        SpectraTable) pairs, index being the position's index in coords, so
+        that e.g. downloads of the first results can start while later ones
+        are still being fetched.
+
+        ordered = if True, yield the results in the order of coords;
+                    otherwise in the order they complete
+
         """
 
         if type(service) is str:
             service = {"access_url":service}
 
-        if type(coords) is str or isinstance(coords, SkyCoord):
-            coords = [coords]
-        assert type(coords) is list, "ERROR: Give a coordinate object that is a single string, a list/tuple (ra,dec), a SkyCoord, or a list of any of the above."
-#        Tracer()()
-        if type(radius) is not list:
-            inradius = [radius]*len(coords)
-        else:
-            inradius = radius
-            assert len(inradius) == len(coords), 'Please give either single radius or list of radii of same length as coords.'
+        # Parse all positions and radii in one vectorized pass.
+        ra, dec = utils.parse_coordinates_array(coords)
+        inradius = utils.parse_radius_array(radius, len(ra))
         # Passing along proper image format parameters:
         if image_format is not None:
             if "fits" in image_format.lower():
@@ -62,43 +92,37 @@ class SpectraClass(BaseQuery):
                 raise Exception("ERROR: please give a image_format that is one of FITS, JPEG, PNG, ALL, or GRAPHICS")
 
         # Expand the input parameters to a list of input parameter dictionaries for the call to query_loop.
-        params = [{'coords':c, 'radius':inradius[i], 'image_format':image_format} for i, c in enumerate(coords)]
+        params = [{'coords':c, 'radius':r, 'image_format':image_format, 'verbose':verbose}
+                  for c, r in zip(zip(ra.tolist(), dec.tolist()), inradius.tolist())]
 
-        result_list = utils.query_loop(self._one_image_search, service=service, params=params, verbose=verbose)
-        spectra_result_list = []
-        for result in result_list:
-            spectra_table = SpectraTable(result, copy=False)
-            spectra_result_list.append(spectra_table)
+        from .spectra_table import SpectraTable
 
-        return spectra_result_list
+        results = utils.iter_query_loop(self._one_image_search, service=service, params=params, verbose=verbose,
+                                        max_workers=max_workers, executor=executor, ordered=ordered)
+        return ((j, SpectraTable(result, copy=False)) for j, result in results)
 
-    def _one_image_search(self, coords, radius, service, image_format=None):
-        if (type(coords) is tuple or type(coords) is list) and len(coords) == 2:
-            coords = parse_coordinates("{} {}".format(coords[0], coords[1]))
-        elif type(coords) is str:
-            coords = parse_coordinates(coords)
-        else:
-            assert isinstance(coords, SkyCoord), "ERROR: cannot parse input coordinates {}".format(coords)
+    def _one_image_search(self, coords, radius, service, image_format=None, verbose=False):
+        ra, dec = utils.parse_coordinates_array(coords)
 
         params = {
-            'POS': utils.sval(coords.ra.deg) + ',' + utils.sval(coords.dec.deg),
+            'POS': utils.sval(ra[0]) + ',' + utils.sval(dec[0]),
             'SIZE': utils.sval(2.*float(radius)),   #Note: size in SIA is diameter, not radius!
             }
         if image_format is not None:
             params['FORMAT'] = image_format
 
-        response = utils.try_query(service, get_params=params, timeout=self._TIMEOUT, retries=self._RETRIES)
-        #Tracer()()
-        return utils.astropy_table_from_votable_response(response)
+        return utils.query_votable(service, 'spectra', get_params=params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=verbose)
 
     def get_column(self, table, mnemonic):
+        from astropy.table import Table
         col = None
         if not isinstance(mnemonic, SpectraColumn):
             raise ValueError('mnemonic must be an enumeration member of SpectraColumn.')
         elif not isinstance(table, Table):
             raise ValueError('table must be an instance of astropy.Table.')
         else:
-            col = utils.find_column_by_utype(table, mnemonic.value)
+            col = utils.find_column_by_utype(table, mnemonic.value['utype'])
         return col
 
     def get_column_name(self, table, mnemonic):
@@ -144,87 +168,9 @@ class SpectraColumn(Enum):
     # WCS (also "should have")
 
 
-#
-# Custom subclass of astropy Table.
-#
-
-class SpRow(Row):
-    """
-    This Row allows column access by SpectraColumn utype values.
-    """
-    def __getitem__(self, item):
-        if isinstance(item, SpectraColumn):
-            colname = self.table.stdcol_to_colname(item)
-            val = None
-            if colname is not None:
-                val = super().__getitem__(colname)
-            return val
-        else:
-            return super().__getitem__(item)
-
-
-class SpectraTable(Table):
-    """
-    Custom subclass of astropy.table.Table
-    """
-
-    Row = SpRow
-
-    __utypemap__ = None
-
-
-    def __compute_utype_column__(self, mnemonic):
-        col = None
-        if not isinstance(mnemonic, SpectraColumn):
-            raise ValueError('mnemonic must be an enumeration member of SpectraColumn.')
-        else:
-            col = utils.find_column_by_utype(self, mnemonic.value['utype'])
-        return col
-
-    def __compute_utype_column_name__(self, mnemonic):
-        name = None
-        col = self.__compute_utype_column__(mnemonic)
-        if col is not None:
-            name = col.name
-        return name
-
-    def get_utypemap(self):
-        if not self.__utypemap__:
-            self.__utypemap__ = {}
-            for utype in SpectraColumn:
-                colname = self.__compute_utype_column_name__(utype)
-                self.__utypemap__[utype.name] = colname
-
-        return self.__utypemap__
-
-    def __getitem__(self, item):
-        if isinstance(item, SpectraColumn):
-            colname = self.stdcol_to_colname(item)
-            if colname is None:
-                return None
-            else:
-                return super().__getitem__(colname)
-        else:
-            return super().__getitem__(item)
-
-    def stdcol_to_colname(self, mnemonic):
-        if not isinstance(mnemonic, SpectraColumn):
-            raise ValueError('mnemonic must be an enumeration member of SpectraColumn.')
-        else:
-            utypemap = self.get_utypemap()
-            name = utypemap.get(mnemonic.name)
-        return name
-
-    def colname_to_stdcol(self, colname):
-        imgcol = None
-        if colname not in self.colnames:
-            raise ValueError(f'colname {colname} is not the name of a column in this table.')
-        else:
-            utypemap = self.get_utypemap()
-            for img, col in utypemap.items():
-                if colname == col:
-                    for e in SpectraColumn:
-                        if e.name == img:
-                            imgcol = e
-
-        return imgcol
+def __getattr__(name):
+    # The Table subclasses load astropy.table, so they are only imported when first used.
+    if name in ('SpectraTable', 'SpRow'):
+        from . import spectra_table
+        return getattr(spectra_table, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
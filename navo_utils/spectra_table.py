@@ -0,0 +1,71 @@
+"""
+Table of VO spectra query results
+"""
+from astropy.table import Table, Row
+
+from . import utils
+from .spectra import SpectraColumn
+
+__all__ = ['SpectraTable', 'SpRow']
+
+
+#
+# Custom subclass of astropy Table.
+#
+
+class SpRow(Row):
+    """
+    This Row allows column access by SpectraColumn utype values.
+    """
+    def __getitem__(self, item):
+        if isinstance(item, SpectraColumn):
+            colname = self.table.stdcol_to_colname(item)
+            val = None
+            if colname is not None:
+                val = super().__getitem__(colname)
+            return val
+        else:
+            return super().__getitem__(item)
+
+
+class SpectraTable(Table):
+    """
+    Custom subclass of astropy.table.Table
+    """
+
+    Row = SpRow
+
+    def _stdcol_maps(self):
+        # Taken from the process-wide index for this schema, and looked up
+        # again when columns have been added, removed or renamed.
+        colnames = tuple(self.colnames)
+        cached = getattr(self, '_stdcol_maps_cache', None)
+        if cached is None or cached[0] != colnames:
+            cached = self._stdcol_maps_cache = (colnames, utils.stdcol_maps(self, SpectraColumn, 'utype'))
+        return cached[1]
+
+    def get_utypemap(self):
+        return self._stdcol_maps()[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, SpectraColumn):
+            colname = self.stdcol_to_colname(item)
+            if colname is None:
+                return None
+            else:
+                return super().__getitem__(colname)
+        else:
+            return super().__getitem__(item)
+
+    def stdcol_to_colname(self, mnemonic):
+        if not isinstance(mnemonic, SpectraColumn):
+            raise ValueError('mnemonic must be an enumeration member of SpectraColumn.')
+        else:
+            utypemap = self.get_utypemap()
+            name = utypemap.get(mnemonic.name)
+        return name
+
+    def colname_to_stdcol(self, colname):
+        if colname not in self.colnames:
+            raise ValueError(f'colname {colname} is not the name of a column in this table.')
+        return self._stdcol_maps()[1].get(colname)
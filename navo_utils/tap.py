@@ -4,12 +4,16 @@ VO Queries
 """
 
 from __future__ import print_function, division
-#from IPython.core.debugger import Tracer
-from astroquery.query import BaseQuery
+import concurrent.futures
+import io
+import threading
+import time
 import numpy
-from . import utils
+from . import metrics, utils
+from .query import BaseQuery
+from .retry import RetryPolicy
 
-__all__ = ['Tap', 'TapClass']
+__all__ = ['Tap', 'TapClass', 'AsyncJob']
 
 class TapClass(BaseQuery):
     """
@@ -22,14 +26,175 @@ class TapClass(BaseQuery):
         super(TapClass, self).__init__()
         self._TIMEOUT = 60 # seconds
         self._RETRIES = 2 # total number of times to try
+        self._RETRY_POLICY = RetryPolicy() # backoff, adaptive timeouts, circuit breaker, hedging
 
-    def query(self, service, query, upload_file=None,upload_name=None):
+    def query(self, service, query, upload_file=None, upload_name=None, stream=False, batch_size=10000, as_table=True,
+              verbose=False):
+        """Basic synchronous TAP query function
+
+        Input service can be a string URL or a single row of an astropy
+        Table with an access_url.
+
+        upload_file = a VOTABLE to upload, given as a file name, an open
+                 binary file, bytes, or an astropy Table; refer to it in
+                 the query as TAP_UPLOAD.<upload_name>.
+        stream = if True, return a generator that reads the (TABLEDATA)
+                 VOTABLE result incrementally and yields batches of at most
+                 batch_size rows, as astropy Tables or, with as_table=False,
+                 numpy record arrays.  Peak memory then depends on
+                 batch_size rather than on the size of the result.
+        verbose = if True, print a warning before each retry of the request
+        """
 
         if type(service) is str:
             service = {"access_url":service}
 
         url = service['access_url'] + '/sync?'
 
+        tap_params, files = self._tap_params(query, upload_file, upload_name)
+        if tap_params is None:
+            return None
+
+        if stream:
+            return self._stream_batches(url, tap_params, files, batch_size, as_table, verbose)
+
+        with metrics.span('tap', url):
+            response = utils.try_query(url, post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                       files=files, policy=self._RETRY_POLICY, verbose=verbose, idempotent=True)
+
+            aptable = utils.astropy_table_from_votable_response(response)
+        return aptable
+
+    def submit_job(self, service, query, upload_file=None, upload_name=None, run=True, verbose=False):
+        """Submit an asynchronous (UWS) TAP job
+
+        The query is sent to the service's /async endpoint, where it keeps
+        running on the server independently of this client.  Returns an
+        AsyncJob; save job.url to pick the job up again later with
+        resume_job().  With verbose=True, the job's requests print a warning
+        before each retry.
+        """
+        if type(service) is str:
+            service = {"access_url":service}
+
+        url = service['access_url'] + '/async'
+
+        tap_params, files = self._tap_params(query, upload_file, upload_name)
+        if tap_params is None:
+            return None
+
+        response = utils.try_query(url, post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES, files=files,
+                                   policy=self._RETRY_POLICY, verbose=verbose)
+        response.raise_for_status()
+
+        # The service redirects to the new job, so the final URL is the job URL.
+        job = AsyncJob(response.url, timeout=self._TIMEOUT, retries=self._RETRIES, policy=self._RETRY_POLICY,
+                       verbose=verbose)
+        if run:
+            job.run()
+        return job
+
+    def resume_job(self, job_url, verbose=False):
+        """Return an AsyncJob for a job submitted earlier, given its saved URL
+        """
+        return AsyncJob(job_url, timeout=self._TIMEOUT, retries=self._RETRIES, policy=self._RETRY_POLICY,
+                        verbose=verbose)
+
+    def query_many(self, service, queries, max_workers=8, poll_interval=1., max_poll_interval=30., verbose=False,
+                   job_timeout=3600.):
+        """Run many ADQL queries as concurrent asynchronous jobs
+
+        All jobs are submitted first, so they are in flight on the server at
+        the same time, then waited for and downloaded by up to max_workers
+        threads.  Returns a list of astropy Tables in the order of queries.
+        A query that failed gives an empty table with the error in
+        meta['error'].  A job still running after job_timeout seconds of
+        waiting is aborted and counted as failed.
+        """
+        return [result for j, result in self.iter_query_many(service, queries, max_workers=max_workers,
+                                                             poll_interval=poll_interval,
+                                                             max_poll_interval=max_poll_interval, verbose=verbose,
+                                                             job_timeout=job_timeout, ordered=True)]
+
+    def iter_query_many(self, service, queries, max_workers=8, poll_interval=1., max_poll_interval=30., verbose=False,
+                        job_timeout=3600., ordered=False):
+        """Run many ADQL queries as concurrent asynchronous jobs, yielding each result as it arrives
+
+        Arguments are as for query_many().  Returns a generator of (index,
+        table) pairs, index being the query's index in queries, in the order
+        the jobs finish or, with ordered=True, in the order of queries.
+        Closing the generator early stops waiting at once and aborts the
+        jobs whose results were not fetched yet.
+        """
+        if type(service) is str:
+            service = {"access_url":service}
+
+        def failed(j, e):
+            from astropy.table import Table
+            print("ERROR: query[{}] failed: {}".format(j, e))
+            result = Table()
+            result.meta['error'] = repr(e)
+            return result
+
+        def submit_one(j, query):
+            try:
+                job = self.submit_job(service, query, verbose=verbose)
+            except Exception as e:
+                return failed(j, e)
+            if verbose:
+                print("    Submitted query[{}] as {}".format(j, job.url))
+            return job
+
+        closing = threading.Event()
+
+        def finish_one(j, job):
+            if not isinstance(job, AsyncJob):
+                return job   # Submission already failed.
+            try:
+                phase = job.wait(poll_interval=poll_interval, max_poll_interval=max_poll_interval,
+                                 timeout=job_timeout, stop=closing)
+                if closing.is_set():
+                    return None   # Nobody is waiting for the result any more.
+                if phase not in job.FINAL_PHASES:
+                    job.abort()
+                    raise RuntimeError('job {} did not finish within {} s'.format(job.url, job_timeout))
+                if phase != 'COMPLETED':
+                    raise RuntimeError('job {} ended in phase {}: {}'.format(job.url, phase, job.error()))
+                result = job.result()
+            except Exception as e:
+                return failed(j, e)
+            if verbose:
+                print("    Got {} results for query[{}]".format(len(result), j))
+            return result
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        jobs = []
+        futures = []
+        try:
+            jobs = list(executor.map(submit_one, range(len(queries)), queries))
+            futures = [executor.submit(finish_one, j, job) for j, job in enumerate(jobs)]
+            if ordered:
+                for j, future in enumerate(futures):
+                    yield j, future.result()
+            else:
+                index = {future: j for j, future in enumerate(futures)}
+                for future in concurrent.futures.as_completed(futures):
+                    yield index[future], future.result()
+        finally:
+            # Don't block on the jobs still being waited for: stop the waits,
+            # drop the queued ones, and abort the jobs on the server.
+            outstanding = [job for job, future in zip(jobs, futures)
+                           if isinstance(job, AsyncJob) and not future.done()]
+            closing.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            for job in outstanding:
+                try:
+                    job.abort()
+                except Exception as e:
+                    if verbose:
+                        print("    Could not abort {}: {}".format(job.url, e))
+
+    def _tap_params(self, query, upload_file=None, upload_name=None):
         tap_params = {
             "request": "doQuery",
             "lang": "ADQL",
@@ -39,17 +204,143 @@ class TapClass(BaseQuery):
         if upload_file is not None:
             if upload_name is None:
                 print("ERROR: you have to give a name to use in the query for the uploaded table.")
-                return None
-            ## Why does neither of these work?
-            files={'uplt':open(upload_file,'rb')}
-            #files={'uplt':upload_file}
+                return None, None
+            # Read the upload into memory so that it can be resent on a retry.
+            files={'uplt':('upload.xml', _upload_content(upload_file), 'application/x-votable+xml')}
             tap_params['upload'] = upload_name+',param:uplt'
         else:
             files=None
 
-        response = utils.try_query(url, post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES,files=files)
+        return tap_params, files
 
-        aptable = utils.astropy_table_from_votable_response(response)
-        return aptable
+    def _stream_batches(self, url, tap_params, files, batch_size, as_table, verbose=False):
+        response = utils.try_query(url, post_data=tap_params, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   files=files, stream=True, policy=self._RETRY_POLICY, verbose=verbose,
+                                   idempotent=True)
+        try:
+            for batch in utils.iter_votable_batches(response, batch_size=batch_size, as_table=as_table):
+                yield batch
+        finally:
+            response.close()
 
 Tap = TapClass()
+
+
+def _upload_content(upload_file):
+    """
+    Returns the VOTABLE bytes to upload for upload_file, which may be a file
+    name, an open binary file, the bytes themselves or an astropy Table.
+    """
+    from astropy.table import Table
+
+    if isinstance(upload_file, Table):
+        buffer = io.BytesIO()
+        upload_file.write(buffer, format='votable')
+        return buffer.getvalue()
+    if isinstance(upload_file, (bytes, bytearray)):
+        return bytes(upload_file)
+    if hasattr(upload_file, 'read'):
+        return upload_file.read()
+    with open(upload_file, 'rb') as f:
+        return f.read()
+
+
+class AsyncJob:
+    """
+    An asynchronous TAP job, following the IVOA Universal Worker Service (UWS) pattern.
+    """
+
+    # Phases after which a job will not change any more.
+    FINAL_PHASES = ('COMPLETED', 'ERROR', 'ABORTED', 'ARCHIVED')
+
+    def __init__(self, url, timeout=60, retries=2, policy=None, verbose=False):
+        self.url = url.rstrip('/')
+        self._TIMEOUT = timeout
+        self._RETRIES = retries
+        self._RETRY_POLICY = policy
+        self.verbose = verbose
+
+    def __repr__(self):
+        return 'AsyncJob({!r})'.format(self.url)
+
+    def phase(self):
+        """Return the current phase of the job, e.g. QUEUED, EXECUTING or COMPLETED
+        """
+        response = utils.try_query(self.url + '/phase', get_params={}, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=self.verbose)
+        response.raise_for_status()
+        return response.text.strip().upper()
+
+    def run(self):
+        """Start the job
+        """
+        self._set_phase('RUN')
+
+    def abort(self):
+        """Abort the job on the server
+        """
+        self._set_phase('ABORT')
+
+    def delete(self):
+        """Delete the job and its results from the server
+        """
+        response = utils.try_query(self.url, post_data={'ACTION': 'DELETE'}, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=self.verbose)
+        response.raise_for_status()
+
+    def _set_phase(self, phase):
+        response = utils.try_query(self.url + '/phase', post_data={'PHASE': phase}, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=self.verbose)
+        response.raise_for_status()
+
+    def wait(self, poll_interval=1., max_poll_interval=30., backoff=1.5, timeout=None, stop=None):
+        """Poll the job until it reaches a final phase, and return that phase
+
+        The delay between polls starts at poll_interval and grows by a factor
+        of backoff up to max_poll_interval.  If timeout seconds pass first,
+        or the threading.Event stop is set, the current (non-final) phase is
+        returned; the job keeps running.
+        """
+        start = time.monotonic()
+        delay = poll_interval
+        if stop is None:
+            stop = threading.Event()
+        while True:
+            phase = self.phase()
+            if phase in self.FINAL_PHASES:
+                return phase
+            if timeout is not None and time.monotonic() - start + delay > timeout:
+                return phase
+            if stop.wait(delay):
+                return phase
+            delay = min(delay * backoff, max_poll_interval)
+
+    def error(self):
+        """Return the error summary of a job that ended in phase ERROR
+        """
+        response = utils.try_query(self.url + '/error', get_params={}, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=self.verbose)
+        return response.text.strip() if response.ok else ''
+
+    def result(self, stream=False, batch_size=10000, as_table=True):
+        """Download the result of a completed job
+
+        With stream=True the result is read incrementally, returning a
+        generator of batches as for TapClass.query(stream=True).
+        """
+        url = self.url + '/results/result'
+        if stream:
+            return self._stream_batches(url, batch_size, as_table)
+
+        response = utils.try_query(url, get_params={}, timeout=self._TIMEOUT, retries=self._RETRIES,
+                                   policy=self._RETRY_POLICY, verbose=self.verbose)
+        return utils.astropy_table_from_votable_response(response)
+
+    def _stream_batches(self, url, batch_size, as_table):
+        response = utils.try_query(url, get_params={}, timeout=self._TIMEOUT, retries=self._RETRIES, stream=True,
+                                   policy=self._RETRY_POLICY, verbose=self.verbose)
+        try:
+            for batch in utils.iter_votable_batches(response, batch_size=batch_size, as_table=as_table):
+                yield batch
+        finally:
+            response.close()
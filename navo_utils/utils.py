@@ -2,10 +2,15 @@
 # Imports
 #
 
+import concurrent.futures
 import html # to unescape, which shouldn't be neccessary but currently is
-import io
+import re
+import threading
+import time
+import urllib.parse
 import numpy as np
-from astropy.table import Table
+
+from . import metrics
 
 #
 # Support for VOTABLEs as astropy tables
@@ -26,40 +31,304 @@ def astropy_table_from_votable_response(response):
         Astropy Table containing the data from the first TABLE in the VOTABLE.
     """
 
-    # The astropy table reader would like a file-like object, so convert
-    # the response content a byte stream.  This assumes Python 3.x.
-    #
-    # (The reader also accepts just a string, but that seems to have two
-    # problems:  It looks for newlines to see if the string is itself a table,
-    # and we need to support unicode content.)
-    #Tracer()()
-    try:
-        file_like_content = io.BytesIO(response.content)
-    except IOError:
-        print("ERROR parsing response content? Got:\n    {}...".format(response.content[0:400]))
-        #  Should this return or raise?
-        raise
-    except Exception as e:
-        raise e
+    from astropy.table import Table
+    from . import parse_pool
 
-    # The astropy table reader will auto-detect that the content is a VOTABLE
-    # and parse it appropriately.
-    try:
-        aptable = Table.read(file_like_content, format='votable')
-    except Exception as e:
+    record = metrics.current()
+    if record is None and metrics.active():
+        # Not inside a query's span: report the parse on its own.
+        with metrics.span('parse', response.url):
+            return astropy_table_from_votable_response(response)
+
+    # The astropy table reader auto-detects that the content is a VOTABLE and
+    # parses it; string values, stored as bytes, are then converted to strings
+    # (see stringify_table).  Both happen in a worker process if a parse pool
+    # is enabled (see navo_utils.parse_pool).
+    aptable, parse_time, stringify_time = parse_pool.parse(response.content)
+    if aptable is None:
         print("ERROR parsing response as astropy Table: looks like the content isn't the expected VO table XML? Returning an empty table. Look at its meta data to debug.")
         aptable = Table()
-        #raise e
 
     aptable.meta['url'] = response.url
     aptable.meta['text'] = response.text
-    # String values in the VOTABLE are stored in the astropy Table as bytes instead
-    # of strings.  To makes accessing them more convenient, we will convert all those
-    # bytes values to strings.
-    stringify_table(aptable)
 
+    if record is not None:
+        metrics.add_phase(record, 'parse', parse_time)
+        metrics.add_phase(record, 'stringify', stringify_time)
+        record['rows'] = len(aptable)
     return aptable
 
+# Services signal a result cut short by their row limit with this INFO element.
+_OVERFLOW = re.compile(r'QUERY_STATUS[^>]*OVERFLOW|OVERFLOW[^>]*QUERY_STATUS')
+
+def is_truncated(table):
+    """
+    Returns whether a query result was cut short by the service's row limit
+    (QUERY_STATUS OVERFLOW): from meta['truncated'] if set, as for results
+    served from the result cache, otherwise from the response text.
+    """
+    truncated = table.meta.get('truncated')
+    if truncated is not None:
+        return bool(truncated)
+    return bool(_OVERFLOW.search(table.meta.get('text', '') or ''))
+
+#
+# Streaming support for large TABLEDATA VOTABLEs
+#
+
+# numpy dtypes for scalar VOTABLE datatypes.  Anything else (arrays, complex
+# values) is kept as the string from the TD element.
+_VOTABLE_DTYPES = {
+    'boolean': bool,
+    'bit': bool,
+    'unsignedByte': np.uint8,
+    'short': np.int16,
+    'int': np.int32,
+    'long': np.int64,
+    'float': np.float32,
+    'double': np.float64,
+}
+
+_VOTABLE_TRUE = {'t', 'true', '1'}
+
+def _strip_ns(tag):
+    """
+    Returns an XML tag without its {namespace} prefix.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+def _votable_field_dtype(field):
+    """
+    Returns the numpy dtype for a FIELD element's attributes, or None for string data.
+    """
+    datatype = field.get('datatype')
+    arraysize = field.get('arraysize')
+    if datatype in ('char', 'unicodeChar'):
+        return None
+    if arraysize is not None and arraysize != '1':
+        return None
+    return _VOTABLE_DTYPES.get(datatype)
+
+def _votable_batch_to_table(fields, columns, url=None):
+    """
+    Builds an astropy Table from the TD strings of one batch of rows.
+
+    Parameters
+    ----------
+    fields : list of dict
+        Attributes of each FIELD, with the VALUES null value under 'null' if given.
+    columns : list of list of str
+        The TD text of each row, stored column by column.
+    url : str
+        Stored in the table meta data.
+    """
+    from astropy.table import MaskedColumn, Table
+
+    table = Table(masked=True)
+    for field, values in zip(fields, columns):
+        text = np.array(values, dtype=str)
+        mask = (text == '')
+        if field.get('null') is not None:
+            mask |= (text == field['null'])
+
+        dtype = _votable_field_dtype(field)
+        if dtype is None:
+            data = text
+        elif dtype is bool:
+            text = np.char.lower(np.char.strip(text))
+            mask |= (text == '?')
+            data = np.isin(text, list(_VOTABLE_TRUE))
+        else:
+            data = np.where(mask, '0', text).astype(dtype)
+
+        col = MaskedColumn(data, name=field.get('name') or field.get('ID'), mask=mask,
+                           unit=field.get('unit'), description=field.get('description'))
+        for key in ('ucd', 'utype', 'ID', 'datatype', 'arraysize'):
+            if field.get(key) is not None:
+                col.meta[key] = field[key]
+        table.add_column(col)
+
+    table.meta['url'] = url
+    return table
+
+def iter_votable_batches(source, batch_size=10000, as_table=True, url=None):
+    """
+    Incrementally parses the first TABLE of a TABLEDATA-serialized VOTABLE and
+    yields its rows in batches, so that memory use is bounded by the batch
+    size rather than the size of the result.
+
+    Parameters
+    ----------
+    source : requests.Response or file-like
+        A response opened with stream=True, or a binary file-like object.
+    batch_size : int
+        Maximum number of rows per batch.
+    as_table : bool
+        Yield astropy Tables if True, otherwise numpy (masked) record arrays.
+    url : str
+        URL to store in each table's meta data (defaults to source.url if present).
+
+    Yields
+    ------
+    astropy.table.Table or numpy.ndarray
+        Consecutive batches of at most batch_size rows.  String columns are
+        returned as str, so no stringify_table pass is needed.
+    """
+    import xml.etree.ElementTree as ET
+
+    if url is None:
+        url = getattr(source, 'url', None)
+    stream = getattr(source, 'raw', source)
+    if hasattr(stream, 'decode_content'):
+        # Let urllib3 undo any gzip/deflate transfer encoding as it reads.
+        stream.decode_content = True
+
+    fields = []
+    columns = None
+    nrows = 0
+    yielded = False
+    in_table = False
+    tabledata = None
+    field = None
+
+    def emit():
+        batch = _votable_batch_to_table(fields, columns, url=url)
+        return batch if as_table else batch.as_array()
+
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        tag = _strip_ns(elem.tag)
+        if event == 'start':
+            if tag == 'TABLE':
+                if in_table or columns is not None:
+                    break   # Only the first TABLE is returned.
+                in_table = True
+            elif tag == 'FIELD' and in_table:
+                field = dict(elem.attrib)
+            elif tag == 'TABLEDATA':
+                tabledata = elem
+                columns = [[] for f in fields]
+            elif tag in ('BINARY', 'BINARY2', 'FITS') and in_table:
+                raise ValueError('Streaming only supports TABLEDATA serialization, not {}.'.format(tag))
+            continue
+
+        # 'end' events
+        if tag == 'VALUES' and field is not None and elem.get('null') is not None:
+            field['null'] = elem.get('null')
+        elif tag == 'DESCRIPTION' and field is not None:
+            field['description'] = (elem.text or '').strip()
+        elif tag == 'FIELD' and field is not None:
+            fields.append(field)
+            field = None
+        elif tag == 'INFO' and elem.get('name') == 'QUERY_STATUS' and elem.get('value') == 'ERROR':
+            print("ERROR returned by service: {}".format((elem.text or '').strip()))
+            return
+        elif tag == 'TR' and columns is not None:
+            tds = [td.text or '' for td in elem]
+            if len(tds) < len(columns):
+                tds.extend([''] * (len(columns) - len(tds)))
+            for column, value in zip(columns, tds):
+                column.append(value)
+            nrows += 1
+            # Drop the parsed rows so the tree never grows past one batch.
+            tabledata.clear()
+            if nrows == batch_size:
+                yield emit()
+                yielded = True
+                columns = [[] for f in fields]
+                nrows = 0
+        elif tag == 'TABLE':
+            break
+
+    if fields and (nrows > 0 or not yielded):
+        if columns is None:
+            # A TABLE with no DATA element, i.e. no rows.
+            columns = [[] for f in fields]
+        yield emit()
+
+#
+# Column lookup by UCD or utype
+#
+
+# Indexes built by column_index and stdcol_maps, keyed by a fingerprint of the
+# column metadata.  Every table from one service has the same fingerprint, so
+# an index is built once per service schema rather than once per table.
+_COLUMN_INDEX_CACHE_SIZE = 1024
+_column_index_cache = {}
+
+def _schema_fingerprint(table, key):
+    return (key,) + tuple((name, col.meta.get(key)) for name, col in table.columns.items())
+
+def _cache_index(fingerprint, index):
+    if len(_column_index_cache) >= _COLUMN_INDEX_CACHE_SIZE:
+        _column_index_cache.clear()
+    _column_index_cache[fingerprint] = index
+    return index
+
+def column_index(table, key):
+    """
+    Returns a dict mapping each value of the given column metadata key
+    (e.g. 'ucd' or 'utype') to the name of the first column that has it.
+
+    The index is built in a single pass over the columns and shared by all
+    tables with the same column names and metadata values.
+
+    Parameters
+    ----------
+    table : astropy.table.Table
+        Astropy Table which was created from a VOTABLE.
+    key : str
+        The column meta data key to index, 'ucd' or 'utype'.
+
+    Returns
+    -------
+    dict
+        Metadata value to column name.
+    """
+    fingerprint = _schema_fingerprint(table, key)
+    index = _column_index_cache.get(fingerprint)
+    if index is None:
+        index = {}
+        for name, col in table.columns.items():
+            value = col.meta.get(key)
+            if value is not None and value not in index:
+                index[value] = name
+        index = _cache_index(fingerprint, index)
+    return index
+
+def stdcol_maps(table, enum, key):
+    """
+    Returns the maps between the members of a standard column enumeration
+    (ImageColumn or SpectraColumn) and the column names of a table.
+
+    Parameters
+    ----------
+    table : astropy.table.Table
+        Astropy Table which was created from a VOTABLE.
+    enum : Enum class
+        Enumeration whose member values are dicts holding the key.
+    key : str
+        'ucd' or 'utype'.
+
+    Returns
+    -------
+    (dict, dict)
+        Member name to column name (None for columns not present), and
+        column name to enum member.
+    """
+    fingerprint = (enum,) + _schema_fingerprint(table, key)
+    maps = _column_index_cache.get(fingerprint)
+    if maps is None:
+        index = column_index(table, key)
+        forward = {}
+        reverse = {}
+        for member in enum:
+            colname = index.get(member.value[key])
+            forward[member.name] = colname
+            if colname is not None:
+                reverse.setdefault(colname, member)
+        maps = _cache_index(fingerprint, (forward, reverse))
+    return maps
+
 def find_column_by_ucd(table, ucd):
     """
     Given an astropy table derived from a VOTABLE, this function returns
@@ -85,15 +354,10 @@ def find_column_by_ucd(table, ucd):
     print ('1st row title value is:', my_table[col.name][0])
     """
 
-    # Loop through all the columns looking for the UCD
-    for key in table.columns:
-        col = table.columns[key]
-        ucdval = col.meta.get('ucd')
-        if ucdval is not None:
-            if ucd == ucdval:
-                return col
-
-    return None
+    name = column_index(table, 'ucd').get(ucd)
+    if name is None:
+        return None
+    return table.columns[name]
 
 def find_column_by_utype(table, utype):
     """
@@ -120,15 +384,10 @@ def find_column_by_utype(table, utype):
     print ('1st row access_url value is:', my_table[col.name][0])
     """
 
-    # Loop through all the columns looking for the utype
-    for key in table.columns:
-        col = table.columns[key]
-        utypeval = col.meta.get('utype')
-        if utypeval is not None:
-            if utype == utypeval:
-                return col
-
-    return None
+    name = column_index(table, 'utype').get(utype)
+    if name is None:
+        return None
+    return table.columns[name]
 
 #
 # Functions to help replace bytes with strings in astropy tables that came from VOTABLEs
@@ -157,11 +416,54 @@ def sval(val):
 # Create a version of sval() that operates on a whole column.
 svalv = np.vectorize(sval)
 
+def decode_bytes_array(values, mask=None):
+    """
+    Decodes an array of bytes into a fixed-width numpy unicode array in bulk,
+    using utf-8 decoding.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Array of dtype object holding bytes, or of a numpy bytes ('S') dtype.
+    mask : numpy.ndarray
+        Optional boolean mask; masked cells are decoded as empty strings.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of numpy unicode ('U') dtype with the same shape as values.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'O':
+        if mask is not None and mask.any():
+            values = values.copy()
+            values[mask] = b''
+        # One C-level pass to a fixed-width bytes array.  This raises if a cell
+        # holds a non-ASCII str, which the caller handles.
+        values = values.astype(np.bytes_)
+    elif values.dtype.kind != 'S':
+        raise TypeError('decode_bytes_array needs bytes values, not {}'.format(values.dtype))
+    values = np.ascontiguousarray(values)
+    if values.size == 0:
+        return values.astype(np.str_)
+
+    # Pure ASCII, the common case, needs no codec at all: widening each byte
+    # to a 4-byte code point gives the unicode array directly.
+    width = values.dtype.itemsize
+    codes = values.view(np.uint8).reshape(values.shape + (width,))
+    if codes.max() < 128:
+        return codes.astype(np.uint32).view(np.dtype((np.str_, width)))[..., 0]
+    return np.char.decode(values, 'utf-8')
+
 def sval_whole_column(single_column):
     """
     Returns a new column whose values are the string versions of the values
     in the input column.  The new column also keeps the metadata from the input column.
 
+    Bytes columns are decoded per column in bulk to a compact fixed-width
+    unicode column, keeping any mask.  Other columns fall back to calling
+    sval() on each cell.
+
     Parameters
     ----------
     single_column : astropy.table.Column
@@ -172,9 +474,39 @@ def sval_whole_column(single_column):
     astropy.table.Column
         Stringified version of input column
     """
-    new_col = svalv(single_column)
-    new_col.meta = single_column.meta
-    return new_col
+    from astropy.table import Column, MaskedColumn
+
+    mask = getattr(single_column, 'mask', None)
+    if mask is not None:
+        mask = np.ma.getmaskarray(single_column)
+    data = np.ma.getdata(single_column)
+
+    if data.dtype.kind == 'U':
+        new_data = data.copy()
+    else:
+        try:
+            new_data = decode_bytes_array(data, mask=mask)
+        except (UnicodeError, TypeError, ValueError):
+            new_data = svalv(data)
+
+    attrs = dict(name=single_column.name, unit=single_column.unit, format=single_column.format,
+                 description=single_column.description, meta=single_column.meta)
+    if mask is not None:
+        return MaskedColumn(new_data, mask=mask, **attrs)
+    return Column(new_data, **attrs)
+
+def _is_bytes_column(column):
+    """
+    Returns True if the column holds bytes that should be decoded to strings.
+    """
+    if column.dtype.kind == 'S':
+        return True
+    if column.dtype.kind != 'O':
+        return False
+    data = np.ma.getdata(column)
+    if np.ma.is_masked(column):
+        data = data[~np.ma.getmaskarray(column)]
+    return len(data) > 0 and isinstance(data[0], bytes)
 
 def stringify_table(t):
     """
@@ -191,68 +523,691 @@ def stringify_table(t):
         The same table as input, but with bytes-valued cells replaced by strings.
     """
     # This mess will look for columns that should be strings and convert them.
-    if len(t) is 0:
+    if len(t) == 0:
         return   # Nothing to convert
 
-    scols = []
-    for col in t.columns:
-        colobj = t.columns[col]
-        if (colobj.dtype == 'object' and isinstance(t[colobj.name][0], bytes)):
-            scols.append(colobj.name)
+    scols = [colname for colname in t.colnames if _is_bytes_column(t.columns[colname])]
 
     for colname in scols:
-        t[colname] = sval_whole_column(t[colname])
-
-def query_loop(query_function, service, params, verbose=False):
-    # Only one service, which is expected to be a row of a Registry query result that has  service['access_url']
-    if verbose: print("    Querying service {}".format(html.unescape(service['access_url'])))
-    # Initialize a table to add results to:
-    service_results = []
-    for j, param in enumerate(params):
-
-        result = query_function(service=html.unescape(service['access_url']), **param)
-        # Need a test that we got something back. Shouldn't error if not, just be empty
-        if verbose:
-            if len(result) > 0:
-                print("    Got {} results for parameters[{}]".format(len(result), j))
-                #Tracer()()
+        t.replace_column(colname, sval_whole_column(t[colname]))
+
+def split_by_index(table, index_column, n):
+    """
+    Splits a table into a list of n tables according to an integer column
+    giving, for each row, the position in the list it belongs to.
+
+    Parameters
+    ----------
+    table : astropy.table.Table
+        The table to split.
+    index_column : str
+        Name of the column holding list positions 0..n-1.  It is not
+        included in the returned tables.
+    n : int
+        Length of the returned list.
+
+    Returns
+    -------
+    list of astropy.table.Table
+        Tables of the rows for each position, in their original order.
+        Positions without rows get empty tables.
+    """
+    if index_column not in table.colnames:
+        # Typically an error result; give each position the same (empty) table.
+        return [table[0:0] for i in range(n)]
+
+    index = np.asarray(table[index_column], dtype=np.int64)
+    order = np.argsort(index, kind='stable')
+    ordered = table[order]
+    ordered.remove_column(index_column)
+    bounds = np.searchsorted(index[order], np.arange(n + 1))
+    return [ordered[bounds[i]:bounds[i+1]] for i in range(n)]
+
+#
+# Merged results of many positions
+#
+
+INPUT_INDEX = 'input_index'
+INPUT_RA = 'input_ra'
+INPUT_DEC = 'input_dec'
+
+def _merged_dtype(columns):
+    """
+    Returns the dtype holding every column's values, and their common cell shape (or object dtype and ()).
+    """
+    dtypes = [col.dtype for col in columns]
+    shapes = {col.shape[1:] for col in columns}
+    if len(shapes) > 1:
+        return np.dtype(object), ()
+    if all(d == dtypes[0] for d in dtypes):
+        return dtypes[0], shapes.pop()
+    kinds = {d.kind for d in dtypes}
+    if kinds <= {'U'} or kinds <= {'S'} or kinds <= set('biuf'):
+        return np.result_type(*dtypes), shapes.pop()
+    return np.dtype(object), ()
+
+def merge_results(results, ra, dec, table_class=None):
+    """
+    Combines the result tables of many positions into one table, with each
+    row tagged by the position it belongs to.
+
+    The output columns are allocated once, at their final length, and each
+    result is copied into its slice; positions keep their input order, so
+    each position's rows are contiguous (see position_rows and group_view).
+
+    Parameters
+    ----------
+    results : list of astropy.table.Table
+        One result per position, as returned by query_loop.
+    ra, dec : numpy.ndarray
+        The positions, in degrees.
+    table_class : type
+        Class of the returned table, e.g. ImageTable (default astropy Table).
+
+    Returns
+    -------
+    astropy.table.Table
+        Columns input_index, input_ra and input_dec, then every column found
+        in the results (masked where a result lacks it).  meta['input_offsets']
+        holds the first row of each position plus the table length, and
+        meta['errors'] maps the index of each failed position to its error.
+    """
+    from astropy.table import Column, MaskedColumn, Table
+
+    if table_class is None:
+        table_class = Table
+    lengths = np.array([len(result) if len(result.columns) else 0 for result in results], dtype=np.int64)
+    offsets = np.zeros(len(results) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    total = int(offsets[-1])
+
+    names = []
+    sources = {}
+    for i, result in enumerate(results):
+        if lengths[i] == 0:
+            continue
+        for name in result.colnames:
+            if name not in sources:
+                names.append(name)
+                sources[name] = []
+            sources[name].append(i)
+
+    index = np.repeat(np.arange(len(results), dtype=np.int64), lengths)
+    columns = [Column(index, name=INPUT_INDEX, description='Index of the input position'),
+               Column(np.asarray(ra, dtype=float)[index], name=INPUT_RA, unit='deg',
+                      description='RA of the input position'),
+               Column(np.asarray(dec, dtype=float)[index], name=INPUT_DEC, unit='deg',
+                      description='Dec of the input position')]
+    for name in names:
+        if name in (INPUT_INDEX, INPUT_RA, INPUT_DEC):
+            continue
+        rows = sources[name]
+        template = results[rows[0]][name]
+        dtype, shape = _merged_dtype([results[i][name] for i in rows])
+        data = np.zeros((total,) + shape, dtype=dtype) if dtype != object else np.full((total,) + shape, None)
+        mask = None
+        if int(lengths[rows].sum()) < total:
+            mask = np.ones((total,) + shape, dtype=bool)   # rows of results without this column
+        for i in rows:
+            col = results[i][name]
+            part = slice(offsets[i], offsets[i + 1])
+            if dtype == object and col.dtype != object:
+                data[part] = list(col)
             else:
-                print("    (Got no results for parameters[{}])".format(j))
+                data[part] = np.ma.getdata(col.data)
+            if mask is not None or np.ma.is_masked(col):
+                if mask is None:
+                    mask = np.zeros((total,) + shape, dtype=bool)
+                mask[part] = np.ma.getmaskarray(col.data)
+        attrs = {'name': name, 'unit': template.unit, 'description': template.description,
+                 'format': template.format, 'meta': dict(template.meta)}
+        if mask is not None or hasattr(template, 'mask'):
+            columns.append(MaskedColumn(data, mask=mask, copy=False, **attrs))
+        else:
+            columns.append(Column(data, copy=False, **attrs))
 
-        service_results.append(result)
-    return service_results
+    merged = table_class(columns, copy=False)
+    merged.meta['input_offsets'] = offsets
+    merged.meta['errors'] = {i: result.meta['error'] for i, result in enumerate(results)
+                             if result.meta.get('error')}
+    return merged
 
+def _input_offsets(table):
+    offsets = table.meta.get('input_offsets')
+    if offsets is not None and len(offsets) and offsets[-1] == len(table):
+        return np.asarray(offsets)
+    index = np.asarray(table[INPUT_INDEX], dtype=np.int64)
+    if len(index) and np.any(np.diff(index) < 0):
+        raise ValueError('the rows of the table are not in input_index order.')
+    n = int(index[-1]) + 1 if len(index) else 0
+    return np.searchsorted(index, np.arange(n + 1))
 
-def try_query(url, retries=3, timeout=60, get_params=None, post_data=None, files=None):
-    """ A wrapper to the astroquery _request() function allowing for retries
+def position_rows(table, i):
+    """
+    Returns the rows of position i in a table from merge_results, as a view
+    (a slice, without copying the data).  Positions without rows give an
+    empty table.
     """
-    from requests.exceptions import (Timeout, ReadTimeout)
-    from urllib3.exceptions import ReadTimeoutError
-    from astroquery.query import BaseQuery
-    from IPython.core.debugger import Tracer
+    offsets = _input_offsets(table)
+    if i + 1 >= len(offsets):
+        return table[0:0]
+    return table[int(offsets[i]):int(offsets[i + 1])]
 
-    bq = BaseQuery()
-    retry = retries
-    assert get_params is not None or post_data is not None, "Give either get_params or post_data"
+def group_view(table):
+    """
+    Returns a table from merge_results grouped by input_index, like
+    table.group_by('input_index') but without sorting or copying, since each
+    position's rows are already contiguous.  Iterate over view.groups, or
+    use view.groups.keys; positions without rows have no group.
+    """
+    from astropy.table import TableGroups
+
+    offsets = _input_offsets(table)
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    indices = np.append(starts, len(table))
+    view = table.__class__(table, copy=False)
+    keys = table.__class__([table[INPUT_INDEX][starts]], copy=False)
+    # The same grouping group_by() sets up after its sort.
+    view._groups = TableGroups(view, indices=indices, keys=keys)
+    return view
+
+#
+# Input coordinate handling
+#
+
+COORDS_ERROR = """
+        ERROR: Give a coordinate object that is a single string,
+        a list/tuple (ra,dec), a SkyCoord (scalar or array), an (N,2) array
+        of RA,DEC in degrees, a Table with ra/dec columns, or a list of any
+        of the above."""
+
+def find_radec_columns(table):
+    """
+    Returns the names of the main RA and Dec columns of a table, found by
+    UCD (UCD1 or UCD1+) or, failing that, by the column names ra and dec.
+    Either name is None if not found.
+    """
+    ra = None
+    dec = None
+    for key in table.colnames:
+        ucd = (table[key].meta.get('ucd') or '').lower()
+        if ra is None and ucd in ('pos.eq.ra;meta.main', 'pos_eq_ra_main'):
+            ra = key
+        elif dec is None and ucd in ('pos.eq.dec;meta.main', 'pos_eq_dec_main'):
+            dec = key
+    names = {name.lower(): name for name in table.colnames}
+    if ra is None:
+        ra = names.get('ra')
+    if dec is None:
+        dec = names.get('dec')
+    return ra, dec
 
-    #Tracer()()
-    while retry:
+def _degrees(values):
+    """
+    Returns values, which may be an astropy Quantity or Column with a unit, as a float array in degrees.
+    """
+    unit = getattr(values, 'unit', None)
+    if unit is not None and hasattr(values, 'to_value'):
+        return np.atleast_1d(values.to_value('deg')).astype(float)
+    if unit is not None:
+        import astropy.units as u
+        return np.atleast_1d(u.Quantity(np.asarray(values), unit).to_value(u.deg)).astype(float)
+    return np.atleast_1d(np.asarray(values, dtype=float))
+
+def _parse_coordinate_strings(strings):
+    """
+    Parses a list of coordinate strings in one pass where possible, falling back
+    to astroquery's parse_coordinates (which resolves object names) one at a time.
+    """
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+
+    for kwargs in ({}, {'unit': u.deg}):
         try:
-            if post_data is not None:
-                response = bq._request('POST', url, data=post_data, cache=False, timeout=timeout,files=files)
-            else:
-                response = bq._request('GET', url, params=get_params, cache=False, timeout=timeout)
-            retry = retries-1
-        except (Timeout, ReadTimeout, ReadTimeoutError, ConnectionError) as e:
-            retry = retry-1
-            if retry == 0:
-                print("ERROR: Got another timeout; quitting.")
-                #Tracer()()
-                #raise e
-                return response
-            else:
-                print("WARNING: Got a timeout; trying again.")
-        except:
-            raise
+            c = SkyCoord(strings, frame='icrs', **kwargs)
+            return c.ra.deg, c.dec.deg
+        except (ValueError, u.UnitsError):
+            pass
+
+    from astroquery.utils import parse_coordinates
+    parsed = [parse_coordinates(s).icrs for s in strings]
+    return np.array([c.ra.deg for c in parsed]), np.array([c.dec.deg for c in parsed])
+
+def parse_coordinates_array(coords):
+    """
+    Converts any of the accepted forms of input positions to arrays of ICRS
+    RA and Dec in degrees, vectorizing the conversion wherever possible.
+
+    Parameters
+    ----------
+    coords : str, tuple, SkyCoord, numpy.ndarray, astropy.table.Table or list
+        A coordinate string or object name; an (ra, dec) tuple of scalars or
+        of arrays, in degrees; a scalar or array SkyCoord; an (N, 2) or (2,)
+        array of RA, Dec in degrees; a Table with ra/dec columns (found by
+        name or UCD); or a list of any of the single-position forms.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        RA and Dec in degrees, one element per input position.
+    """
+    from astropy.coordinates import SkyCoord
+    from astropy.table import Table
+
+    if isinstance(coords, str):
+        return _parse_coordinate_strings([coords])
+
+    if isinstance(coords, SkyCoord):
+        c = coords.icrs
+        return np.atleast_1d(c.ra.deg).astype(float), np.atleast_1d(c.dec.deg).astype(float)
+
+    if isinstance(coords, Table):
+        ra, dec = find_radec_columns(coords)
+        assert ra is not None and dec is not None, COORDS_ERROR
+        return _degrees(coords[ra]), _degrees(coords[dec])
+
+    if isinstance(coords, tuple):
+        assert len(coords) == 2, COORDS_ERROR
+        if any(isinstance(c, str) for c in coords):
+            return _parse_coordinate_strings(["{} {}".format(coords[0], coords[1])])
+        ra, dec = _degrees(coords[0]), _degrees(coords[1])
+        assert ra.shape == dec.shape, 'RA and Dec arrays must have the same length.'
+        return ra, dec
+
+    if isinstance(coords, np.ndarray) and coords.dtype.kind in 'iuf':
+        arr = np.asarray(coords, dtype=float)
+        if arr.shape == (2,):
+            arr = arr.reshape(1, 2)
+        assert arr.ndim == 2 and arr.shape[1] == 2, COORDS_ERROR
+        return arr[:, 0].copy(), arr[:, 1].copy()
+
+    assert isinstance(coords, (list, np.ndarray)), COORDS_ERROR
+    if len(coords) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    # Fast path: a list of numeric (ra, dec) pairs.
+    try:
+        arr = np.asarray(coords, dtype=float)
+    except (TypeError, ValueError):
+        arr = None
+    if arr is not None and arr.ndim == 2 and arr.shape[1] == 2:
+        return arr[:, 0].copy(), arr[:, 1].copy()
+
+    # Mixed list: group the strings so they are parsed in one call.
+    ra = np.empty(len(coords))
+    dec = np.empty(len(coords))
+    string_idx = []
+    strings = []
+    for i, c in enumerate(coords):
+        if isinstance(c, str):
+            string_idx.append(i)
+            strings.append(c)
+        elif isinstance(c, (tuple, list)) and len(c) == 2 and any(isinstance(v, str) for v in c):
+            string_idx.append(i)
+            strings.append("{} {}".format(c[0], c[1]))
         else:
-            return response
+            if isinstance(c, list):
+                c = tuple(c)
+            assert isinstance(c, (tuple, SkyCoord)), COORDS_ERROR
+            one_ra, one_dec = parse_coordinates_array(c)
+            assert len(one_ra) == 1, COORDS_ERROR
+            ra[i], dec[i] = one_ra[0], one_dec[0]
+    if strings:
+        ra[string_idx], dec[string_idx] = _parse_coordinate_strings(strings)
+    return ra, dec
+
+def radec_to_xyz(ra, dec):
+    """
+    Returns the unit vectors, shape (N, 3), for RA and Dec arrays in degrees.
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Returns the angular separation in degrees between positions given in
+    degrees, broadcasting the inputs like numpy.  Uses the Vincenty formula,
+    which is accurate at all separations.
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(a, dtype=float)) for a in (ra1, dec1, ra2, dec2))
+    dra = ra2 - ra1
+    sin_dra, cos_dra = np.sin(dra), np.cos(dra)
+    sin_d1, cos_d1 = np.sin(dec1), np.cos(dec1)
+    sin_d2, cos_d2 = np.sin(dec2), np.cos(dec2)
+    num1 = cos_d2 * sin_dra
+    num2 = cos_d1 * sin_d2 - sin_d1 * cos_d2 * cos_dra
+    denominator = sin_d1 * sin_d2 + cos_d1 * cos_d2 * cos_dra
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+def parse_radius_array(radius, n):
+    """
+    Converts a radius, or a list or array of radii, to n radii in degrees.
+
+    Parameters
+    ----------
+    radius : float, str, astropy.units.Quantity, list or numpy.ndarray
+        A single radius for all positions, or one radius per position.
+        Values without units are in degrees.
+    n : int
+        The number of positions.
+
+    Returns
+    -------
+    numpy.ndarray
+        n radii in degrees.
+    """
+    if isinstance(radius, (list, tuple)):
+        radius = [_degrees(r)[0] if hasattr(r, 'unit') else float(r) for r in radius]
+    radii = _degrees(radius)
+    if radii.size == 1:
+        return np.full(n, radii[0])
+    assert len(radii) == n, 'Please give either single radius or list of radii of same length as coords.'
+    return radii
+
+# Maximum number of simultaneous requests sent to any one host by query_loop,
+# no matter how many workers the executor has.
+MAX_REQUESTS_PER_HOST = 8
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+def _host_semaphore(url):
+    """
+    Returns the semaphore that bounds concurrent requests to the host of the given URL.
+    """
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    with _host_semaphores_lock:
+        sem = _host_semaphores.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+            _host_semaphores[host] = sem
+    return sem
+
+def _run_one_query(query_function, url, j, param, verbose=False):
+    """
+    Runs query_function for a single parameter set, bounded by the per-host limit.
+
+    Any exception is reported and turned into an empty table whose meta data
+    holds the error, so that one bad position does not lose the whole batch.
+    """
+    try:
+        with _host_semaphore(url):
+            result = query_function(service=url, **param)
+    except Exception as e:
+        print("ERROR: query for parameters[{}] failed: {}".format(j, e))
+        from astropy.table import Table
+        result = Table()
+        result.meta['url'] = url
+        result.meta['error'] = repr(e)
+        return result
+
+    # Need a test that we got something back. Shouldn't error if not, just be empty
+    if verbose:
+        if len(result) > 0:
+            print("    Got {} results for parameters[{}]".format(len(result), j))
+        else:
+            print("    (Got no results for parameters[{}])".format(j))
+    return result
+
+def query_loop(query_function, service, params, verbose=False, max_workers=None, executor=None):
+    """
+    Runs query_function once for each parameter set in params against one service.
+
+    Parameters
+    ----------
+    query_function : callable
+        Called as query_function(service=url, **param) for each param in params.
+    service : dict-like
+        Expected to be a row of a Registry query result that has service['access_url'].
+    params : list of dict
+        The parameters for each individual query.
+    verbose : bool
+        Print progress for each query.
+    max_workers : int
+        If given, run the queries concurrently in a thread pool of this size.
+    executor : concurrent.futures.Executor
+        If given, submit the queries to this executor instead (takes precedence
+        over max_workers).  The executor is not shut down.
+
+    Returns
+    -------
+    list of astropy.table.Table
+        One result per parameter set, in the same order as params.  A query
+        that raised gives an empty table with the error in meta['error'].
+    """
+    return [result for j, result in iter_query_loop(query_function, service, params, verbose=verbose,
+                                                    max_workers=max_workers, executor=executor, ordered=True)]
+
+
+def iter_query_loop(query_function, service, params, verbose=False, max_workers=None, executor=None,
+                    ordered=False):
+    """
+    Like query_loop, but yields each result as soon as it is available, so
+    that processing of early results overlaps with the queries still running.
+
+    Parameters
+    ----------
+    query_function, service, params, verbose, max_workers, executor
+        As for query_loop.
+    ordered : bool
+        Yield in the order of params rather than in order of completion.
+
+    Yields
+    ------
+    (int, astropy.table.Table)
+        The index in params and the result of each query.  Closing the
+        generator early cancels the queries not yet started.
+    """
+    url = html.unescape(service['access_url'])
+    if verbose: print("    Querying service {}".format(url))
+    start = time.perf_counter()
+    counts = {'queries': 0, 'errors': 0, 'rows': 0}
+
+    def done(j, result):
+        counts['queries'] += 1
+        counts['errors'] += bool(result.meta.get('error'))
+        counts['rows'] += len(result)
+        return j, result
+
+    futures = []
+    own_executor = False
+    try:
+        if executor is None and (max_workers is None or max_workers <= 1):
+            for j, param in enumerate(params):
+                yield done(j, _run_one_query(query_function, url, j, param, verbose=verbose))
+        else:
+            own_executor = executor is None
+            if own_executor:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+            futures = [executor.submit(_run_one_query, query_function, url, j, param, verbose)
+                       for j, param in enumerate(params)]
+            if ordered:
+                for j, future in enumerate(futures):
+                    yield done(j, future.result())
+            else:
+                index = {future: j for j, future in enumerate(futures)}
+                for future in concurrent.futures.as_completed(futures):
+                    yield done(index[future], future.result())
+    finally:
+        for future in futures:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+
+        if metrics.active():
+            # One record for the whole batch; each query also reports its own.
+            record = metrics.new_record('query_loop', url)
+            record.update(counts)
+            record['total'] = time.perf_counter() - start
+            metrics.emit(record)
+
+
+def iter_in_order(pairs):
+    """
+    Yields the (index, result) pairs of an iterable in index order, each as
+    soon as all those before it have arrived.  The indices should be 0 to N-1.
+    """
+    waiting = {}
+    next_index = 0
+    for index, result in pairs:
+        waiting[index] = result
+        while next_index in waiting:
+            yield next_index, waiting.pop(next_index)
+            next_index += 1
+    for index in sorted(waiting):
+        yield index, waiting[index]
+
+
+#
+# Shared HTTP session
+#
+
+# Connection pool sizing for the shared session.  pool_connections is the number
+# of hosts whose pools are kept; pool_maxsize is the number of keep-alive
+# connections kept per host, which should be at least MAX_REQUESTS_PER_HOST.
+SESSION_POOL_CONNECTIONS = 16
+SESSION_POOL_MAXSIZE = MAX_REQUESTS_PER_HOST
+
+_session = None
+_session_lock = threading.Lock()
+
+def configure_session(pool_connections=None, pool_maxsize=None, headers=None):
+    """
+    (Re)creates the shared HTTP session used by try_query.
+
+    Parameters
+    ----------
+    pool_connections : int
+        Number of per-host connection pools to keep (default SESSION_POOL_CONNECTIONS).
+    pool_maxsize : int
+        Number of keep-alive connections to keep per host (default SESSION_POOL_MAXSIZE).
+    headers : dict
+        Extra headers to send with every request.
+
+    Returns
+    -------
+    requests.Session
+        The new shared session.
+    """
+    global _session
+    import requests
+
+    if pool_connections is None:
+        pool_connections = SESSION_POOL_CONNECTIONS
+    if pool_maxsize is None:
+        pool_maxsize = SESSION_POOL_MAXSIZE
+
+    session = requests.Session()
+    # Retries are handled by try_query, not by urllib3.
+    # The adapter's connections also time connection setup for navo_utils.metrics.
+    adapter = metrics.timed_adapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'User-Agent': 'navo_utils ' + session.headers.get('User-Agent', ''),
+        'Accept-Encoding': 'gzip, deflate',
+    })
+    if headers is not None:
+        session.headers.update(headers)
+
+    with _session_lock:
+        old_session = _session
+        _session = session
+    if old_session is not None:
+        old_session.close()
+    return session
+
+def get_session():
+    """
+    Returns the shared HTTP session, creating it on first use.
+
+    The session keeps a pool of keep-alive connections per host, so repeated
+    queries to the same service reuse their TCP/TLS connections.  The pools
+    are thread-safe, so the session may be shared by query_loop workers.
+
+    Returns
+    -------
+    requests.Session
+        The shared session.
+    """
+    session = _session
+    if session is None:
+        with _session_lock:
+            session = _session
+        if session is None:
+            session = configure_session()
+    return session
+
+def try_query(url, retries=3, timeout=60, get_params=None, post_data=None, files=None, stream=False,
+              headers=None, policy=None, verbose=False, idempotent=None):
+    """ A wrapper around a request on the shared session allowing for retries
+
+    Timeouts, connection errors and transient HTTP statuses are retried with
+    exponential backoff and jitter, with a per-host circuit breaker and
+    optional adaptive per-endpoint timeouts and hedged GETs, as set by policy (see
+    navo_utils.retry.RetryPolicy).  If every try fails the last error is
+    raised; a host whose circuit is open raises retry.CircuitOpenError at once.
+
+    With stream=True the body is not read up front; use response.raw or
+    iter_votable_batches() to consume it.  With verbose=True a warning is
+    printed before each retry.  POSTs are taken to change state on the
+    server and are not resent once they may have arrived; give
+    idempotent=True for POSTs that only query (see retry.send).
+    """
+    from . import retry as retry_policy
+
+    session = get_session()
+    assert get_params is not None or post_data is not None, "Give either get_params or post_data"
+
+    if post_data is not None:
+        return retry_policy.send(session, 'POST', url, retries=retries, timeout=timeout, policy=policy,
+                                 verbose=verbose, idempotent=idempotent, data=post_data, files=files, stream=stream,
+                                 headers=headers)
+    return retry_policy.send(session, 'GET', url, retries=retries, timeout=timeout, policy=policy,
+                             verbose=verbose, idempotent=idempotent, params=get_params, stream=stream,
+                             headers=headers)
+
+
+def query_votable(url, kind, retries=3, timeout=60, get_params=None, post_data=None, policy=None, verbose=False):
+    """
+    Sends a query with try_query and returns the VOTABLE response as an astropy
+    Table, going through the result cache (see navo_utils.cache) if one is enabled.
+
+    Parameters
+    ----------
+    url : str
+        The service URL.
+    kind : str
+        The kind of service ('cone', 'image', 'spectra', 'registry', ...),
+        which selects the cache time to live.
+    retries, timeout, get_params, post_data, policy, verbose
+        As for try_query.
+
+    Returns
+    -------
+    astropy.table.Table
+        As from astropy_table_from_votable_response.
+    """
+    from . import cache as result_cache
+
+    with metrics.span(kind, url) as record:
+        cache = result_cache.get_default_cache()
+        params = get_params if get_params is not None else post_data
+        if cache is not None:
+            table = cache.get(kind, url, params)
+            if table is not None:
+                if record is not None:
+                    record['cache'] = 'hit'
+                    record['rows'] = len(table)
+                return table
+
+        response = try_query(url, retries=retries, timeout=timeout, get_params=get_params, post_data=post_data,
+                             policy=policy, verbose=verbose, idempotent=True)
+        table = astropy_table_from_votable_response(response)
+
+        # Don't cache errors or results that failed to parse.
+        if cache is not None and response.ok and len(table.columns) > 0:
+            cache.put(kind, url, params, table)
+        return table
@@ -0,0 +1,221 @@
+"""
+Shared fixtures: the stand-in VO services of benchmarks/vo_standin.py, a
+small local HTTP server for canned responses (FITS files, downloads, error
+statuses) that also records the requests it receives, and a synthetic
+source catalog served as a cone search and as a TAP service.
+"""
+
+import email.parser
+import io
+import os
+import re
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from vo_standin import StandinServer, make_votable  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def standin():
+    """The stand-in VO services, served from a thread of the test process."""
+    with StandinServer(process=False) as server:
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """Runs each test without a result cache, metrics sinks or circuit breaker history."""
+    from navo_utils import cache, metrics, retry
+    cache.disable()
+    metrics.clear_sinks()
+    retry.reset_host_stats()
+    yield
+    cache.disable()
+    metrics.clear_sinks()
+    retry.reset_host_stats()
+
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True   # headers and body go out in separate writes
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _serve_bytes(self, content):
+        # Static content, with single byte ranges as a file server would serve them.
+        size = len(content)
+        match = _RANGE.match(self.headers.get('Range', ''))
+        if match is None:
+            return self.reply(200, content, {'Accept-Ranges': 'bytes'})
+        first, last = match.groups()
+        if first == '':
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size:
+            return self.reply(416, headers={'Content-Range': 'bytes */{}'.format(size)})
+        self.reply(206, content[start:end + 1],
+                   {'Accept-Ranges': 'bytes', 'Content-Range': 'bytes {}-{}/{}'.format(start, end, size)})
+
+    def _answer(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        path = self.path.split('?')[0]
+        with server.lock:
+            server.requests.append((self.command, self.path, dict(self.headers)))
+        route = server.routes.get(path)
+        if route is None:
+            self.reply(404)
+        elif callable(route):
+            route(self)
+        else:
+            self._serve_bytes(route)
+
+    do_GET = do_POST = do_HEAD = _answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(ThreadingHTTPServer):
+    """
+    Serves the entries of routes, which map a path to bytes (served with
+    Range support) or to a callable given the request handler, which
+    answers with handler.reply(status, body, headers).  requests lists the
+    (method, path, headers) of every request received.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def requests_for(self, path):
+        with self.lock:
+            return [r for r in self.requests if r[1].split('?')[0] == path]
+
+
+@pytest.fixture
+def http_server():
+    server = LocalServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.02}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def votable():
+    """make_votable of the stand-in, for canned responses."""
+    return make_votable
+
+
+class CatalogService:
+    """
+    A catalog of n random sources in a patch of sky, served from server as
+
+        /scs        Simple Cone Search (RA, DEC, SR); at most maxrec rows,
+                    flagged QUERY_STATUS OVERFLOW when cut short
+        /tap/sync   TAP, answering the upload join of Cone.query(tap=...)
+
+    Rows come in catalog order (by id).
+    """
+
+    def __init__(self, server, n=2000, center=(150., 2.), size=2., seed=3):
+        rng = np.random.default_rng(seed)
+        self.id = np.arange(n)
+        self.ra = center[0] + size * (rng.random(n) - 0.5) / np.cos(np.radians(center[1]))
+        self.dec = center[1] + size * (rng.random(n) - 0.5)
+        self.mag = np.round(rng.uniform(10., 20., n), 3)
+        self.maxrec = None
+        self.server = server
+        server.routes['/scs'] = self._cone
+        server.routes['/tap/sync'] = self._tap
+        self.url = server.url('/scs')
+        self.tap = {'access_url': server.url('/tap'), 'table': 'cat'}
+
+    def within(self, ra, dec, radius):
+        """Indices of the sources within radius degrees of (ra, dec)."""
+        ra1, dec1, ra2, dec2 = map(np.radians, (self.ra, self.dec, ra, dec))
+        hav = np.sin((dec1 - dec2) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra1 - ra2) / 2) ** 2
+        return np.flatnonzero(2 * np.degrees(np.arcsin(np.sqrt(hav))) <= radius)
+
+    def cone_requests(self):
+        return len(self.server.requests_for('/scs'))
+
+    def _votable(self, rows, extra=None, overflow=False):
+        fields = [('id', 'long', ''), ('ra', 'double', 'pos.eq.ra;meta.main'),
+                  ('dec', 'double', 'pos.eq.dec;meta.main'), ('mag', 'double', ''), ('name', 'char', '')]
+        columns = [self.id[rows], self.ra[rows], self.dec[rows], self.mag[rows],
+                   ['src{}'.format(i) for i in self.id[rows]]]
+        if extra is not None:
+            fields.insert(0, (extra[0], 'int', ''))
+            columns.insert(0, extra[1])
+        header = ''.join('<FIELD name="{}" datatype="{}"{}{}/>'.format(
+            name, datatype, ' arraysize="*"' if datatype == 'char' else '',
+            ' ucd="{}"'.format(ucd) if ucd else '') for name, datatype, ucd in fields)
+        body = ''.join('<TR>{}</TR>'.format(''.join('<TD>{}</TD>'.format(escape(repr(v) if isinstance(v, float)
+                                                                                  else str(v))) for v in row))
+                       for row in zip(*[list(c.tolist() if hasattr(c, 'tolist') else c) for c in columns]))
+        return ('<?xml version="1.0"?><VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">'
+                '<RESOURCE type="results"><INFO name="QUERY_STATUS" value="OK"/>'
+                '<TABLE>{}<DATA><TABLEDATA>{}</TABLEDATA></DATA></TABLE>{}</RESOURCE></VOTABLE>'.format(
+                    header, body, '<INFO name="QUERY_STATUS" value="OVERFLOW"/>' if overflow else '')).encode()
+
+    def _cone(self, handler):
+        params = {k.upper(): v for k, v in urllib.parse.parse_qsl(urllib.parse.urlsplit(handler.path).query)}
+        rows = self.within(float(params['RA']), float(params['DEC']), float(params['SR']))
+        overflow = self.maxrec is not None and len(rows) > self.maxrec
+        if overflow:
+            rows = rows[:self.maxrec]
+        handler.reply(200, self._votable(rows, overflow=overflow), {'Content-Type': 'text/xml'})
+
+    def _tap(self, handler):
+        from astropy.table import Table
+
+        form = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + handler.headers['Content-Type'].encode() + b'\r\n\r\n' + handler.body)
+        parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                 for part in form.get_payload()}
+        assert b'TAP_UPLOAD.cone_positions' in parts['query']
+        upload = Table.read(io.BytesIO(parts['uplt']), format='votable')
+        index, rows = [], []
+        for i, ra, dec, sr in zip(upload['in_idx'], upload['in_ra'], upload['in_dec'], upload['in_sr']):
+            match = self.within(ra, dec, sr)
+            index.extend([int(i)] * len(match))
+            rows.extend(match.tolist())
+        handler.reply(200, self._votable(np.array(rows, dtype=int), extra=('in_idx', index)),
+                      {'Content-Type': 'text/xml'})
+
+
+@pytest.fixture
+def catalog(http_server):
+    return CatalogService(http_server)
@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+from vo_standin import KINDS
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'bench_suite.py')
+
+
+def _run(tmp_path, *args):
+    output = str(tmp_path / 'results.json')
+    completed = subprocess.run([sys.executable, SCRIPT, '--rows', '3', '--requests', '4', '--workers', '2',
+                                '--parse-time', '0.01', '--output', output] + list(args),
+                               capture_output=True, text=True, timeout=120, cwd=str(tmp_path))
+    assert completed.returncode == 0, completed.stderr
+    with open(output) as f:
+        return json.load(f), completed.stdout
+
+
+def test_every_service_answers_every_query(tmp_path):
+    results, _ = _run(tmp_path)
+    queries = [r for r in results['results'] if r['benchmark'] == 'query']
+    assert sorted(r['service'] for r in queries) == sorted(KINDS)
+    for result in queries:
+        assert result['errors'] == 0 and result['rows'] == 3
+        assert result['latency']['p50_ms'] > 0 and result['phases']['parse'] is not None
+    parses = [r for r in results['results'] if r['benchmark'] == 'parse']
+    assert sorted(r['service'] for r in parses) == sorted(KINDS)
+    assert results['environment']['python'] == '{}.{}.{}'.format(*sys.version_info[:3])
+
+
+def test_compare_with_a_baseline(tmp_path):
+    baseline = str(tmp_path / 'baseline.json')
+    _run(tmp_path, '--services', 'cone', '--no-parse')
+    os.rename(str(tmp_path / 'results.json'), baseline)
+    _, stdout = _run(tmp_path, '--services', 'cone', '--no-parse', '--compare', baseline)
+    assert 'Change from' in stdout
+    assert 'query  cone     rows       3   rows/s' in stdout
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from navo_utils import cache, utils
+
+OVERFLOW_INFO = '<INFO name="QUERY_STATUS" value="OVERFLOW"/>'
+
+
+@pytest.fixture
+def query_cache(tmp_path):
+    return cache.QueryCache(str(tmp_path))
+
+
+def test_cache_key_normalizes_url_and_params():
+    key = cache.cache_key('HTTP://Example.org/cone?ra=1.5', {'DEC': 2.0, 'sr': 0.1})
+    assert key == cache.cache_key('http://example.org/cone', {'RA': 1.5, 'dec': 2.0, 'SR': 0.1})
+    assert key == cache.cache_key('http://example.org/cone?sr=0.1&amp;dec=2.0', {'ra': 1.5})
+    assert key != cache.cache_key('http://example.org/cone', {'RA': 1.5, 'DEC': 2.0, 'SR': 0.2})
+
+
+def test_put_and_get(query_cache):
+    table = Table({'a': [1, 2]}, meta={'url': 'u', 'text': '<VOTABLE/>'})
+    assert query_cache.get('cone', 'http://x/cone', {'RA': 1}) is None
+    query_cache.put('cone', 'http://x/cone', {'RA': 1}, table)
+    cached = query_cache.get('cone', 'http://x/cone', {'ra': 1})
+    assert list(cached['a']) == [1, 2]
+    assert 'text' not in cached.meta and cached.meta['url'] == 'u'
+    assert (query_cache.hits, query_cache.misses) == (1, 1)
+
+
+@pytest.mark.parametrize('content', [b'', b'\x80\x04\x95garbage', b'not a pickle',
+                                     # A class that no longer exists, as after an upgrade.
+                                     b'\x80\x04c__main__\nGone\n)\x81.',
+                                     # A pickle of something other than an entry.
+                                     b'\x80\x04K\x01.'])
+def test_unreadable_entries_are_misses(query_cache, content):
+    query_cache.put('cone', 'http://x/cone', {'RA': 1}, Table({'a': [1]}))
+    path = query_cache._path(cache.cache_key('http://x/cone', {'RA': 1}))
+    with open(path, 'wb') as f:
+        f.write(content)
+    assert query_cache.get('cone', 'http://x/cone', {'RA': 1}) is None
+    assert not os.path.exists(path) and query_cache.misses == 1
+
+    query_cache.put('cone', 'http://x/cone', {'RA': 1}, Table({'a': [2]}))
+    assert list(query_cache.get('cone', 'http://x/cone', {'RA': 1})['a']) == [2]
+
+
+def test_entries_expire(tmp_path):
+    query_cache = cache.QueryCache(str(tmp_path), ttls={'cone': 0.05})
+    query_cache.put('cone', 'http://x/cone', {'RA': 1}, Table({'a': [1]}))
+    assert query_cache.get('cone', 'http://x/cone', {'RA': 1}) is not None
+    time.sleep(0.1)
+    assert query_cache.get('cone', 'http://x/cone', {'RA': 1}) is None
+    assert query_cache.size() == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    table = Table({'a': np.zeros(1000)})
+    query_cache = cache.QueryCache(str(tmp_path), max_bytes=10**9)
+    query_cache.put('cone', 'http://x/cone', {'RA': 0}, table)
+    entry_size = query_cache.size()
+
+    query_cache = cache.QueryCache(str(tmp_path), max_bytes=int(3.5 * entry_size))
+    for i in range(1, 3):
+        query_cache.put('cone', 'http://x/cone', {'RA': i}, table)
+    # Touch entry 0 so that entry 1 is now the least recently used.
+    past = time.time() - 100
+    for i, key in enumerate(cache.cache_key('http://x/cone', {'RA': i}) for i in range(3)):
+        os.utime(query_cache._path(key), (past + i, past + i))
+    assert query_cache.get('cone', 'http://x/cone', {'RA': 0}) is not None
+    query_cache.put('cone', 'http://x/cone', {'RA': 3}, table)
+    query_cache.evict()
+
+    present = [query_cache.get('cone', 'http://x/cone', {'RA': i}) is not None for i in range(4)]
+    assert present == [True, False, True, True]
+
+
+def test_counters_are_thread_safe(query_cache):
+    query_cache.put('cone', 'http://x/cone', {'RA': 1}, Table({'a': [1]}))
+
+    def lookups():
+        for i in range(200):
+            query_cache.get('cone', 'http://x/cone', {'RA': i % 2})
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert query_cache.hits == query_cache.misses == 800
+
+
+def test_truncated_flag_survives_the_cache(query_cache):
+    table = Table({'a': [1]}, meta={'text': '<VOTABLE>' + OVERFLOW_INFO + '</VOTABLE>'})
+    assert utils.is_truncated(table)
+    query_cache.put('cone', 'http://x/cone', {'RA': 1}, table)
+    query_cache.put('cone', 'http://x/cone', {'RA': 2}, Table({'a': [1]}, meta={'text': '<VOTABLE/>'}))
+    assert utils.is_truncated(query_cache.get('cone', 'http://x/cone', {'RA': 1}))
+    assert not utils.is_truncated(query_cache.get('cone', 'http://x/cone', {'RA': 2}))
+
+
+def test_query_votable_is_served_from_the_cache(http_server, votable, tmp_path):
+    http_server.routes['/cone'] = votable('cone', rows=5)
+    cache.enable(str(tmp_path))
+    url = http_server.url('/cone')
+    first = utils.query_votable(url, 'cone', get_params={'RA': 1., 'DEC': 2., 'SR': 0.1})
+    second = utils.query_votable(url, 'cone', get_params={'ra': 1., 'dec': 2., 'sr': 0.1})
+    assert len(http_server.requests_for('/cone')) == 1
+    assert list(first['id']) == list(second['id'])
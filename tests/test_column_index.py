@@ -0,0 +1,65 @@
+from astropy.table import Table
+
+from navo_utils import utils
+from navo_utils.image import ImageColumn
+from navo_utils.image_table import ImageTable
+from navo_utils.spectra import SpectraColumn
+from navo_utils.spectra_table import SpectraTable
+
+
+def _table(cls, key, columns):
+    table = Table()
+    for name, value in columns:
+        table[name] = [1.5, 2.5]
+        if value is not None:
+            table[name].meta[key] = value
+    return cls(table)
+
+
+def _images():
+    return _table(ImageTable, 'ucd', [('ra', 'POS_EQ_RA_MAIN'), ('dec', 'POS_EQ_DEC_MAIN'),
+                                      ('url', 'VOX:Image_AccessReference'), ('url2', 'VOX:Image_AccessReference'),
+                                      ('extra', None)])
+
+
+def test_index_matches_column_scans():
+    images = _images()
+    for member in ImageColumn:
+        col = utils.find_column_by_ucd(images, member.value['ucd'])
+        assert images.stdcol_to_colname(member) == (None if col is None else col.name)
+    assert images.colname_to_stdcol('url') is ImageColumn.ACCESS_URL
+    assert images.colname_to_stdcol('url2') is None
+    assert images.colname_to_stdcol('extra') is None
+
+    spectra = _table(SpectraTable, 'utype', [('url', 'ssa:Access.Reference'), ('title', 'ssa:DataID.Title')])
+    for member in SpectraColumn:
+        col = utils.find_column_by_utype(spectra, member.value['utype'])
+        assert spectra.stdcol_to_colname(member) == (None if col is None else col.name)
+    assert list(spectra[SpectraColumn.TITLE]) == [1.5, 2.5]
+
+
+def test_index_is_shared_by_tables_of_the_same_schema():
+    assert _images()._stdcol_maps() is _images()._stdcol_maps()
+
+
+def test_index_follows_column_changes():
+    images = _images()
+    assert images.stdcol_to_colname(ImageColumn.RA) == 'ra'
+    images.rename_column('ra', 'ra_deg')
+    assert images.stdcol_to_colname(ImageColumn.RA) == 'ra_deg'
+    images.remove_column('dec')
+    assert images[ImageColumn.DEC] is None
+    images['dec'] = [0., 1.]
+    images['dec'].meta['ucd'] = 'POS_EQ_DEC_MAIN'
+    assert list(images[ImageColumn.DEC]) == [0., 1.]
+    assert images[0][ImageColumn.DEC] == 0.
+
+    # A changed UCD keeps the column names; clear_array_cache() picks it up.
+    images['extra'].meta['ucd'] = 'VOX:Image_Title'
+    images.clear_array_cache()
+    assert images.stdcol_to_colname(ImageColumn.TITLE) == 'extra'
+
+    spectra = _table(SpectraTable, 'utype', [('url', 'ssa:Access.Reference')])
+    assert spectra.stdcol_to_colname(SpectraColumn.ACCESS_URL) == 'url'
+    spectra.rename_column('url', 'access')
+    assert spectra.stdcol_to_colname(SpectraColumn.ACCESS_URL) == 'access'
@@ -0,0 +1,68 @@
+import numpy as np
+from astropy.table import Table
+
+from navo_utils import utils
+from navo_utils.cone import ConeClass
+from navo_utils.cone_cache import ConeCache
+
+
+def _brute_force_find(cache, service, ra, dec, radius):
+    # The smallest live cone of the service containing the search, or the exact repeat.
+    best = None
+    for entry in cache._entries.values():
+        if entry.service != service:
+            continue
+        sep = utils.angular_separation(ra, dec, entry.ra, entry.dec)
+        if entry.ra_col is None:
+            usable = sep <= 1e-9 and abs(entry.radius - radius) <= 1e-9
+        else:
+            usable = sep + radius <= entry.radius + 1e-9
+        if usable and (best is None or entry.radius < best.radius):
+            best = entry
+    return best
+
+
+def test_lookups_match_a_scan_of_the_entries_through_eviction():
+    rng = np.random.default_rng(4)
+    cache = ConeCache(max_rows=60)
+    with_radec = Table({'ra': [0.], 'dec': [0.]})
+    without_radec = Table({'x': [0.]})
+    for step in range(400):
+        service = 'http://s{}/cone'.format(step % 2)
+        ra, dec = rng.uniform(10., 11.), rng.uniform(-1., 0.)
+        cache.store(service, ra, dec, rng.uniform(0.05, 0.5), with_radec if step % 5 else without_radec)
+        for _ in range(3):
+            ra, dec, radius = rng.uniform(10., 11.), rng.uniform(-1., 0.), rng.uniform(0.01, 0.2)
+            assert cache._find(service, ra, dec, radius) is _brute_force_find(cache, service, ra, dec, radius)
+        entry = next(reversed(cache._entries.values()))
+        assert cache._find(entry.service, entry.ra, entry.dec, entry.radius) is entry
+    assert cache.stats()['entries'] == 60
+    assert cache._find('http://other/cone', 10.5, -0.5, 0.01) is None
+
+
+def test_lookup_cuts_the_cached_rows(catalog):
+    cone = ConeClass()
+    cache = cone.use_cone_cache(widen=4.)
+    ra, dec = catalog.ra[10], catalog.dec[10]
+    first = cone.query(catalog.url, (ra, dec), 0.05)[0]
+    assert sorted(first['id']) == sorted(catalog.within(ra, dec, 0.05))
+    nearby = cone.query(catalog.url, (ra + 0.05, dec), 0.1)[0]
+    assert sorted(nearby['id']) == sorted(catalog.within(ra + 0.05, dec, 0.1))
+    assert catalog.cone_requests() == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_truncated_widened_fetch_is_repeated_at_the_requested_radius(catalog):
+    ra, dec = catalog.ra[1990], catalog.dec[1990]
+    catalog.maxrec = len(catalog.within(ra, dec, 0.05)) + 5
+    # The widened cone is cut short before some of the requested rows.
+    assert not set(catalog.within(ra, dec, 0.05)) <= set(catalog.within(ra, dec, 0.2)[:catalog.maxrec])
+
+    cone = ConeClass()
+    cache = cone.use_cone_cache(widen=4.)
+    result = cone.query(catalog.url, (ra, dec), 0.05)[0]
+    assert sorted(result['id']) == sorted(catalog.within(ra, dec, 0.05))
+    assert catalog.cone_requests() == 2
+    assert not utils.is_truncated(result)
+    # Only the complete result at the requested radius was kept.
+    assert [entry.radius for entry in cache._entries.values()] == [0.05]
@@ -0,0 +1,42 @@
+import numpy as np
+
+from navo_utils.cone import Cone
+
+
+def _positions(catalog, n, seed=5):
+    rng = np.random.default_rng(seed)
+    pick = rng.choice(len(catalog.id), n, replace=False)
+    # Half on sources, half off them.
+    return catalog.ra[pick] + rng.normal(0., 0.01, n), catalog.dec[pick] + rng.normal(0., 0.01, n)
+
+
+def _ids(results):
+    return [sorted(t['id'].tolist()) for t in results]
+
+
+def test_tap_upload_matches_cone_searches(catalog):
+    ra, dec = _positions(catalog, 20)
+    cones = Cone.query(catalog.url, (ra, dec), 0.05)
+    matches = Cone.query(catalog.url, (ra, dec), 0.05, tap=catalog.tap)
+    assert len(catalog.server.requests_for('/tap/sync')) == 1
+    assert _ids(matches) == _ids(cones)
+    assert sum(len(t) for t in matches) > 0
+    for i, table in enumerate(matches):
+        assert _ids([table]) == [sorted(catalog.within(ra[i], dec[i], 0.05).tolist())]
+        assert 'mag' in table.colnames
+
+
+def test_service_row_selects_tap(catalog):
+    service = {'access_url': catalog.url, 'tap_access_url': catalog.tap['access_url'], 'tap_table': 'cat'}
+    ra, dec = _positions(catalog, 5)
+    matches = Cone.query(service, (ra, dec), [0.02, 0.04, 0.06, 0.08, 0.1])
+    assert catalog.cone_requests() == 0
+    assert _ids(matches) == [sorted(catalog.within(r, d, sr).tolist())
+                             for r, d, sr in zip(ra, dec, [0.02, 0.04, 0.06, 0.08, 0.1])]
+
+
+def test_positions_without_matches_get_empty_tables(catalog):
+    matches = Cone.query(catalog.url, ([150., 10.], [2., 10.]), 0.05, tap=catalog.tap)
+    assert len(matches[0]) > 0
+    assert len(matches[1]) == 0 and 'id' in matches[1].colnames
+
@@ -0,0 +1,81 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.table import Column, Table
+
+from navo_utils import utils
+
+RA = [10.5, 200.25, 359.]
+DEC = [-30., 0.5, 89.]
+
+
+def _check(coords, ra=RA, dec=DEC):
+    got_ra, got_dec = utils.parse_coordinates_array(coords)
+    np.testing.assert_allclose(got_ra, ra, atol=1e-9)
+    np.testing.assert_allclose(got_dec, dec, atol=1e-9)
+
+
+@pytest.mark.parametrize('coords', [
+    (np.array(RA), np.array(DEC)),
+    (RA, DEC),
+    np.column_stack([RA, DEC]),
+    [(r, d) for r, d in zip(RA, DEC)],
+    [[r, d] for r, d in zip(RA, DEC)],
+    SkyCoord(RA, DEC, unit='deg'),
+    [SkyCoord(r, d, unit='deg') for r, d in zip(RA, DEC)],
+    ['{} {}'.format(r, d) for r, d in zip(RA, DEC)],
+    Table({'RA': RA, 'Dec': DEC}),
+    (np.radians(RA) * u.rad, np.radians(DEC) * u.rad),
+], ids=['arrays', 'lists', 'n_by_2', 'pairs', 'pair_lists', 'skycoord', 'skycoords', 'strings', 'table',
+        'quantities'])
+def test_forms_of_many_positions(coords):
+    _check(coords)
+
+
+def test_single_positions():
+    _check((RA[0], DEC[0]), RA[:1], DEC[:1])
+    _check(np.array([RA[0], DEC[0]]), RA[:1], DEC[:1])
+    _check(SkyCoord(RA[0], DEC[0], unit='deg'), RA[:1], DEC[:1])
+    _check('10.5 -30', RA[:1], DEC[:1])
+    _check('00h42m00s +41d00m00s', [10.5], [41.])
+
+
+def test_mixed_list():
+    coords = ['10.5 -30', (200.25, 0.5), SkyCoord(359., 89., unit='deg')]
+    _check(coords)
+
+
+def test_table_columns_found_by_ucd():
+    table = Table([Column(RA, name='x', meta={'ucd': 'pos.eq.ra;meta.main'}),
+                   Column(np.radians(DEC), name='y', unit='rad', meta={'ucd': 'pos.eq.dec;meta.main'})])
+    _check(table)
+
+
+def test_galactic_skycoord_is_converted_to_icrs():
+    c = SkyCoord(RA, DEC, unit='deg').galactic
+    _check(c)
+
+
+def test_bad_input():
+    with pytest.raises(AssertionError):
+        utils.parse_coordinates_array((RA, DEC[:2]))
+    with pytest.raises(AssertionError):
+        utils.parse_coordinates_array(Table({'a': [1.]}))
+
+
+def test_radius_forms():
+    np.testing.assert_allclose(utils.parse_radius_array(0.1, 3), [0.1] * 3)
+    np.testing.assert_allclose(utils.parse_radius_array('0.1', 2), [0.1] * 2)
+    np.testing.assert_allclose(utils.parse_radius_array(36 * u.arcsec, 2), [0.01] * 2)
+    np.testing.assert_allclose(utils.parse_radius_array([0.1, 0.2, 0.3], 3), [0.1, 0.2, 0.3])
+    np.testing.assert_allclose(utils.parse_radius_array([36 * u.arcsec, 0.2], 2), [0.01, 0.2])
+    with pytest.raises(AssertionError):
+        utils.parse_radius_array([0.1, 0.2], 3)
+
+
+def test_angular_separation():
+    np.testing.assert_allclose(utils.angular_separation(0., 0., [90., 180., 0.], [0., 0., 90.]), [90., 180., 90.])
+    c1, c2 = SkyCoord(RA, DEC, unit='deg'), SkyCoord(np.add(RA, 0.3), np.subtract(DEC, 0.2), unit='deg')
+    np.testing.assert_allclose(utils.angular_separation(RA, DEC, np.add(RA, 0.3), np.subtract(DEC, 0.2)),
+                               c1.separation(c2).deg, atol=1e-10)
@@ -0,0 +1,143 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import Cutout2D
+from astropy.table import Table
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+from navo_utils.cutout import Cutouts, cutout_local, cutout_remote, plan_cutouts
+from navo_utils.image_table import ImageTable
+
+CENTER = (150., 2.)
+SCALE = 1. / 3600.
+RA = np.array([150., 150.02, 149.97, 150. + 180 * SCALE, 151.])
+DEC = np.array([2., 1.99, 2.03, 2. + 140 * SCALE, 2.])
+SIZE = 0.01
+
+
+def _wcs(shape):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = CENTER
+    wcs.wcs.crpix = [shape[1] / 2., shape[0] / 2.]
+    wcs.wcs.cdelt = [-SCALE, SCALE]
+    return wcs
+
+
+def _write_image(path, shape=(300, 400), planes=None, seed=0):
+    """A scaled int16 image (or cube, with planes leading planes) about CENTER; returns the physical pixels."""
+    rng = np.random.default_rng(seed)
+    full = shape if planes is None else (planes,) + shape
+    physical = np.round(rng.uniform(-100., 100., full), 2)
+    header = _wcs(shape).to_header()
+    if planes is not None:
+        header['CTYPE3'] = 'FREQ'
+    hdu = fits.PrimaryHDU(physical.copy(), header=header)
+    hdu.scale('int16', bscale=0.01, bzero=5.)
+    hdu.writeto(path)
+    return fits.getdata(path)
+
+
+def _expected(image, ra, dec):
+    wcs = _wcs(image.shape[-2:])
+    x, y = wcs.world_to_pixel_values(ra, dec)
+    scales = proj_plane_pixel_scales(wcs)
+    shape = (max(int(np.round(SIZE / scales[1])), 1), max(int(np.round(SIZE / scales[0])), 1))
+    plane = image[(0,) * (image.ndim - 2)]
+    try:
+        return Cutout2D(plane, (float(x), float(y)), shape, wcs=wcs, mode='trim')
+    except Exception:
+        return None
+
+
+def _check(cutouts, image):
+    assert isinstance(cutouts, Cutouts) and not cutouts.errors
+    for i, hdus in enumerate(cutouts):
+        expected = _expected(image, RA[i], DEC[i])
+        if expected is None:
+            assert hdus == []
+            continue
+        assert len(hdus) == 1
+        assert hdus[0].data.dtype == np.float32
+        np.testing.assert_array_equal(hdus[0].data, expected.data)
+        np.testing.assert_allclose(WCS(hdus[0].header).wcs.crpix, expected.wcs.wcs.crpix)
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    path = str(tmp_path / 'image.fits')
+    return path, _write_image(path)
+
+
+def test_remote_cutouts_match_astropy(http_server, image_file):
+    path, image = image_file
+    http_server.routes['/image.fits'] = open(path, 'rb').read()
+    url = http_server.url('/image.fits')
+    cutouts = cutout_remote([(i, url) for i in range(len(RA))], (RA, DEC), SIZE, max_workers=2)
+    _check(cutouts, image)
+    assert cutouts[4] == [] and cutouts[3][0].data.shape != cutouts[0][0].data.shape
+    assert cutouts[0][0].header['ORIGURL'] == url
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_local_cutouts_match_astropy(image_file, processes):
+    path, image = image_file
+    cutouts = cutout_local([(i, path) for i in range(len(RA))], (RA, DEC), SIZE, processes=processes)
+    _check(cutouts, image)
+    assert cutouts[0][0].header['ORIGFILE'] == 'image.fits'
+
+
+def test_cutouts_of_cubes_take_the_first_plane(http_server, tmp_path):
+    path = str(tmp_path / 'cube.fits')
+    cube = _write_image(path, planes=3)
+    http_server.routes['/cube.fits'] = open(path, 'rb').read()
+    _check(cutout_local([(i, path) for i in range(len(RA))], (RA, DEC), SIZE, processes=0), cube)
+    _check(cutout_remote([(i, http_server.url('/cube.fits')) for i in range(len(RA))], (RA, DEC), SIZE), cube)
+
+
+def test_failures_are_returned(http_server, image_file, tmp_path):
+    path, image = image_file
+    http_server.routes['/image.fits'] = open(path, 'rb').read()
+    no_wcs = str(tmp_path / 'no_wcs.fits')
+    fits.PrimaryHDU(np.zeros((10, 10), dtype=np.int16)).writeto(no_wcs)
+    http_server.routes['/no_wcs.fits'] = open(no_wcs, 'rb').read()
+
+    good, missing, bad = (http_server.url(p) for p in ('/image.fits', '/missing.fits', '/no_wcs.fits'))
+    cutouts = cutout_remote([(0, good), (0, missing), (1, bad), (1, good)], (RA[:2], DEC[:2]), SIZE, retries=1)
+    assert [len(c) for c in cutouts] == [1, 1]
+    assert set(cutouts.errors) == {missing, bad}
+    assert 'celestial' in cutouts.errors[bad]
+
+    missing_path = str(tmp_path / 'missing.fits')
+    cutouts = cutout_local([(0, missing_path), (0, path), (1, no_wcs)], (RA[:2], DEC[:2]), SIZE, processes=0)
+    assert [len(c) for c in cutouts] == [1, 0]
+    assert set(cutouts.errors) == {missing_path, no_wcs}
+
+
+def test_local_cutouts_read_only_their_pixels(tmp_path):
+    path = str(tmp_path / 'large.fits')
+    _write_image(path, shape=(2000, 2000))
+    tracemalloc.start()
+    try:
+        cutouts = cutout_local([(0, path)], (RA[:1], DEC[:1]), SIZE, processes=0)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert cutouts[0][0].data.shape == (36, 36)
+    # The whole image, scaled to float32, would take 16 MB.
+    assert peak < 4 * 1024**2
+
+
+def test_plan_pairs_positions_with_fits_images():
+    table = Table()
+    table['url'] = ['http://x/a.fits?x=1&amp;y=2', 'http://x/b.jpg', 'http://x/c.fits']
+    table['url'].meta['ucd'] = 'VOX:Image_AccessReference'
+    table['format'] = ['image/fits', 'image/jpeg', 'image/fits']
+    table['format'].meta['ucd'] = 'VOX:Image_Format'
+    jobs = plan_cutouts([ImageTable(table), ImageTable(table[2:])], ([1., 2.], [3., 4.]))
+    assert jobs == [(0, 'http://x/a.fits?x=1&y=2'), (0, 'http://x/c.fits'), (1, 'http://x/c.fits')]
+    with pytest.raises(ValueError):
+        plan_cutouts([ImageTable(table)], ([1., 2.], [3., 4.]))
@@ -0,0 +1,229 @@
+import gzip
+import os
+import time
+
+import numpy as np
+
+from navo_utils.retry import RetryPolicy
+from workshop_utils.download import BulkDownloader
+
+
+def _content(n, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, n, dtype=np.uint8).tobytes()
+
+
+def _slow(content, pieces=10, delay=0.02):
+    def answer(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        step = -(-len(content) // pieces)
+        for i in range(0, len(content), step):
+            handler.wfile.write(content[i:i + step])
+            handler.wfile.flush()
+            time.sleep(delay)
+    return answer
+
+
+class _Recorded(RetryPolicy):
+    def __init__(self):
+        super().__init__()
+        self.attempts = []
+
+    def backoff(self, attempt, retry_after=None):
+        self.attempts.append(attempt)
+        return 0.01
+
+
+def _ranges(server, path):
+    return [headers.get('Range') for method, p, headers in server.requests_for(path)]
+
+
+def test_downloads_many_files(http_server, tmp_path):
+    files = {'/f{}.fits'.format(i): _content(1000 + i, seed=i) for i in range(6)}
+    http_server.routes.update(files)
+    downloader = BulkDownloader(str(tmp_path), max_workers=3)
+    results = downloader.download([http_server.url(p) for p in files])
+    assert [r.status for r in results] == ['downloaded'] * 6
+    for p, content in files.items():
+        assert (tmp_path / p[1:]).read_bytes() == content
+    assert downloader.bytes_received == sum(len(c) for c in files.values())
+    assert not list(tmp_path.glob('*.part'))
+
+    again = downloader.download([http_server.url(p) for p in files])
+    assert [r.status for r in again] == ['skipped'] * 6
+
+
+def test_resumes_from_a_part_file(http_server, tmp_path):
+    content = _content(10000)
+    http_server.routes['/a.fits'] = content
+    (tmp_path / 'a.fits.part').write_bytes(content[:4000])
+    result = BulkDownloader(str(tmp_path)).download_one(http_server.url('/a.fits'))
+    assert result.status == 'resumed' and result.nbytes == 6000
+    assert (tmp_path / 'a.fits').read_bytes() == content
+    assert _ranges(http_server, '/a.fits')[-1] == 'bytes=4000-'
+
+
+def test_complete_part_file_is_finished_without_a_transfer(http_server, tmp_path):
+    content = _content(5000)
+    http_server.routes['/a.fits'] = content
+    (tmp_path / 'a.fits.part').write_bytes(content)
+    result = BulkDownloader(str(tmp_path), retries=1).download_one(http_server.url('/a.fits'))
+    assert result.status == 'resumed' and result.nbytes == 0
+    assert (tmp_path / 'a.fits').read_bytes() == content
+
+
+def test_part_file_longer_than_the_file_is_restarted(http_server, tmp_path):
+    content = _content(5000)
+    http_server.routes['/a.fits'] = content
+    (tmp_path / 'a.fits.part').write_bytes(content + b'junk')
+    result = BulkDownloader(str(tmp_path), retries=1).download_one(http_server.url('/a.fits'))
+    assert result.status == 'downloaded'
+    assert (tmp_path / 'a.fits').read_bytes() == content
+
+
+def test_range_answered_from_the_wrong_offset_is_restarted(http_server, tmp_path):
+    content = _content(5000)
+
+    def answer(handler):
+        if handler.headers.get('Range'):
+            # A server that always answers ranges from byte 1000.
+            return handler.reply(206, content[1000:], {'Accept-Ranges': 'bytes',
+                                                       'Content-Range': 'bytes 1000-4999/5000'})
+        handler.reply(200, content, {'Accept-Ranges': 'bytes'})
+
+    http_server.routes['/a.fits'] = answer
+    (tmp_path / 'a.fits.part').write_bytes(content[:2000])
+    result = BulkDownloader(str(tmp_path), retries=1).download_one(http_server.url('/a.fits'))
+    assert result.status == 'downloaded'
+    assert (tmp_path / 'a.fits').read_bytes() == content
+
+
+def test_urls_with_the_same_output_name_do_not_collide(http_server, tmp_path):
+    content = _content(200000)
+    http_server.routes['/a/image.fits'] = _slow(content)
+    http_server.routes['/b/image.fits'] = _slow(content)
+    results = BulkDownloader(str(tmp_path), max_workers=2).download(
+        [http_server.url('/a/image.fits'), http_server.url('/b/image.fits')])
+    assert sorted(r.status for r in results) == ['downloaded', 'skipped']
+    assert (tmp_path / 'image.fits').read_bytes() == content
+    assert not list(tmp_path.glob('*.part'))
+
+
+def test_decompresses_gzip_files(http_server, tmp_path):
+    content = _content(20000)
+    packed = gzip.compress(content)
+    http_server.routes['/a.fits.gz'] = packed
+    (tmp_path / 'a.fits.part').write_bytes(packed[:len(packed) // 2])
+    result = BulkDownloader(str(tmp_path), decompress=True).download_one(http_server.url('/a.fits.gz'))
+    assert result.status == 'resumed'
+    assert (tmp_path / 'a.fits').read_bytes() == content
+    assert not os.path.exists(tmp_path / 'a.fits.part')
+
+
+def test_retries_back_off(http_server, tmp_path):
+    content = _content(100)
+    calls = []
+
+    def flaky(handler):
+        calls.append(1)
+        if len(calls) < 3:
+            return handler.reply(503)
+        handler.reply(200, content)
+
+    http_server.routes['/a.fits'] = flaky
+    policy = _Recorded()
+    result = BulkDownloader(str(tmp_path), retries=3, retry_policy=policy).download_one(http_server.url('/a.fits'))
+    assert result.status == 'downloaded'
+    assert policy.attempts == [1, 2]
+
+
+def test_failure_is_reported(http_server, tmp_path):
+    policy = _Recorded()
+    result = BulkDownloader(str(tmp_path), retries=3, retry_policy=policy).download_one(
+        http_server.url('/missing.fits'))
+    assert result.status == 'failed' and '404' in result.error
+    # A missing file is not asked for again.
+    assert len(http_server.requests_for('/missing.fits')) == 1 and policy.attempts == []
+
+    http_server.routes['/down.fits'] = lambda handler: handler.reply(503)
+    result = BulkDownloader(str(tmp_path), retries=3, retry_policy=policy).download_one(
+        http_server.url('/down.fits'))
+    assert result.status == 'failed' and '503' in result.error
+    assert len(http_server.requests_for('/down.fits')) == 3
+
+
+def test_malformed_content_length_fails_only_its_file(http_server, tmp_path):
+    content = _content(100)
+
+    def answer(length):
+        # The body ends with the connection, as the length can't be trusted.
+        def reply(handler):
+            handler.send_response(200)
+            handler.send_header('Content-Length', length)
+            handler.send_header('Connection', 'close')
+            handler.end_headers()
+            handler.wfile.write(content)
+            handler.close_connection = True
+        return reply
+
+    http_server.routes['/twice.fits'] = answer('100, 100')
+    http_server.routes['/bad.fits'] = answer('lots')
+    http_server.routes['/ok.fits'] = content
+    downloader = BulkDownloader(str(tmp_path), retries=1)
+    urls = [http_server.url(p) for p in ('/twice.fits', '/bad.fits', '/ok.fits')]
+    assert [r.status for r in downloader.download(urls)] == ['downloaded'] * 3
+    assert (tmp_path / 'bad.fits').read_bytes() == content
+
+    # A present file of the known size is skipped even if the header can't be read.
+    assert downloader.download_one(urls[1], size=100).status == 'skipped'
+    assert downloader.download_one(urls[0]).status == 'skipped'
+
+
+def _image_results(urls, sizes):
+    from astropy.table import MaskedColumn, Table
+    from navo_utils.image_table import ImageTable
+    table = Table()
+    table['access_url'] = urls
+    table['access_url'].meta['ucd'] = 'VOX:Image_AccessReference'
+    table['filesize'] = MaskedColumn([s or 0 for s in sizes], mask=[s is None for s in sizes])
+    table['filesize'].meta['ucd'] = 'VOX:Image_FileSize'
+    return ImageTable(table)
+
+
+def test_plan_balances_workers_on_estimates():
+    from workshop_utils.download import plan_downloads
+    urls = ['http://x/{}.fits'.format(i) for i in range(5)]
+    plan = plan_downloads(_image_results(urls, [4000, None, 1000, 3000, 4000]), workers=2)
+    entries = {url: (size, estimate) for queue in plan.queues for url, size, estimate in queue}
+    assert entries['http://x/1.fits'] == (None, 3500)
+    assert entries['http://x/2.fits'] == (1000, 1000)
+    assert sorted(plan.loads) == [7500, 8000]
+    assert sorted(plan.urls) == urls
+
+    budget = plan_downloads(_image_results(urls, [4000, None, 1000, 3000, 4000]), byte_budget=8000)
+    assert [url for url, size, estimate in budget.excluded] == ['http://x/2.fits', 'http://x/3.fits', 'http://x/4.fits']
+    assert budget.total_bytes == 7500
+
+
+def test_plan_does_not_pass_estimates_as_sizes(http_server, tmp_path):
+    from workshop_utils.download import plan_downloads
+    content = _content(1500)
+
+    def unsized(handler):
+        # No Content-Length: the size is only known once the transfer ends.
+        handler.send_response(200)
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.wfile.write(content)
+        handler.close_connection = True
+
+    http_server.routes['/known.fits'] = _content(2000, seed=1)
+    http_server.routes['/unknown.fits'] = unsized
+    urls = [http_server.url('/known.fits'), http_server.url('/unknown.fits')]
+    plan = plan_downloads(_image_results(urls, [2000, None]), workers=2)
+    # A stale copy that happens to be of the estimated size must not be taken as complete.
+    (tmp_path / 'unknown.fits').write_bytes(b'x' * 2000)
+    results = BulkDownloader(str(tmp_path)).download_plan(plan)
+    assert [r.status for r in results] == ['downloaded', 'downloaded']
+    assert (tmp_path / 'unknown.fits').read_bytes() == content
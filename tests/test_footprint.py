@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from navo_utils.footprint import FootprintIndex
+from navo_utils.image_table import ImageTable
+
+PROJECTIONS = ['TAN', 'SIN', 'ARC', 'ZEA', 'STG']
+
+
+def _images(n=60, seed=1):
+    rng = np.random.default_rng(seed)
+    centers = np.column_stack([rng.uniform(0., 360., n), rng.uniform(-60., 60., n)])
+    # Across RA 0 and near the poles.
+    special = [[359.99, 10.], [0.01, -10.], [180., 89.9], [90., -89.95]]
+    centers[:min(n, 4)] = special[:n]
+    naxis = rng.integers(50, 400, size=(n, 2)).astype(float)
+    scale = rng.uniform(1e-3, 5e-3, n)
+    angle = rng.uniform(0., 2 * np.pi, n)
+    cd = np.column_stack([-scale * np.cos(angle), scale * np.sin(angle), scale * np.sin(angle), scale * np.cos(angle)])
+    crpix = naxis * rng.uniform(0.2, 0.8, size=(n, 2))
+    projection = np.array([PROJECTIONS[i % len(PROJECTIONS)] for i in range(n)])
+    return centers, crpix, cd, naxis, projection
+
+
+def _wcs(crval, crpix, cd, projection):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---' + projection, 'DEC--' + projection]
+    wcs.wcs.crval = crval
+    wcs.wcs.crpix = crpix
+    wcs.wcs.cd = np.reshape(cd, (2, 2))
+    return wcs
+
+
+def _points(centers, naxis, cd, seed=2, per_image=30):
+    # Points scattered around each image, out to twice its size.
+    rng = np.random.default_rng(seed)
+    extent = np.max(naxis, axis=1) * np.sqrt(np.abs(cd[:, 0] * cd[:, 3] - cd[:, 1] * cd[:, 2]))
+    coords = []
+    for (ra, dec), size in zip(centers, extent):
+        offsets = rng.uniform(-size, size, size=(per_image, 2))
+        point = SkyCoord(ra * u.deg, dec * u.deg).spherical_offsets_by(offsets[:, 0] * u.deg, offsets[:, 1] * u.deg)
+        coords.append(np.column_stack([point.ra.deg, point.dec.deg]))
+    coords = np.concatenate(coords)
+    return coords[:, 0], coords[:, 1]
+
+
+def _expected_containment(centers, crpix, cd, naxis, projection, ra, dec):
+    inside, edge = [], []
+    for i in range(len(centers)):
+        px, py = _wcs(centers[i], crpix[i], cd[i], projection[i]).all_world2pix(ra, dec, 1)
+        margin = np.minimum.reduce([px - 0.5, naxis[i, 0] + 0.5 - px, py - 0.5, naxis[i, 1] + 0.5 - py])
+        inside.append(margin >= 0)
+        edge.append(np.abs(margin) < 1e-6)
+    return np.array(inside).T, np.array(edge).T
+
+
+def test_containment_matches_astropy_wcs():
+    centers, crpix, cd, naxis, projection = _images()
+    ra, dec = _points(centers, naxis, cd)
+    index = FootprintIndex(centers, crpix, cd, naxis, projection)
+    pos, img = index.contains(ra, dec)
+    found = np.zeros((len(ra), len(centers)), dtype=bool)
+    found[pos, img] = True
+    expected, edge = _expected_containment(centers, crpix, cd, naxis, projection, ra, dec)
+    assert np.array_equal(found[~edge], expected[~edge])
+    assert expected.sum() > len(centers)
+    assert np.all(np.diff(pos) >= 0)
+
+
+def test_overlap_matches_distance_to_the_footprint():
+    centers, crpix, cd, naxis, projection = _images(n=20)
+    ra, dec = _points(centers, naxis, cd, per_image=10)
+    radius = np.full(len(ra), 0.1)
+    index = FootprintIndex(centers, crpix, cd, naxis, projection)
+    pos, img = index.overlaps(ra, dec, radius)
+    found = np.zeros((len(ra), len(centers)), dtype=bool)
+    found[pos, img] = True
+
+    contained, edge = _expected_containment(centers, crpix, cd, naxis, projection, ra, dec)
+    points = SkyCoord(ra * u.deg, dec * u.deg)
+    by_radius = missed = 0
+    t = np.linspace(0., 1., 400)
+    for i in range(len(centers)):
+        # The footprint's edges, sampled finely enough for 1e-4 degree distances.
+        lo, (hx, hy) = 0.5, naxis[i] + 0.5
+        sx, sy = lo + (hx - lo) * t, lo + (hy - lo) * t
+        px = np.concatenate([sx, np.full_like(t, hx), sx, np.full_like(t, lo)])
+        py = np.concatenate([np.full_like(t, lo), sy, np.full_like(t, hy), sy])
+        bra, bdec = _wcs(centers[i], crpix[i], cd[i], projection[i]).all_pix2world(px, py, 1)
+        separation = points[:, np.newaxis].separation(SkyCoord(bra * u.deg, bdec * u.deg)[np.newaxis]).deg
+        distance = np.where(contained[:, i], 0., separation.min(axis=1))
+        clear = ~edge[:, i] & (np.abs(distance - radius) > 2e-3 * radius + 1e-4)
+        assert np.array_equal(found[clear, i], (distance <= radius)[clear])
+        by_radius += np.sum(clear & found[:, i] & ~contained[:, i])
+        missed += np.sum(clear & ~found[:, i])
+    assert by_radius > 0 and missed > 0
+
+
+def test_best_sampled_takes_the_finest_containing_image():
+    crval = [[10., 0.], [10., 0.], [10.1, 0.]]
+    cd = [[-1e-3, 0, 0, 1e-3], [-5e-4, 0, 0, 5e-4], [-1e-4, 0, 0, 1e-4]]
+    naxis = [[400, 400], [400, 400], [400, 400]]
+    crpix = [[200.5, 200.5]] * 3
+    index = FootprintIndex(crval, crpix, cd, naxis)
+    best = index.best_sampled([10., 10.15, 10.1, 50.], [0., 0., 0., 0.])
+    assert list(best) == [1, 0, 2, -1]
+
+
+def _table(centers, crpix, cd, naxis, projection):
+    table = Table()
+    for name, ucd, values in [('crval', 'VOX:WCS_CoordRefValue', centers), ('crpix', 'VOX:WCS_CoordRefPixel', crpix),
+                              ('cd', 'VOX:WCS_CDMatrix', cd), ('naxis', 'VOX:Image_Naxis', naxis)]:
+        table[name] = [' '.join(repr(float(v)) for v in row) for row in values]
+        table[name].meta['ucd'] = ucd
+    table['proj'] = projection
+    table['proj'].meta['ucd'] = 'VOX:WCS_CoordProjection'
+    return ImageTable(table)
+
+
+def test_table_queries_use_the_wcs_columns():
+    centers, crpix, cd, naxis, projection = _images(n=10)
+    table = _table(centers, crpix, cd, naxis, projection)
+    ra, dec = _points(centers, naxis, cd, per_image=5)
+    index = FootprintIndex(centers, crpix, cd, naxis, projection)
+    coords = SkyCoord(ra * u.deg, dec * u.deg)
+    for ours, direct in zip(table.contains(coords), index.contains(ra, dec)):
+        np.testing.assert_array_equal(ours, direct)
+    for ours, direct in zip(table.overlaps(coords, 0.05 * u.deg), index.overlaps(ra, dec, np.full(len(ra), 0.05))):
+        np.testing.assert_array_equal(ours, direct)
+    assert table.footprint_index() is table.footprint_index()
+
+
+@pytest.mark.parametrize('missing', ['cd', 'naxis', 'crval'])
+def test_images_without_geometry_never_match(missing):
+    centers, crpix, cd, naxis, projection = _images(n=4)
+    table = _table(centers, crpix, cd, naxis, projection)
+    table[missing][1] = ''
+    pos, img = table.contains(SkyCoord(centers[:, 0] * u.deg, centers[:, 1] * u.deg))
+    assert 1 not in img
+    assert {0, 2, 3} <= set(img)
@@ -0,0 +1,60 @@
+import io
+
+import numpy as np
+from astropy.table import MaskedColumn, Table
+
+from navo_utils.image import ImageColumn
+from navo_utils.image_table import ImageTable
+
+
+def _parse_row(value):
+    if isinstance(value, np.ndarray):
+        return np.ravel(value).astype(float)
+    return np.array(str(value).split(), dtype=float)
+
+
+def test_arrays_match_row_by_row_parsing(votable):
+    table = ImageTable(Table.read(io.BytesIO(votable('image', rows=40, columns=0)), format='votable'))
+    for mnemonic, array in [(ImageColumn.NAXIS, table.naxis_array()), (ImageColumn.CRPIX, table.crpix_array()),
+                            (ImageColumn.CRVAL, table.crval_array()), (ImageColumn.CDMATRIX, table.cdmatrix_array())]:
+        expected = np.array([_parse_row(row[mnemonic]) for row in table])
+        np.testing.assert_array_equal(array, expected)
+    assert table.naxis_array().dtype.kind == 'i'
+    assert table.cdmatrix_array().shape == (40, 4)
+    ra, dec = table.radec_arrays()
+    np.testing.assert_array_equal(ra, [float(row[ImageColumn.RA]) for row in table])
+    assert dec.dtype == float and dec.shape == (40,)
+
+
+def _string_table():
+    table = Table()
+    table['naxis'] = MaskedColumn(['100 200', ' 300  400 ', '5 6 7', 'abc', '', '8 9'],
+                                  mask=[False, False, False, False, False, True])
+    table['naxis'].meta['ucd'] = 'VOX:Image_Naxis'
+    table['scale'] = np.array([b'0.1 0.2', b'0.3 0.4', b'0.5 0.6', b'0.7 0.8', b'0.9 1.0', b'1.1 1.2'])
+    table['scale'].meta['ucd'] = 'VOX:Image_Scale'
+    table['ra'] = ['10.5', '11', '', 'x', '12', '13']
+    table['ra'].meta['ucd'] = 'POS_EQ_RA_MAIN'
+    return ImageTable(table)
+
+
+def test_irregular_entries_are_nan():
+    table = _string_table()
+    nan = np.nan
+    np.testing.assert_array_equal(table.get_array(ImageColumn.NAXIS, width=2),
+                                  [[100, 200], [300, 400], [5, 6], [nan, nan], [nan, nan], [nan, nan]])
+    np.testing.assert_array_equal(table.naxis_array(), [[100, 200], [300, 400], [5, 6], [0, 0], [0, 0], [0, 0]])
+    np.testing.assert_array_equal(table.scale_array()[:, 1], [0.2, 0.4, 0.6, 0.8, 1.0, 1.2])
+    np.testing.assert_array_equal(table.get_array(ImageColumn.RA), [10.5, 11, nan, nan, 12, 13])
+    assert table.get_array(ImageColumn.DEC) is None
+    assert table.cdmatrix_array() is None
+
+
+def test_arrays_are_cached_until_cleared():
+    table = _string_table()
+    scale = table.scale_array()
+    assert table.scale_array() is scale
+    table['scale'][0] = b'2.0 3.0'
+    assert table.scale_array()[0, 0] == 0.1
+    table.clear_array_cache()
+    np.testing.assert_array_equal(table.scale_array()[0], [2.0, 3.0])
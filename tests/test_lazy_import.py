@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY = ['astroquery', 'astropy.table', 'astropy.coordinates', 'astropy.io.votable', 'IPython']
+
+
+def _loaded_after(statement):
+    # Runs statement in a fresh interpreter and returns the heavy modules it loaded.
+    script = 'import sys, json\n{}\nprint(json.dumps([m for m in {!r} if m in sys.modules]))'.format(statement, HEAVY)
+    completed = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, cwd=ROOT, timeout=60)
+    assert completed.returncode == 0, completed.stderr
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+@pytest.mark.parametrize('module', ['navo_utils', 'navo_utils.utils', 'navo_utils.cone', 'navo_utils.image',
+                                    'navo_utils.spectra', 'navo_utils.tap', 'navo_utils.registry',
+                                    'workshop_utils.download'])
+def test_import_loads_no_heavy_dependencies(module):
+    assert _loaded_after('import ' + module) == []
+
+
+def test_query_objects_load_on_first_use():
+    assert _loaded_after('import navo_utils; assert navo_utils.Cone.__class__.__name__ == "ConeClass"') == []
+    assert 'astropy.table' in _loaded_after('from navo_utils.image import ImageTable')
+
+
+def test_package_attributes():
+    import navo_utils
+    from navo_utils.cone import Cone
+    from navo_utils.image_table import ImageTable
+    from navo_utils.spectra_table import SpectraTable
+    from navo_utils import image, spectra
+
+    assert navo_utils.Cone is Cone
+    assert set(navo_utils.__all__) <= set(dir(navo_utils))
+    assert image.ImageTable is ImageTable and spectra.SpectraTable is SpectraTable
+    with pytest.raises(AttributeError):
+        navo_utils.Nothing
+    with pytest.raises(AttributeError):
+        image.Nothing
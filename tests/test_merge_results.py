@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from astropy.table import MaskedColumn, Table, vstack
+
+from navo_utils import utils
+from navo_utils.cone import Cone
+from navo_utils.image import Image
+from navo_utils.image_table import ImageTable
+
+
+def _stacked(results, ra, dec):
+    # What merging should give: the results vstacked, with the input columns in front.
+    parts = []
+    for i, result in enumerate(results):
+        if len(result.columns) == 0 or len(result) == 0:
+            continue
+        part = Table(result, copy=True)
+        part.add_column(np.full(len(part), i), name='input_index', index=0)
+        part.add_column(np.full(len(part), float(ra[i])), name='input_ra', index=1)
+        part.add_column(np.full(len(part), float(dec[i])), name='input_dec', index=2)
+        parts.append(part)
+    return vstack(parts, metadata_conflicts='silent')
+
+
+def _assert_same_rows(merged, expected):
+    assert merged.colnames == expected.colnames
+    assert len(merged) == len(expected)
+    for name in expected.colnames:
+        np.testing.assert_array_equal(np.ma.getmaskarray(merged[name]), np.ma.getmaskarray(expected[name]))
+        keep = ~np.ma.getmaskarray(expected[name])
+        np.testing.assert_array_equal(np.ma.getdata(merged[name])[keep], np.ma.getdata(expected[name])[keep])
+
+
+def _results():
+    first = Table({'id': [1, 2], 'mag': [10.5, 11.], 'name': ['a', 'bb']})
+    second = Table({'id': [3], 'name': ['cccc'], 'flag': [True]})
+    second['mag'] = MaskedColumn([12.], mask=[True])
+    failed = Table()
+    failed.meta['error'] = "ValueError('bad position')"
+    third = Table({'id': np.array([4, 5, 6], dtype=np.int16), 'mag': [1., 2., 3.], 'name': ['d', 'e', 'f']})
+    return [first, Table({'id': [], 'mag': [], 'name': []}), second, failed, third]
+
+
+def test_merge_matches_a_vstack():
+    results = _results()
+    ra, dec = np.arange(5.) * 10, np.arange(5.) - 2
+    merged = utils.merge_results(results, ra, dec)
+    _assert_same_rows(merged, _stacked(results, ra, dec))
+    assert list(merged['input_index']) == [0, 0, 2, 4, 4, 4]
+    assert merged['name'].dtype == np.dtype('<U4') and merged['id'].dtype == np.int64
+    assert list(merged['flag'].mask) == [True, True, False, True, True, True]
+    assert merged['input_ra'].unit == 'deg'
+    assert list(merged.meta['input_offsets']) == [0, 2, 2, 3, 3, 6]
+    assert merged.meta['errors'] == {3: "ValueError('bad position')"}
+
+
+def test_position_rows_and_group_view_match_group_by():
+    merged = utils.merge_results(_results(), np.zeros(5), np.zeros(5))
+    for i in range(7):
+        rows = utils.position_rows(merged, i)
+        assert list(rows['id']) == [v for j, v in zip(merged['input_index'], merged['id']) if j == i]
+    assert np.shares_memory(utils.position_rows(merged, 4)['mag'], merged['mag'])
+
+    view = utils.group_view(merged)
+    grouped = merged.group_by('input_index')
+    assert list(view.groups.keys['input_index']) == list(grouped.groups.keys['input_index']) == [0, 2, 4]
+    for ours, expected in zip(view.groups, grouped.groups):
+        assert list(ours['id']) == list(expected['id'])
+
+    # Without the offsets in meta they are found from input_index.
+    del merged.meta['input_offsets']
+    assert list(utils.position_rows(merged, 2)['id']) == [3]
+    with pytest.raises(ValueError):
+        utils.position_rows(merged[::-1], 0)
+
+
+def test_merged_cone_query(catalog):
+    indices = [10, 500, 1990]
+    ra = np.append(catalog.ra[indices], 10.)
+    dec = np.append(catalog.dec[indices], -60.)
+    results = Cone.query(catalog.url, (ra, dec), 0.05, max_workers=2)
+    assert len(results[3]) == 0
+    merged = Cone.query(catalog.url, (ra, dec), 0.05, max_workers=2, merge=True)
+    _assert_same_rows(merged, _stacked(results, ra, dec))
+    assert merged.meta['errors'] == {}
+    for i in range(4):
+        assert sorted(utils.position_rows(merged, i)['id']) == sorted(catalog.within(ra[i], dec[i], 0.05))
+
+
+def test_merged_image_query_is_an_image_table(standin):
+    url = standin.url('image', rows=3)
+    merged = Image.query(url, ([1., 2.], [3., 4.]), 0.01, merge=True)
+    assert isinstance(merged, ImageTable)
+    assert list(merged['input_index']) == [0, 0, 0, 1, 1, 1]
+    # The standard-column accessors work across all positions' rows.
+    ra, dec = merged.radec_arrays()
+    np.testing.assert_array_equal(ra, np.asarray(merged['ra'], dtype=float))
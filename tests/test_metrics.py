@@ -0,0 +1,105 @@
+import json
+import re
+
+import pytest
+
+from navo_utils import metrics, utils
+from navo_utils.cone import ConeClass
+from navo_utils.retry import RetryPolicy
+
+
+def test_query_records_its_phases(http_server, votable):
+    body = votable('cone', rows=5)
+    attempts = []
+
+    def answer(handler):
+        attempts.append(1)
+        handler.reply(503 if len(attempts) == 1 else 200, b'' if len(attempts) == 1 else body)
+
+    http_server.routes['/cone'] = answer
+    sink = metrics.add_sink(metrics.MemorySink())
+    url = http_server.url('/cone')
+    table = utils.query_votable(url, 'cone', get_params={'RA': 1., 'DEC': 2., 'SR': 0.1}, policy=RetryPolicy(backoff_base=0.001))
+
+    [record] = sink.records
+    assert (record['kind'], record['url'], record['host']) == ('cone', url, '127.0.0.1:{}'.format(
+        http_server.server_address[1]))
+    assert (record['method'], record['status'], record['retries']) == ('GET', 200, 1)
+    assert record['rows'] == len(table) == 5
+    assert record['bytes_received'] == len(body)
+    for phase in metrics.PHASES + ('total',):
+        assert record[phase] is not None and record[phase] >= 0
+    assert record['total'] >= record['parse']
+    assert record['error'] is None
+
+
+def test_query_loop_reports_each_query_and_the_batch(catalog):
+    sink = metrics.add_sink(metrics.MemorySink())
+    results = ConeClass().query(catalog.url, ([150., 150.1, 150.2], [2., 2., 2.]), 0.05, max_workers=2)
+    kinds = sorted(record['kind'] for record in sink.records)
+    assert kinds == ['cone', 'cone', 'cone', 'query_loop']
+    [batch] = [record for record in sink.records if record['kind'] == 'query_loop']
+    assert (batch['queries'], batch['errors'], batch['rows']) == (3, 0, sum(len(t) for t in results))
+
+    summary = sink.summary(by='kind')
+    assert summary['cone']['count'] == 3 and summary['cone']['errors'] == 0
+    assert set(summary['cone']['parse']) == {'mean', 'p50', 'p95', 'p99'}
+    assert [r['kind'] for r in sink.slowest(1)] == ['query_loop']
+
+
+def test_nothing_is_measured_without_sinks():
+    assert not metrics.active()
+    with metrics.span('cone', 'http://x/cone') as record:
+        assert record is None and metrics.current() is None
+
+
+def test_spans_record_errors_and_failing_sinks_are_skipped(capsys):
+    def broken(record):
+        raise RuntimeError('sink down')
+
+    metrics.add_sink(broken)
+    sink = metrics.add_sink(metrics.MemorySink())
+    with pytest.raises(ValueError):
+        with metrics.span('tap', 'http://x/tap') as record:
+            assert metrics.current() is record
+            raise ValueError('bad query')
+    assert 'ValueError' in sink.records[0]['error']
+    assert 'sink down' in capsys.readouterr().out
+    assert metrics.current() is None
+
+
+def _record(kind, status, total, **extra):
+    record = metrics.new_record(kind, 'http://svc.example/{}'.format(kind), 'GET')
+    record.update(status=status, total=total, bytes_received=100, bytes_sent=10, **extra)
+    return record
+
+
+def test_jsonl_sink(tmp_path):
+    path = str(tmp_path / 'metrics.jsonl')
+    sink = metrics.JsonlSink(path)
+    sink.emit(_record('cone', 200, 0.5))
+    sink.emit(_record('tap', 500, 1.5, retries=2))
+    lines = [json.loads(line) for line in open(path)]
+    assert [(r['kind'], r['status'], r['retries']) for r in lines] == [('cone', 200, 0), ('tap', 500, 2)]
+
+
+def test_prometheus_sink(tmp_path):
+    sink = metrics.PrometheusSink(buckets=(0.1, 1., 10.))
+    sink.emit(_record('cone', 200, 0.5, ttfb=0.05))
+    sink.emit(_record('cone', 200, 5., retries=1))
+    sink.emit(_record('query_loop', None, 6.))
+    text = sink.render()
+
+    assert 'navo_requests_total{kind="cone",host="svc.example",status="200"} 2' in text
+    assert 'navo_retries_total{kind="cone",host="svc.example"} 1' in text
+    assert 'navo_bytes_total{kind="cone",host="svc.example",direction="received"} 200' in text
+    assert 'kind="query_loop"' not in ''.join(line for line in text.splitlines() if '_requests_total{' in line)
+    buckets = [int(n) for n in re.findall(
+        r'navo_phase_seconds_bucket\{kind="cone",host="svc.example",phase="total",le="[^"]+"\} (\d+)', text)]
+    assert buckets == [0, 1, 2, 2]
+    assert 'navo_phase_seconds_sum{kind="cone",host="svc.example",phase="total"} 5.5' in text
+    assert 'navo_phase_seconds_count{kind="query_loop",host="svc.example",phase="total"} 1' in text
+
+    path = str(tmp_path / 'navo.prom')
+    sink.write(path)
+    assert open(path).read() == text
@@ -0,0 +1,97 @@
+import concurrent.futures
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from navo_utils import parse_pool
+from navo_utils.cone import Cone
+from vo_standin import KINDS
+
+VARIABLE_ARRAYS = b"""<?xml version="1.0" encoding="utf-8"?>
+<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+<RESOURCE type="results"><TABLE>
+<FIELD name="id" datatype="int"/>
+<FIELD name="flux" datatype="double" arraysize="*" unit="mJy"/>
+<FIELD name="counts" datatype="int" arraysize="*"/>
+<FIELD name="name" datatype="char" arraysize="*"/>
+<DATA><TABLEDATA>
+<TR><TD>1</TD><TD>1.5 2.5 3.5</TD><TD>1 2</TD><TD>alpha</TD></TR>
+<TR><TD>2</TD><TD></TD><TD>3</TD><TD></TD></TR>
+<TR><TD></TD><TD>NaN 4</TD><TD></TD><TD>gamma</TD></TR>
+</TABLEDATA></DATA>
+</TABLE></RESOURCE>
+</VOTABLE>
+"""
+
+
+@pytest.fixture(scope='module')
+def pool():
+    executor = parse_pool.enable(2)
+    yield executor
+    parse_pool.disable()
+    executor.shutdown()
+
+
+def _assert_same_table(ours, expected):
+    assert ours.colnames == expected.colnames
+    assert ours.masked == expected.masked
+    for name in expected.colnames:
+        a, b = ours[name], expected[name]
+        assert type(a) is type(b) and a.dtype == b.dtype and a.shape == b.shape
+        assert (a.unit, a.description, a.format, a.meta) == (b.unit, b.description, b.format, b.meta)
+        if hasattr(b, 'mask'):
+            np.testing.assert_array_equal(np.ma.getmaskarray(a), np.ma.getmaskarray(b))
+        for x, y in zip(a, b):
+            if isinstance(y, np.ndarray):
+                assert type(x) is type(y)
+                np.testing.assert_array_equal(np.ma.getmaskarray(x), np.ma.getmaskarray(y))
+                np.testing.assert_array_equal(np.ma.getdata(x), np.ma.getdata(y))
+            elif y is not np.ma.masked:
+                assert x == y or (x != x and y != y)
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_pool_parses_like_the_calling_thread(pool, votable, kind):
+    content = votable(kind, rows=20)
+    table, parse_time, stringify_time = parse_pool.parse(content)
+    expected = parse_pool._parse(content)[0]
+    _assert_same_table(table, expected)
+    assert table.meta == expected.meta
+    assert parse_time > 0 and stringify_time >= 0
+
+
+def test_variable_length_arrays_survive_the_trip(pool):
+    table = parse_pool.parse(VARIABLE_ARRAYS)[0]
+    expected = parse_pool._parse(VARIABLE_ARRAYS)[0]
+    _assert_same_table(table, expected)
+    # The in-process round trip packs the array cells into one flat array.
+    _assert_same_table(parse_pool._decode(parse_pool._encode(expected)), expected)
+    assert parse_pool._pack_cells(expected['flux'].data.data)[1] is not None
+
+
+def test_unparsable_content(pool):
+    assert parse_pool.parse(b'<html>not a votable</html>')[0] is None
+
+
+def test_queries_give_the_same_results_with_a_pool(pool, standin):
+    url = standin.url('cone', rows=6)
+    coords = ([1., 2., 3.], [4., 5., 6.])
+    pooled = Cone.query(url, coords, 0.01, max_workers=3)
+    parse_pool.disable()
+    try:
+        local = Cone.query(url, coords, 0.01, max_workers=3)
+    finally:
+        parse_pool.enable(executor=pool)
+    for a, b in zip(pooled, local):
+        _assert_same_table(a, b)
+        assert a.meta['url'] == b.meta['url']
+
+
+def test_given_pool_is_left_running():
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        assert parse_pool.enable(executor=executor) is executor
+        assert parse_pool.get_pool() is executor
+        parse_pool.disable()
+        assert parse_pool.get_pool() is None
+        assert executor.submit(abs, -1).result() == 1
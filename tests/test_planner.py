@@ -0,0 +1,79 @@
+import numpy as np
+from astropy.table import Table
+
+from navo_utils import planner, utils
+from navo_utils.cone import Cone
+
+
+def _clustered(catalog, n_clusters=6, per_cluster=5, spread=0.03, seed=7):
+    rng = np.random.default_rng(seed)
+    centers = rng.choice(len(catalog.id), n_clusters, replace=False)
+    ra = np.repeat(catalog.ra[centers], per_cluster) + rng.normal(0., spread, n_clusters * per_cluster)
+    dec = np.repeat(catalog.dec[centers], per_cluster) + rng.normal(0., spread, n_clusters * per_cluster)
+    return ra, dec
+
+
+def _check_plan(ra, dec, radius, groups, max_group_radius):
+    members = np.sort(np.concatenate([g.members for g in groups]))
+    assert np.array_equal(members, np.arange(len(ra)))
+    for g in groups:
+        sep = utils.angular_separation(g.ra, g.dec, ra[g.members], dec[g.members])
+        assert np.all(sep + radius[g.members] <= g.radius + 1e-9)
+        if len(g.members) > 1:
+            assert g.radius <= max_group_radius
+
+
+def test_plan_covers_every_position_once():
+    rng = np.random.default_rng(1)
+    ra = np.concatenate([rng.uniform(10., 10.2, 50), rng.uniform(0., 360., 20)])
+    dec = np.concatenate([rng.uniform(5., 5.2, 50), rng.uniform(-90., 90., 20)])
+    radius = rng.uniform(0.01, 0.03, len(ra))
+    groups = planner.plan_cone_groups(ra, dec, radius)
+    _check_plan(ra, dec, radius, groups, 4 * radius.max())
+    assert len(groups) < len(ra)
+    firsts = [g.members.min() for g in groups]
+    assert firsts == sorted(firsts)
+
+
+def test_plan_groups_across_ra_zero_and_the_pole():
+    ra = np.array([359.995, 0.005, 0., 120., 240.])
+    dec = np.array([0., 0., 0.003, 89.998, 89.998])
+    radius = np.full(5, 0.01)
+    _check_plan(ra, dec, radius, planner.plan_cone_groups(ra, dec, radius), 0.04)
+
+
+def test_split_group_result_by_distance():
+    ra, dec, radius = np.array([10., 10.02]), np.array([0., 0.]), np.array([0.015, 0.015])
+    group = planner.ConeGroup(10.01, 0., 0.025, np.array([0, 1]))
+    table = Table({'ra': [10., 10.01, 10.02, 10.5], 'dec': [0., 0., 0., 0.], 'id': [1, 2, 3, 4]})
+    first, second = planner.split_group_result(table, group, ra, dec, radius)
+    assert list(first['id']) == [1, 2] and list(second['id']) == [2, 3]
+    assert planner.split_group_result(Table({'x': [1]}), group, ra, dec, radius) is None
+    table.meta['truncated'] = True
+    assert planner.split_group_result(table, group, ra, dec, radius) is None
+
+
+def _ids(results):
+    return [sorted(t['id'].tolist()) for t in results]
+
+
+def test_coalesced_search_matches_separate_searches(catalog):
+    ra, dec = _clustered(catalog)
+    separate = Cone.query(catalog.url, (ra, dec), 0.05)
+    requests = catalog.cone_requests()
+    coalesced = Cone.query(catalog.url, (ra, dec), 0.05, coalesce=True, max_workers=4)
+    assert catalog.cone_requests() - requests < len(ra)
+    assert _ids(coalesced) == _ids(separate)
+
+
+def test_truncated_group_results_fall_back_to_separate_searches(catalog):
+    ra, dec = _clustered(catalog, per_cluster=8)
+    # The row limit is enough for each position's own cone, but not for the groups' cones.
+    catalog.maxrec = max(len(catalog.within(r, d, 0.05)) for r, d in zip(ra, dec))
+    separate = Cone.query(catalog.url, (ra, dec), 0.05)
+    assert not any(utils.is_truncated(t) for t in separate)
+
+    groups = planner.plan_cone_groups(ra, dec, np.full(len(ra), 0.05))
+    assert any(len(catalog.within(g.ra, g.dec, g.radius)) > catalog.maxrec for g in groups)
+    coalesced = Cone.query(catalog.url, (ra, dec), 0.05, coalesce=True)
+    assert _ids(coalesced) == _ids(separate)
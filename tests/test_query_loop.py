@@ -0,0 +1,118 @@
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+from astropy.table import Table
+
+from navo_utils import utils
+from navo_utils.cone import Cone
+
+SERVICE = {'access_url': 'http://127.0.0.1:1/unused'}
+
+
+def _echo(service, i, delay=0.):
+    time.sleep(delay)
+    if i < 0:
+        raise ValueError('bad position {}'.format(i))
+    return Table({'i': [i]})
+
+
+def test_query_loop_keeps_order_of_params():
+    params = [{'i': i, 'delay': 0.02 * (5 - i)} for i in range(5)]
+    for kwargs in ({}, {'max_workers': 5}):
+        results = utils.query_loop(_echo, SERVICE, params, **kwargs)
+        assert [t['i'][0] for t in results] == list(range(5))
+
+
+def test_query_loop_runs_concurrently():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def query(service, i):
+        with lock:
+            running.append(i)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(i)
+        return Table({'i': [i]})
+
+    utils.query_loop(query, SERVICE, [{'i': i} for i in range(8)], max_workers=4)
+    assert max(peak) == 4
+
+
+def test_query_loop_turns_exceptions_into_error_tables():
+    results = utils.query_loop(_echo, SERVICE, [{'i': 0}, {'i': -1}, {'i': 2}], max_workers=2)
+    assert len(results) == 3
+    assert len(results[1]) == 0 and 'bad position -1' in results[1].meta['error']
+    assert results[2]['i'][0] == 2
+
+
+def test_query_loop_leaves_given_executor_running():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        results = utils.query_loop(_echo, SERVICE, [{'i': i} for i in range(4)], executor=executor)
+        assert [t['i'][0] for t in results] == [0, 1, 2, 3]
+        assert executor.submit(lambda: 42).result() == 42
+
+
+def test_concurrent_cone_query_matches_serial(standin):
+    url = standin.url('cone', rows=7)
+    coords = (np.array([10., 20., 30.]), np.array([-10., 0., 10.]))
+    serial = Cone.query(url, coords, 0.01)
+    concurrent_ = Cone.query(url, coords, 0.01, max_workers=3)
+    assert len(serial) == len(concurrent_) == 3
+    for a, b in zip(serial, concurrent_):
+        assert len(a) == len(b) == 7
+        assert a.colnames == b.colnames
+        assert list(a['id']) == list(b['id'])
+
+
+def test_iter_query_loop_yields_in_completion_or_input_order():
+    params = [{'i': i, 'delay': 0.03 * (4 - i)} for i in range(4)]
+    pairs = list(utils.iter_query_loop(_echo, SERVICE, params, max_workers=4))
+    assert [j for j, _ in pairs] == [3, 2, 1, 0]
+    assert all(t['i'][0] == j for j, t in pairs)
+    for kwargs in ({}, {'max_workers': 4}):
+        pairs = list(utils.iter_query_loop(_echo, SERVICE, params, ordered=True, **kwargs))
+        assert [(j, t['i'][0]) for j, t in pairs] == [(j, j) for j in range(4)]
+
+
+def test_closing_iter_query_loop_cancels_the_waiting_queries():
+    started = []
+
+    def query(service, i):
+        started.append(i)
+        time.sleep(0.05)
+        return Table({'i': [i]})
+
+    results = utils.iter_query_loop(query, SERVICE, [{'i': i} for i in range(8)], max_workers=2)
+    assert next(results)[1]['i'][0] in (0, 1)
+    results.close()
+    assert len(started) < 8
+
+
+def test_iter_in_order():
+    assert list(utils.iter_in_order([(2, 'c'), (0, 'a'), (3, 'd'), (1, 'b')])) == [
+        (0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')]
+
+
+def test_iter_query_gives_the_results_of_query(catalog, standin):
+    from navo_utils.image import Image
+
+    coords = (catalog.ra[[10, 500, 1990]], catalog.dec[[10, 500, 1990]])
+    expected = Cone.query(catalog.url, coords, 0.05)
+    for kwargs in ({}, {'max_workers': 3}, {'max_workers': 3, 'ordered': True}, {'coalesce': True}):
+        pairs = list(Cone.iter_query(catalog.url, coords, 0.05, **kwargs))
+        if kwargs.get('ordered'):
+            assert [j for j, _ in pairs] == [0, 1, 2]
+        assert sorted(j for j, _ in pairs) == [0, 1, 2]
+        for j, table in pairs:
+            assert sorted(table['id']) == sorted(expected[j]['id'])
+
+    url = standin.url('image', rows=4)
+    pairs = sorted(Image.iter_query(url, ([1., 2.], [3., 4.]), 0.01, max_workers=2), key=lambda pair: pair[0])
+    expected = Image.query(url, ([1., 2.], [3., 4.]), 0.01)
+    assert [type(t) for _, t in pairs] == [type(t) for t in expected]
+    assert [list(t['title']) for _, t in pairs] == [list(t['title']) for t in expected]
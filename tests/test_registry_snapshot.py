@@ -0,0 +1,93 @@
+import re
+import urllib.parse
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pytest
+from astropy.table import MaskedColumn
+
+from navo_utils.registry import RegistryClass
+from navo_utils.registry_snapshot import SNAPSHOT_TABLES, RegistrySnapshot
+
+# Registry content, per RegTAP table; None is a NULL.
+CONTENT = {
+    'capability': [
+        ('ivo://a/sia', 1, 'vs:simpleimageaccess', 'ivo://ivoa.net/std/sia'),
+        ('ivo://b/cone', 1, 'vs:conesearch', 'ivo://ivoa.net/std/conesearch'),
+        ('ivo://c/sia', 1, 'vs:simpleimageaccess', 'ivo://ivoa.net/std/sia'),
+    ],
+    'resource': [
+        ('ivo://a/sia', 'A', 'Galaxy images', 'Images of galaxies', 'http://a', 'optical', '2020-01-01'),
+        ('ivo://b/cone', 'B', 'Star catalog', 'Stars', 'http://b', 'infrared', '2020-01-02'),
+        ('ivo://c/sia', 'C', 'Nebula images', 'Images of nebulae', None, None, '2020-01-03'),
+    ],
+    'interface': [
+        ('ivo://a/sia', 1, 1, 'http://a/sia?'),
+        ('ivo://b/cone', 1, 1, 'http://b/cone?'),
+        ('ivo://c/sia', 1, 1, 'http://c/sia?'),
+    ],
+    'res_role': [
+        ('ivo://a/sia', 'Archive A', 'publisher'),
+        ('ivo://b/cone', 'Archive B', 'publisher'),
+        ('ivo://c/sia', 'Archive A', 'publisher'),
+    ],
+}
+
+_INTEGER_COLUMNS = {'cap_index', 'intf_index'}
+
+
+def _votable(table):
+    columns = SNAPSHOT_TABLES[table]
+    fields = ''.join('<FIELD name="{}" datatype="{}" {}/>'.format(
+        name, 'int' if name in _INTEGER_COLUMNS else 'char', '' if name in _INTEGER_COLUMNS else 'arraysize="*"')
+        for name in columns)
+    rows = ''.join('<TR>{}</TR>'.format(''.join('<TD>{}</TD>'.format('' if v is None else escape(str(v)))
+                                               for v in row)) for row in CONTENT[table])
+    return ('<?xml version="1.0"?><VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">'
+            '<RESOURCE type="results"><INFO name="QUERY_STATUS" value="OK"/><TABLE>{}<DATA><TABLEDATA>{}'
+            '</TABLEDATA></DATA></TABLE></RESOURCE></VOTABLE>'.format(fields, rows)).encode()
+
+
+@pytest.fixture
+def snapshot(http_server, tmp_path):
+    def answer(handler):
+        adql = urllib.parse.parse_qs(handler.body.decode())['query'][0]
+        table = re.search(r'from rr\.(\w+)', adql).group(1)
+        handler.reply(200, _votable(table), {'Content-Type': 'text/xml'})
+
+    http_server.routes['/regtap/sync'] = answer
+    snapshot = RegistrySnapshot(str(tmp_path / 'registry.sqlite'), tap_sync_url=http_server.url('/regtap/sync'))
+    snapshot.refresh()
+    yield snapshot
+    snapshot.close()
+
+
+def test_snapshot_answers_registry_queries(snapshot):
+    registry = RegistryClass()
+    registry._snapshot = snapshot
+    images = registry.query(service_type='image', order_by='short_name')
+    assert list(images['short_name']) == ['A', 'C']
+    assert list(images['access_url']) == ['http://a/sia?', 'http://c/sia?']
+    assert list(registry.query(service_type='image', keyword='nebula')['short_name']) == ['C']
+    assert list(registry.query(service_type='cone', waveband='infrared')['short_name']) == ['B']
+
+    counts = registry.query_counts('publisher')
+    assert list(counts['publisher']) == ['Archive A', 'Archive B']
+    assert list(counts['count_publisher']) == [2, 1]
+
+
+def test_snapshot_columns_are_typed_and_masked(snapshot):
+    table = snapshot.query('select short_name, waveband, reference_url, cap_index from rr.resource '
+                           'natural join rr.capability order by short_name')
+    assert all(isinstance(col, MaskedColumn) for col in table.itercols())
+    assert table['short_name'].dtype.kind == 'U'
+    assert table['cap_index'].dtype == np.int64
+    assert list(table['waveband'].mask) == [False, False, True]
+    assert list(table['reference_url'].mask) == [False, False, True]
+    assert list(table['waveband'].filled('')) == ['optical', 'infrared', '']
+    assert table['waveband'].astype(str)[0] == 'optical'
+
+
+def test_empty_snapshot_result_has_columns(snapshot):
+    table = snapshot.query("select short_name from rr.resource where short_name = 'none'")
+    assert table.colnames == ['short_name'] and len(table) == 0
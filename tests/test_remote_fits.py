@@ -0,0 +1,110 @@
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from navo_utils.remote_fits import RemoteFits
+
+SLICES = [(), (slice(None), slice(None)), (slice(3, 9), slice(2, 25, 3)), (5,), (-1, slice(None, None, -2)),
+          (slice(None, None, 4), 7), (slice(0, 0),)]
+
+
+def _fits_file():
+    rng = np.random.default_rng(0)
+    physical = rng.uniform(-100., 100., (20, 30))
+    primary = fits.PrimaryHDU(physical.copy())
+    primary.scale('int16', bscale=0.01, bzero=5.)
+    scaled32 = fits.ImageHDU(physical.copy(), name='SCALED32')
+    scaled32.scale('int32', bscale=1e-4, bzero=-3.)
+    hdus = [primary, scaled32,
+            fits.ImageHDU(rng.integers(0, 2**16, (20, 30)).astype(np.uint16), name='UINT16'),
+            fits.ImageHDU(rng.integers(-128, 128, (20, 30)).astype(np.int8), name='INT8'),
+            fits.ImageHDU(rng.integers(0, 2**32, (20, 30)).astype(np.uint32), name='UINT32'),
+            fits.ImageHDU(rng.normal(size=(4, 20, 30)).astype(np.float32), name='CUBE'),
+            fits.ImageHDU(rng.integers(-1000, 1000, (20, 30)).astype(np.int16), name='INT16'),
+            fits.BinTableHDU.from_columns([fits.Column('a', 'E', array=np.arange(5.))], name='TABLE')]
+    out = io.BytesIO()
+    fits.HDUList(hdus).writeto(out)
+    return out.getvalue()
+
+
+@pytest.fixture(scope='module')
+def fits_bytes():
+    return _fits_file()
+
+
+@pytest.fixture
+def remote(http_server, fits_bytes):
+    http_server.routes['/image.fits'] = fits_bytes
+    return RemoteFits(http_server.url('/image.fits'), block_size=2880)
+
+
+def test_hdus_match_astropy(remote, fits_bytes):
+    reference = fits.open(io.BytesIO(fits_bytes))
+    assert len(remote) == len(reference)
+    for i, hdu in enumerate(reference):
+        assert remote.header(i) == hdu.header
+        ours = remote.read_hdu(i)
+        assert type(ours) is type(hdu)
+        if hdu.is_image:
+            assert ours.data.dtype == hdu.data.dtype
+            np.testing.assert_array_equal(ours.data, hdu.data)
+        else:
+            np.testing.assert_array_equal(ours.data['a'], hdu.data['a'])
+    assert remote.index_of('UINT16') == 2
+    assert remote.index_of(('CUBE', 1)) == 5
+
+
+@pytest.mark.parametrize('ext', ['PRIMARY', 'SCALED32', 'UINT16', 'INT8', 'UINT32', 'INT16'])
+@pytest.mark.parametrize('slices', SLICES)
+def test_sections_match_astropy(remote, fits_bytes, ext, slices):
+    reference = fits.open(io.BytesIO(fits_bytes))[ext if ext != 'PRIMARY' else 0]
+    ours = remote.section(ext if ext != 'PRIMARY' else 0, slices)
+    expected = reference.data[slices]
+    # Unscaled data come in native byte order rather than as stored.
+    assert ours.dtype == expected.dtype.newbyteorder('=')
+    np.testing.assert_array_equal(ours, expected)
+
+
+def test_cube_sections_read_only_their_bytes(remote, fits_bytes):
+    expected = fits.open(io.BytesIO(fits_bytes))['CUBE'].section[2, 5:7, 10:20]
+    np.testing.assert_array_equal(remote.section('CUBE', (2, slice(5, 7), slice(10, 20))), expected)
+    assert remote.range_supported
+    assert remote.bytes_fetched < len(fits_bytes) / 2
+
+
+def test_server_without_range_support(http_server, fits_bytes):
+    http_server.routes['/image.fits'] = lambda handler: handler.reply(200, fits_bytes)
+    remote = RemoteFits(http_server.url('/image.fits'))
+    reference = fits.open(io.BytesIO(fits_bytes))
+    np.testing.assert_array_equal(remote.section('SCALED32', (slice(2, 4),)), reference['SCALED32'].data[2:4])
+    np.testing.assert_array_equal(remote.read_hdu('UINT16').data, reference['UINT16'].data)
+    assert remote.range_supported is False
+    assert remote.requests == 1
+
+
+@pytest.mark.parametrize('answer', ['from_start', 'no_content_range', 'short'])
+def test_server_answering_other_ranges(http_server, fits_bytes, answer):
+    import re
+
+    def reply(handler):
+        match = re.match(r'bytes=(\d+)-(\d+)$', handler.headers.get('Range', ''))
+        if match is None:
+            return handler.reply(200, fits_bytes)
+        start, end = int(match.group(1)), min(int(match.group(2)), len(fits_bytes) - 1)
+        if answer == 'from_start':
+            # The right length, but from the wrong offset.
+            start, end = 0, end - start
+        elif answer == 'short':
+            end = start + (end - start) // 2
+        headers = {} if answer == 'no_content_range' else {
+            'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(fits_bytes))}
+        handler.reply(206, fits_bytes[start:end + 1], headers)
+
+    http_server.routes['/image.fits'] = reply
+    remote = RemoteFits(http_server.url('/image.fits'), block_size=2880)
+    reference = fits.open(io.BytesIO(fits_bytes))
+    assert remote.header('UINT16') == reference['UINT16'].header
+    np.testing.assert_array_equal(remote.section('INT16', (slice(3, 9),)), reference['INT16'].data[3:9])
+    assert remote.range_supported is False
@@ -0,0 +1,226 @@
+import time
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from navo_utils import retry
+from navo_utils.retry import CircuitOpenError, RetryPolicy
+
+
+class _Adapter(HTTPAdapter):
+    """Sends requests normally unless told to raise an exception instead."""
+
+    def __init__(self):
+        super().__init__()
+        self.exception = None
+        self.sends = 0
+
+    def send(self, request, **kwargs):
+        self.sends += 1
+        if self.exception is not None:
+            raise self.exception
+        return super().send(request, **kwargs)
+
+
+@pytest.fixture
+def session():
+    session = requests.Session()
+    adapter = _Adapter()
+    session.mount('http://', adapter)
+    session.adapter = adapter
+    return session
+
+
+def _statuses(http_server, path, statuses):
+    statuses = list(statuses)
+    http_server.routes[path] = lambda handler: handler.reply(statuses.pop(0) if statuses else 200, b'ok')
+    return http_server.url(path)
+
+
+def test_backoff_is_jittered_up_to_the_doubling_limit():
+    policy = RetryPolicy(backoff_base=1., backoff_max=5.)
+    for attempt, limit in [(1, 1.), (2, 2.), (3, 4.), (6, 5.)]:
+        delays = [policy.backoff(attempt) for _ in range(200)]
+        assert 0 <= min(delays) and max(delays) <= limit and max(delays) > limit / 2
+    assert policy.backoff(1, retry_after=3.) >= 3.
+    assert policy.backoff(1, retry_after=100.) <= 5.
+
+
+def test_retried_statuses(http_server, session):
+    policy = RetryPolicy(backoff_base=0.001)
+    url = _statuses(http_server, '/flaky', [503, 429, 200])
+    assert retry.send(session, 'GET', url, retries=3, policy=policy).status_code == 200
+    url = _statuses(http_server, '/down', [503] * 5)
+    assert retry.send(session, 'GET', url, retries=2, policy=policy).status_code == 503
+    assert len(http_server.requests_for('/down')) == 2
+    url = _statuses(http_server, '/missing', [404, 200])
+    assert retry.send(session, 'GET', url, retries=3, policy=policy).status_code == 404
+
+
+def test_circuit_opens_and_a_trial_closes_it(http_server, session):
+    policy = RetryPolicy(breaker_threshold=2, breaker_reset=0.1)
+    url = _statuses(http_server, '/broken', [500, 500])
+    for _ in range(2):
+        assert retry.send(session, 'GET', url, retries=1, policy=policy).status_code == 500
+    with pytest.raises(CircuitOpenError):
+        retry.send(session, 'GET', url, retries=1, policy=policy)
+    assert len(http_server.requests_for('/broken')) == 2
+    assert retry.host_stats(url)[retry._host(url)]['circuit'] == 'open'
+
+    time.sleep(0.15)
+    assert retry.send(session, 'GET', url, retries=1, policy=policy).status_code == 200
+    assert retry.host_stats(url)[retry._host(url)]['circuit'] == 'closed'
+
+
+@pytest.mark.parametrize('exception', [requests.exceptions.ChunkedEncodingError('broken body'),
+                                       requests.exceptions.TooManyRedirects('loop'),
+                                       requests.exceptions.InvalidURL('bad'), RuntimeError('adapter bug')])
+def test_trial_ending_in_any_exception_lets_the_next_trial_through(http_server, session, exception):
+    policy = RetryPolicy(breaker_threshold=1, breaker_reset=0.1)
+    url = _statuses(http_server, '/broken', [500])
+    assert retry.send(session, 'GET', url, retries=1, policy=policy).status_code == 500
+
+    time.sleep(0.15)
+    session.adapter.exception = exception
+    with pytest.raises(type(exception)):
+        retry.send(session, 'GET', url, retries=3, policy=policy)
+    session.adapter.exception = None
+
+    if isinstance(exception, requests.exceptions.RequestException):
+        # A failed trial opens the circuit again for another breaker_reset.
+        with pytest.raises(CircuitOpenError):
+            retry.send(session, 'GET', url, retries=1, policy=policy)
+        time.sleep(0.15)
+    assert retry.send(session, 'GET', url, retries=1, policy=policy).status_code == 200
+
+
+def _slow(http_server, path, seconds):
+    def answer(handler):
+        time.sleep(seconds)
+        handler.reply(200, b'done')
+
+    http_server.routes[path] = answer
+    return http_server.url(path)
+
+
+def test_slow_query_after_many_fast_requests_to_the_host(http_server, session):
+    # E.g. a TAP /sync query after polling job phases on the same host.
+    poll = _statuses(http_server, '/async/1/phase', [])
+    query = _slow(http_server, '/sync', 0.6)
+    for policy in (RetryPolicy(), RetryPolicy(adaptive_timeout=True, min_timeout=0.2, min_samples=5)):
+        retry.reset_host_stats()
+        for _ in range(25):
+            assert retry.send(session, 'GET', poll, retries=1, policy=policy).status_code == 200
+        assert retry.send(session, 'GET', query, retries=1, timeout=5, policy=policy).text == 'done'
+
+
+def test_adaptive_timeout_follows_each_endpoint(http_server, session):
+    policy = RetryPolicy(adaptive_timeout=True, min_timeout=0.2, min_samples=5)
+    assert not RetryPolicy().adaptive_timeout
+    poll = _statuses(http_server, '/async/1/phase', [])
+    for _ in range(5):
+        retry.send(session, 'GET', poll, retries=1, policy=policy)
+    state = retry._host_state(poll)
+    assert policy.timeout_for(state, 60, 0, '/async/1/phase') == 0.2
+    assert policy.timeout_for(state, 60, 1, '/async/1/phase') == 0.4
+    assert policy.timeout_for(state, 60, 0, '/sync') == 60
+    assert RetryPolicy().timeout_for(state, 60, 0, '/async/1/phase') == 60
+
+    _slow(http_server, '/async/1/phase', 0.6)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        retry.send(session, 'GET', poll, retries=1, timeout=5, policy=policy)
+
+
+def test_endpoints_of_a_host_are_bounded(http_server, session, monkeypatch):
+    monkeypatch.setattr(retry, 'MAX_ENDPOINTS', 3)
+    for i in range(5):
+        retry.send(session, 'GET', _statuses(http_server, '/job/{}'.format(i), []), retries=1)
+    state = retry._host_state(http_server.url('/'))
+    assert list(state.endpoint_latencies) == ['/job/2', '/job/3', '/job/4']
+    assert len(state.latencies) == 5
+
+
+def _flaky_votable(http_server, path, body):
+    # Every other request is answered 503.
+    count = []
+
+    def answer(handler):
+        count.append(1)
+        handler.reply(503 if len(count) % 2 else 200, b'' if len(count) % 2 else body)
+
+    http_server.routes[path] = answer
+    return http_server.url(path)
+
+
+def test_verbose_queries_warn_of_retries(http_server, votable, capsys):
+    from navo_utils import utils
+    from navo_utils.cone import ConeClass
+    from navo_utils.tap import TapClass
+
+    url = _statuses(http_server, '/q', [503])
+    utils.try_query(url, get_params={}, policy=RetryPolicy(backoff_base=0.001))
+    assert 'WARNING' not in capsys.readouterr().out
+    url = _statuses(http_server, '/q2', [503])
+    utils.try_query(url, get_params={}, policy=RetryPolicy(backoff_base=0.001), verbose=True)
+    assert 'WARNING: HTTP 503 from 127.0.0.1' in capsys.readouterr().out
+
+    cone = ConeClass()
+    cone._RETRY_POLICY = RetryPolicy(backoff_base=0.001)
+    url = _flaky_votable(http_server, '/cone', votable('cone', rows=3))
+    assert len(cone.query(url, (1., 2.), 0.1, verbose=True)[0]) == 3
+    assert 'WARNING: HTTP 503' in capsys.readouterr().out
+
+    tap = TapClass()
+    tap._RETRY_POLICY = RetryPolicy(backoff_base=0.001)
+    _flaky_votable(http_server, '/tap/sync', votable('tap', rows=3))
+    assert len(tap.query(http_server.url('/tap'), 'SELECT * FROM t', verbose=True)) == 3
+    assert 'WARNING: HTTP 503' in capsys.readouterr().out
+
+
+def test_posts_are_not_resent_once_they_may_have_arrived(http_server, session):
+    policy = RetryPolicy(backoff_base=0.001, breaker_threshold=None)
+    url = _slow(http_server, '/async', 0.5)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        retry.send(session, 'POST', url, retries=3, timeout=0.2, policy=policy, data={'QUERY': 'q'})
+    assert len(http_server.requests_for('/async')) == 1
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        retry.send(session, 'POST', url, retries=3, timeout=0.2, policy=policy, idempotent=True)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        retry.send(session, 'GET', url, retries=2, timeout=0.2, policy=policy)
+    assert len(http_server.requests_for('/async')) == 6
+
+    url = _statuses(http_server, '/busy', [503])
+    assert retry.send(session, 'POST', url, retries=2, policy=policy).status_code == 200
+
+    for exception, sends in [(requests.exceptions.ConnectTimeout('connect'), 3),
+                             (requests.exceptions.ConnectionError('connection reset'), 1)]:
+        session.adapter.exception, session.adapter.sends = exception, 0
+        with pytest.raises(type(exception)):
+            retry.send(session, 'POST', url, retries=3, policy=policy)
+        assert session.adapter.sends == sends
+
+
+def test_refused_post_is_retried(session):
+    policy = RetryPolicy(backoff_base=0.001, breaker_threshold=None)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        retry.send(session, 'POST', 'http://127.0.0.1:1/async', retries=3, policy=policy)
+    assert session.adapter.sends == 3
+
+
+def test_job_submission_is_not_repeated_after_a_timeout(http_server):
+    from navo_utils.tap import TapClass
+
+    _slow(http_server, '/tap/async', 0.5)
+    tap = TapClass()
+    tap._TIMEOUT, tap._RETRIES = 0.2, 3
+    tap._RETRY_POLICY = RetryPolicy(backoff_base=0.001, breaker_threshold=None)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        tap.submit_job(http_server.url('/tap'), 'SELECT * FROM t')
+    assert len(http_server.requests_for('/tap/async')) == 1
+
+    _slow(http_server, '/tap/sync', 0.5)
+    # Synchronous queries are safe to resend.
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        tap.query(http_server.url('/tap'), 'SELECT * FROM t')
+    assert len(http_server.requests_for('/tap/sync')) == 3
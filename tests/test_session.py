@@ -0,0 +1,32 @@
+from navo_utils import utils
+
+
+def test_get_session_is_shared():
+    assert utils.get_session() is utils.get_session()
+
+
+def test_queries_reuse_one_connection(http_server):
+    clients = []
+
+    def answer(handler):
+        clients.append(handler.client_address)
+        handler.reply(200, b'ok')
+
+    http_server.routes['/q'] = answer
+    utils.configure_session()
+    for i in range(5):
+        assert utils.try_query(http_server.url('/q'), get_params={'i': i}).text == 'ok'
+    assert len(clients) == 5
+    assert len(set(clients)) == 1
+
+
+def test_configure_session_sets_headers(http_server):
+    http_server.routes['/q'] = lambda handler: handler.reply(200, b'ok')
+    try:
+        utils.configure_session(headers={'X-Workshop': 'yes'})
+        utils.try_query(http_server.url('/q'), get_params={})
+    finally:
+        utils.configure_session()
+    headers = http_server.requests_for('/q')[0][2]
+    assert headers['User-Agent'].startswith('navo_utils')
+    assert headers['X-Workshop'] == 'yes'
@@ -0,0 +1,45 @@
+import numpy as np
+from astropy.table import Column, MaskedColumn, Table
+
+from navo_utils import utils
+
+
+def test_decode_bytes_array():
+    values = np.array([b'abc', b'', b'xy'])
+    decoded = utils.decode_bytes_array(values)
+    assert decoded.dtype.kind == 'U'
+    assert list(decoded) == ['abc', '', 'xy']
+
+
+def test_decode_bytes_array_non_ascii():
+    values = np.array(['é'.encode(), b'a'], dtype=object)
+    assert list(utils.decode_bytes_array(values.astype(np.bytes_))) == ['é', 'a']
+
+
+def test_sval_whole_column_matches_sval():
+    values = np.array([b'one', b'two', 'thr\xe9e'.encode(), b''], dtype=object)
+    column = Column(values, name='c', unit='deg', description='text')
+    new = utils.sval_whole_column(column)
+    assert list(new) == [utils.sval(v) for v in values]
+    assert new.unit == 'deg' and new.description == 'text'
+
+
+def test_sval_whole_column_keeps_mask():
+    column = MaskedColumn([b'a', b'bb', b'c'], mask=[False, True, False], name='m')
+    new = utils.sval_whole_column(column)
+    assert list(new.mask) == [False, True, False]
+    assert new[0] == 'a' and new[2] == 'c'
+
+
+def test_sval_whole_column_keeps_unicode():
+    column = Column(np.array(['ab', 'é']), name='u')
+    assert list(utils.sval_whole_column(column)) == ['ab', 'é']
+
+
+def test_stringify_table_decodes_only_bytes_columns():
+    table = Table({'b': np.array([b'x', b'y']), 'n': [1.5, 2.5], 'u': ['p', 'q']})
+    utils.stringify_table(table)
+    assert list(table['b']) == ['x', 'y']
+    assert table['b'].dtype.kind == 'U'
+    assert table['n'].dtype.kind == 'f'
+    assert list(table['u']) == ['p', 'q']
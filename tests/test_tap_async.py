@@ -0,0 +1,102 @@
+import threading
+import time
+import urllib.parse
+
+from navo_utils.tap import AsyncJob, TapClass
+
+
+class UWSService:
+    """
+    A TAP /async endpoint whose job i, once run, reports EXECUTING for
+    polls[i] phase requests and then final[i] (None: runs forever).
+    """
+
+    def __init__(self, server, votable, polls, final):
+        self.server = server
+        self.polls = list(polls)
+        self.final = list(final)
+        self.phases = ['PENDING'] * len(polls)
+        self.aborted = set()
+        self.lock = threading.Lock()
+        self.result = votable('tap', rows=3)
+        self.url = server.url('/tap')
+        self.next_job = 0
+        server.routes['/tap/async'] = self.create
+        for i in range(len(polls)):
+            base = '/tap/async/{}'.format(i)
+            server.routes[base] = lambda handler: handler.reply(200, b'<uws:job/>')
+            server.routes[base + '/phase'] = lambda handler, i=i: self.phase(handler, i)
+            server.routes[base + '/error'] = lambda handler: handler.reply(200, b'query failed')
+            server.routes[base + '/results/result'] = lambda handler: handler.reply(200, self.result)
+
+    def create(self, handler):
+        with self.lock:
+            i = self.next_job
+            self.next_job += 1
+        handler.reply(303, headers={'Location': '/tap/async/{}'.format(i)})
+
+    def phase(self, handler, i):
+        with self.lock:
+            if handler.command == 'POST':
+                action = urllib.parse.parse_qs(handler.body.decode())['PHASE'][0]
+                if action == 'RUN':
+                    self.phases[i] = 'EXECUTING'
+                elif action == 'ABORT':
+                    self.aborted.add(i)
+                    self.phases[i] = 'ABORTED'
+                return handler.reply(303, headers={'Location': '/tap/async/{}'.format(i)})
+            if self.phases[i] == 'EXECUTING':
+                if self.polls[i] <= 0 and self.final[i] is not None:
+                    self.phases[i] = self.final[i]
+                self.polls[i] -= 1
+            phase = self.phases[i]
+        handler.reply(200, phase.encode())
+
+
+QUERY = 'SELECT * FROM stand.in'
+
+
+def test_query_many_returns_results_in_order(http_server, votable):
+    service = UWSService(http_server, votable, polls=[3, 0, 1], final=['COMPLETED'] * 3)
+    results = TapClass().query_many(service.url, [QUERY] * 3, poll_interval=0.01)
+    assert [len(t) for t in results] == [3, 3, 3]
+    assert not service.aborted
+
+
+def test_failed_job_gives_error_table(http_server, votable):
+    service = UWSService(http_server, votable, polls=[0, 0], final=['COMPLETED', 'ERROR'])
+    results = TapClass().query_many(service.url, [QUERY] * 2, max_workers=1, poll_interval=0.01)
+    assert len(results[0]) == 3
+    assert 'ERROR' in results[1].meta['error'] and 'query failed' in results[1].meta['error']
+
+
+def test_job_timeout_aborts_the_job(http_server, votable):
+    service = UWSService(http_server, votable, polls=[0, 0], final=['COMPLETED', None])
+    start = time.monotonic()
+    results = TapClass().query_many(service.url, [QUERY] * 2, max_workers=1, poll_interval=0.01, job_timeout=0.3)
+    assert time.monotonic() - start < 5
+    assert len(results[0]) == 3
+    assert 'did not finish' in results[1].meta['error']
+    assert service.aborted == {1}
+
+
+def test_closing_early_does_not_wait_for_running_jobs(http_server, votable):
+    service = UWSService(http_server, votable, polls=[0, 0, 0], final=['COMPLETED', None, None])
+    results = TapClass().iter_query_many(service.url, [QUERY] * 3, poll_interval=0.01, max_poll_interval=0.05)
+    j, table = next(results)
+    assert len(table) == 3
+    start = time.monotonic()
+    results.close()
+    assert time.monotonic() - start < 2
+    assert service.aborted == {1, 2}
+
+
+def test_wait_stops_when_the_event_is_set(http_server, votable):
+    service = UWSService(http_server, votable, polls=[0], final=[None])
+    job = TapClass().submit_job(service.url, QUERY)
+    assert isinstance(job, AsyncJob)
+    stop = threading.Event()
+    threading.Timer(0.2, stop.set).start()
+    start = time.monotonic()
+    assert job.wait(poll_interval=10., stop=stop) == 'EXECUTING'
+    assert time.monotonic() - start < 2
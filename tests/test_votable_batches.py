@@ -0,0 +1,42 @@
+import io
+
+import numpy as np
+import pytest
+from astropy.table import Table, vstack
+
+from navo_utils import utils
+from navo_utils.tap import Tap
+
+
+def _reference(content):
+    table = Table.read(io.BytesIO(content), format='votable')
+    utils.stringify_table(table)
+    return table
+
+
+def _assert_same(table, reference):
+    assert table.colnames == reference.colnames
+    for name in reference.colnames:
+        assert np.array_equal(np.ma.getdata(table[name]), np.ma.getdata(reference[name])), name
+
+
+@pytest.mark.parametrize('kind', ['cone', 'tap', 'registry'])
+def test_batches_match_full_parse(votable, kind):
+    content = votable(kind, rows=25, width=8, columns=3)
+    batches = list(utils.iter_votable_batches(io.BytesIO(content), batch_size=10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    _assert_same(vstack(batches), _reference(content))
+
+
+def test_batches_as_arrays(votable):
+    content = votable('tap', rows=12)
+    batches = list(utils.iter_votable_batches(io.BytesIO(content), batch_size=5, as_table=False))
+    assert [len(b) for b in batches] == [5, 5, 2]
+    assert all(isinstance(b, np.ndarray) for b in batches)
+
+
+def test_tap_query_stream(standin, votable):
+    url = standin.url('tap', rows=30)
+    batches = list(Tap.query(url, 'SELECT * FROM stand.in', stream=True, batch_size=8))
+    assert [len(b) for b in batches] == [8, 8, 8, 6]
+    _assert_same(vstack(batches), Tap.query(url, 'SELECT * FROM stand.in'))
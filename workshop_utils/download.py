@@ -0,0 +1,533 @@
+"""
+Bulk download manager.
+"""
+
+#
+# Imports
+#
+import concurrent.futures
+import os
+import os.path as path
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from navo_utils.retry import RetryPolicy
+
+from .utils import output_path
+
+__all__ = ['BulkDownloader', 'DownloadResult', 'DownloadPlan', 'plan_downloads', 'download_files']
+
+class DownloadResult:
+    """
+    Outcome of one file download.
+
+    Attributes
+    ----------
+    url : str
+        The URL downloaded.
+    path : str
+        The output path, or None if it could not be determined.
+    status : str
+        'downloaded', 'resumed', 'skipped' or 'failed'.
+    nbytes : int
+        Bytes received over the network for this file.
+    error : str
+        The error message for a failed download, else None.
+    """
+
+    def __init__(self, url, path=None, status='failed', nbytes=0, error=None):
+        self.url = url
+        self.path = path
+        self.status = status
+        self.nbytes = nbytes
+        self.error = error
+
+    def __repr__(self):
+        return 'DownloadResult({!r}, path={!r}, status={!r}, nbytes={})'.format(
+            self.url, self.path, self.status, self.nbytes)
+
+
+class BulkDownloader:
+    """
+    Downloads many files concurrently.
+
+    Each file is received into a .part file next to its output path and
+    renamed into place only when complete, so an output file is never left
+    half written.  An interrupted transfer is resumed from its .part file with
+    an HTTP Range request when the server supports it.  Files that already
+    exist with the expected size are skipped.  URLs that resolve to the same
+    output path are transferred one after the other, never at the same time.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to which to write the files (default: current directory).
+    max_workers : int
+        Number of files transferred at the same time.
+    max_per_host : int
+        Maximum number of simultaneous transfers from any one host.
+    timeout : float
+        Seconds to wait for a server to respond or send more data.
+    retries : int
+        Total number of attempts per file; each retry resumes where the last stopped.
+    retry_policy : navo_utils.retry.RetryPolicy
+        Sets the backoff between attempts (default RetryPolicy()) and, by its
+        retry_statuses, the HTTP error statuses worth another attempt; other
+        error statuses fail the file at once.
+    decompress : bool
+        Decompress gzip-compressed files as they arrive, writing the output
+        without its .gz suffix.
+    chunk_size : int
+        Bytes read from the network at a time.
+    verbose : bool
+        Print a line per file and a throughput summary.
+    """
+
+    def __init__(self, directory=None, max_workers=8, max_per_host=4, timeout=60, retries=3, retry_policy=None,
+                 decompress=False, chunk_size=1024*1024, verbose=False):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.decompress = decompress
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Byte ranges must refer to the file itself, not a compressed transfer of it.
+        self.session.headers['Accept-Encoding'] = 'identity'
+
+        self._host_limits = {}
+        self._path_locks = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Reset the aggregate transfer statistics.
+        """
+        with self._lock:
+            self.bytes_received = 0
+            self.elapsed = 0.
+            self.counts = {'downloaded': 0, 'resumed': 0, 'skipped': 0, 'failed': 0}
+
+    def throughput(self):
+        """
+        Return the aggregate throughput, in bytes per second, of the downloads so far.
+        """
+        return self.bytes_received / self.elapsed if self.elapsed > 0 else 0.
+
+    def report(self):
+        """
+        Print a summary of the downloads so far.
+        """
+        print('{downloaded} downloaded, {resumed} resumed, {skipped} skipped, {failed} failed'.format(**self.counts))
+        print('{:.1f} MB in {:.1f} s ({:.2f} MB/s)'.format(self.bytes_received / 1e6, self.elapsed,
+                                                          self.throughput() / 1e6))
+
+    def _host_limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            sem = self._host_limits.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_per_host)
+                self._host_limits[host] = sem
+        return sem
+
+    def _path_lock(self, out_path):
+        key = path.abspath(out_path)
+        with self._lock:
+            lock = self._path_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._path_locks[key] = lock
+        return lock
+
+    def download(self, urls, filenames=None, sizes=None):
+        """
+        Download files concurrently.
+
+        Parameters
+        ----------
+        urls : list of str
+            The URLs to download.
+        filenames : list of str
+            Output filenames, one per URL (None entries, or no list, mean
+            the name is worked out as by download_file).
+        sizes : list of int
+            Expected file sizes in bytes, used to skip files already present
+            when the server does not report a size.
+
+        Returns
+        -------
+        list of DownloadResult
+            One result per URL, in the same order.
+        """
+        urls = list(urls)
+        if filenames is None:
+            filenames = [None] * len(urls)
+        if sizes is None:
+            sizes = [None] * len(urls)
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.download_one, urls, filenames, sizes))
+        with self._lock:
+            self.elapsed += time.perf_counter() - start
+
+        if self.verbose:
+            self.report()
+        return results
+
+    def download_plan(self, plan):
+        """
+        Download the files of a DownloadPlan, each worker queue on its own thread.
+
+        Returns
+        -------
+        list of DownloadResult
+            One result per file, in the order of plan.urls.
+        """
+        def run_queue(queue):
+            return [self.download_one(url, size=size) for url, size, estimate in queue]
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(plan.queues))) as executor:
+            results = [r for queue_results in executor.map(run_queue, plan.queues) for r in queue_results]
+        with self._lock:
+            self.elapsed += time.perf_counter() - start
+
+        if self.verbose:
+            self.report()
+        return results
+
+    def download_one(self, url, filename=None, size=None):
+        """
+        Download one file, retrying and resuming as needed.
+
+        Returns
+        -------
+        DownloadResult
+        """
+        result = DownloadResult(url)
+        with self._host_limit(url):
+            for attempt in range(self.retries):
+                if attempt > 0:
+                    time.sleep(self.retry_policy.backoff(attempt))
+                try:
+                    self._transfer(url, filename, size, result)
+                    result.error = None
+                    break
+                except (requests.exceptions.RequestException, OSError, zlib.error) as e:
+                    result.status = 'failed'
+                    result.error = repr(e)
+                    # Statuses such as 404 or 403 won't change on another try.
+                    give_up = attempt == self.retries - 1 or (
+                        isinstance(e, requests.exceptions.HTTPError) and e.response is not None and
+                        e.response.status_code not in self.retry_policy.retry_statuses)
+                    if self.verbose:
+                        print('WARNING: download of {} failed ({}); {}'.format(
+                            url, e, 'giving up.' if give_up else 'trying again.'))
+                    if give_up:
+                        break
+
+        with self._lock:
+            self.counts[result.status] += 1
+            self.bytes_received += result.nbytes
+        if self.verbose and result.status != 'failed':
+            print('    {} {} ({} bytes)'.format(result.status, result.path, result.nbytes))
+        return result
+
+    def _transfer(self, url, filename, size, result):
+        response = self.session.get(url, stream=True, timeout=self.timeout)
+        try:
+            response.raise_for_status()
+            out_path = output_path(url, response, self.directory, filename)[3]
+            gzipped = self.decompress and (out_path.endswith('.gz') or
+                                           response.headers.get('content-type', '').endswith('gzip'))
+            if gzipped and out_path.endswith('.gz'):
+                out_path = out_path[:-3]
+            result.path = out_path
+
+            # Different URLs can share an output name (e.g. cgi access URLs),
+            # and two transfers into one .part file would corrupt it.
+            with self._path_lock(out_path):
+                self._receive(url, response, out_path, gzipped, size, result)
+        finally:
+            response.close()
+
+    def _receive(self, url, response, out_path, gzipped, size, result):
+        # Skip files already downloaded.  The size of a decompressed file
+        # isn't known in advance, so then its presence has to do.
+        expected = _content_length(response, size)
+        if path.exists(out_path) and (gzipped or expected is not None and path.getsize(out_path) == expected):
+            result.status = 'skipped'
+            return
+
+        part_path = out_path + '.part'
+        offset = path.getsize(part_path) if path.exists(part_path) else 0
+        if offset > 0 and response.headers.get('accept-ranges', '').lower() == 'bytes':
+            ranged = self.session.get(url, stream=True, timeout=self.timeout,
+                                      headers={'Range': 'bytes={}-'.format(offset)})
+            try:
+                content_range = _content_range(ranged)
+                if ranged.status_code == 416 and content_range is not None and content_range[2] == offset:
+                    # The .part file already holds the whole file.
+                    return self._write(iter(()), out_path, part_path, offset, gzipped, result)
+                if ranged.status_code == 206:
+                    if content_range is not None and content_range[0] == offset:
+                        return self._write(ranged.iter_content(self.chunk_size), out_path, part_path, offset,
+                                           gzipped, result)
+                    # Not the bytes asked for: start again from the beginning.
+                elif ranged.status_code != 416:
+                    ranged.raise_for_status()
+                    # The server sent the whole file.
+                    return self._write(ranged.iter_content(self.chunk_size), out_path, part_path, 0, gzipped,
+                                       result)
+                # Otherwise the .part file is longer than the file: start again.
+            finally:
+                ranged.close()
+        self._write(response.iter_content(self.chunk_size), out_path, part_path, 0, gzipped, result)
+
+    def _write(self, chunks, out_path, part_path, offset, gzipped, result):
+        """
+        Writes chunks into the .part file from offset (0: start it afresh),
+        then moves the file (or, with gzipped, its decompressed content) into place.
+        """
+        # The .part file holds the bytes exactly as sent, so it can be resumed.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        tmp_path = out_path + '.tmp'
+        with open(part_path, 'r+b' if offset else 'wb') as part_file:
+            part_file.truncate(offset)
+            part_file.seek(offset)
+            out_file = open(tmp_path, 'wb') if decompressor else None
+            try:
+                if decompressor and offset:
+                    # Rebuild the decompressor state from the bytes already here.
+                    with open(part_path, 'rb') as done:
+                        for chunk in iter(lambda: done.read(self.chunk_size), b''):
+                            out_file.write(decompressor.decompress(chunk))
+                for chunk in chunks:
+                    part_file.write(chunk)
+                    result.nbytes += len(chunk)
+                    if decompressor:
+                        out_file.write(decompressor.decompress(chunk))
+                if decompressor:
+                    out_file.write(decompressor.flush())
+            finally:
+                if out_file is not None:
+                    out_file.close()
+
+        if decompressor:
+            os.replace(tmp_path, out_path)
+            os.remove(part_path)
+        else:
+            os.replace(part_path, out_path)
+        result.status = 'resumed' if offset else 'downloaded'
+
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)')
+
+
+def _content_length(response, default=None):
+    """
+    Return the Content-Length of a response, or default if the header is
+    missing or malformed.  A list of equal values counts as one value.
+    """
+    values = {v.strip() for v in response.headers.get('content-length', '').split(',')}
+    if len(values) != 1:
+        return default
+    try:
+        value = int(values.pop())
+    except ValueError:
+        return default
+    return value if value >= 0 else default
+
+
+def _content_range(response):
+    """
+    Return (first byte, last byte, total size) from the Content-Range header
+    of a response, with None for values not given, or None without the header.
+    """
+    match = _CONTENT_RANGE.match(response.headers.get('content-range', ''))
+    if match is None:
+        return None
+    return tuple(int(v) if v is not None and v != '*' else None for v in match.groups())
+
+
+class DownloadPlan:
+    """
+    Files to download, packed into one queue per worker by estimated size.
+
+    Attributes
+    ----------
+    queues : list of list of (str, int or None, int)
+        For each worker, the (url, size, estimate) of the files it downloads,
+        in order.  size is the size in bytes given by the query results, or
+        None where they do not give one; estimate is the size used for
+        planning, which is the median known size where size is None.
+    loads : list of int
+        Estimated bytes for each worker.
+    excluded : list of (str, int or None, int)
+        Files left out because they did not fit in the byte budget.
+    duplicates : int
+        Number of repeated access URLs dropped.
+    """
+
+    def __init__(self, queues, loads, excluded, duplicates):
+        self.queues = queues
+        self.loads = loads
+        self.excluded = excluded
+        self.duplicates = duplicates
+
+    @property
+    def total_bytes(self):
+        return sum(self.loads)
+
+    @property
+    def urls(self):
+        return [url for queue in self.queues for url, size, estimate in queue]
+
+    def report(self):
+        """
+        Print a summary of the plan.
+        """
+        print('{} files, {:.1f} MB over {} workers (largest worker {:.1f} MB); '
+              '{} over budget, {} duplicates dropped'.format(
+                  sum(len(q) for q in self.queues), self.total_bytes / 1e6, len(self.queues),
+                  max(self.loads, default=0) / 1e6, len(self.excluded), self.duplicates))
+
+
+def _access_urls_and_sizes(table):
+    """
+    Return the access URLs and estimated sizes (None where unknown) of an
+    ImageTable, SpectraTable or other VO result table.
+    """
+    import html
+    import numpy as np
+    from navo_utils.image import ImageColumn, ImageTable
+    from navo_utils.spectra import SpectraColumn, SpectraTable
+
+    if not isinstance(table, (ImageTable, SpectraTable)):
+        image_table = ImageTable(table, copy=False)
+        table = image_table if image_table.stdcol_to_colname(ImageColumn.ACCESS_URL) else SpectraTable(table, copy=False)
+    if isinstance(table, ImageTable):
+        url_col, size_col = table[ImageColumn.ACCESS_URL], table[ImageColumn.FILESIZE]
+    else:
+        url_col, size_col = table[SpectraColumn.ACCESS_URL], table[SpectraColumn.SIZE]
+    if url_col is None:
+        raise ValueError('table has no access URL column.')
+
+    urls = [html.unescape(str(u)) for u in url_col]
+    if size_col is None:
+        return urls, [None] * len(urls)
+    mask = np.ma.getmaskarray(size_col)
+    sizes = [None if m else int(float(v)) for v, m in zip(np.ma.getdata(size_col), mask)]
+    return urls, sizes
+
+
+def plan_downloads(tables, workers=8, byte_budget=None):
+    """
+    Plan the download of the files in image or spectra query results so that
+    the transfers finish as soon as possible.
+
+    The files are deduplicated by access URL across all tables.  With a byte
+    budget, files are taken in table order while they fit.  They are then
+    packed largest first, each onto the worker with the least work so far,
+    which keeps a few large files from being left until the end.  Files
+    without a size are planned as if they were of the median known size,
+    but that estimate is not used as their expected size when downloading.
+
+    Parameters
+    ----------
+    tables : ImageTable, SpectraTable, or list of them
+        Results of Image.query or Spectra.query.
+    workers : int
+        Number of workers to plan for.
+    byte_budget : int
+        Maximum total estimated bytes to download.
+
+    Returns
+    -------
+    DownloadPlan
+        The plan, to run with BulkDownloader.download_plan.
+    """
+    import heapq
+    import numpy as np
+    from astropy.table import Table
+
+    if isinstance(tables, Table):
+        tables = [tables]
+
+    seen = set()
+    items = []
+    duplicates = 0
+    for table in tables:
+        if len(table) == 0:
+            continue
+        for url, size in zip(*_access_urls_and_sizes(table)):
+            if url in seen:
+                duplicates += 1
+                continue
+            seen.add(url)
+            items.append((url, size))
+
+    known = [size for url, size in items if size is not None]
+    default_size = int(np.median(known)) if known else 0
+    items = [(url, size, default_size if size is None else size) for url, size in items]
+
+    excluded = []
+    if byte_budget is not None:
+        chosen = []
+        total = 0
+        for item in items:
+            if total + item[2] <= byte_budget:
+                chosen.append(item)
+                total += item[2]
+            else:
+                excluded.append(item)
+    else:
+        chosen = items
+
+    # Longest-processing-time-first scheduling onto the least loaded worker.
+    queues = [[] for i in range(workers)]
+    heap = [(0, i) for i in range(workers)]
+    for item in sorted(chosen, key=lambda item: -item[2]):
+        load, i = heapq.heappop(heap)
+        queues[i].append(item)
+        heapq.heappush(heap, (load + item[2], i))
+    loads = [sum(estimate for url, size, estimate in queue) for queue in queues]
+
+    return DownloadPlan(queues, loads, excluded, duplicates)
+
+
+def download_files(urls, directory=None, **kwargs):
+    """
+    Download many files concurrently with a BulkDownloader.
+
+    Parameters
+    ----------
+    urls : list of str
+        The URLs to download.
+    directory : str
+        The directory to which to write the files.
+    **kwargs
+        Other BulkDownloader parameters.
+
+    Returns
+    -------
+    list of DownloadResult
+        One result per URL, in the same order.
+    """
+    return BulkDownloader(directory=directory, **kwargs).download(urls)
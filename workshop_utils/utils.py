@@ -10,8 +10,6 @@ import re
 import os.path as path
 import requests
 
-from IPython.display import Markdown, display
-
 def print_registry_row(row):
     """
     Pretty print registry result row.
@@ -25,13 +23,64 @@ def print_registry_row(row):
     -------
     None
     """
+    # IPython is only needed for display, not by the download functions below.
+    from IPython.display import Markdown, display
+
     md = '### {} ({})'.format(row['short_name'], row['ivoid'])
     display(Markdown(md))
     print(row['res_description'])
     print('More info: {}'.format(row['reference_url']))
     print('Access URL: {}'.format(row['access_url']))
 
-def download_file(url, directory=None, filename=None, verbose=False):
+def output_path(url, response, directory=None, filename=None):
+    """
+    Compute the path to write a downloaded file to, using the filename when
+    given, else a filename suggested by the response's content-disposition,
+    else the base filename from the URL.
+
+    Parameters
+    ----------
+    url : str
+        This URL from which the file is retrieved.
+    response : requests.Response
+        The response to the request for the file.
+    directory : str
+        The directory to which to write the file, or None.
+    filename : str
+        The filename to which to write the file, or None.
+
+    Returns
+    -------
+    tuple
+        The content-disposition filename (or None), the base filename from the
+        URL, the chosen base filename, and the full output path.
+    """
+    # See if the response header suggests a filename.
+    cd = response.headers.get('content-disposition', '')
+    re_results = re.findall("filename=(.+)", cd)
+    cd_fname = None
+    if len(re_results) > 0:
+        cd_fname = re_results[0].replace('"', '')
+
+    #Remove the path from the URL to isolate the name we should output to file.
+    url_basename = path.basename(url)
+
+    # Compute base_filename, using the parameter value if it exists.
+    base_filename = filename
+    if base_filename is None:
+        if cd_fname is not None:
+            base_filename = cd_fname
+        else:
+            base_filename = url_basename
+
+    # Compute the full path.
+    out_path = base_filename
+    if directory is not None:
+        out_path = path.join(directory, base_filename)
+
+    return cd_fname, url_basename, base_filename, out_path
+
+def download_file(url, directory=None, filename=None, verbose=False, timeout=60):
     """
     Download a file from the specified URL, making a best guess at the
     output file name when no file name specified.  The logic works as
@@ -56,6 +105,8 @@ def download_file(url, directory=None, filename=None, verbose=False):
         The filename to which to write the file.  When specified,
         the file will be written to that name.  filename may contain
         a directory path only if the directory param is not specified.
+    timeout : float
+        Seconds to wait for the server to respond.
 
     Returns
     -------
@@ -69,30 +120,9 @@ def download_file(url, directory=None, filename=None, verbose=False):
             raise ValueError('directory cannot be specified if filename contains a dirname.')
 
     #Send a request for this file.
-    response = requests.get(url, stream=True)
+    response = requests.get(url, stream=True, timeout=timeout)
 
-    # See if the response header suggests a filename.
-    cd = response.headers.get('content-disposition', '')
-    re_results = re.findall("filename=(.+)", cd)
-    cd_fname = None
-    if len(re_results) > 0:
-        cd_fname = re_results[0].replace('"', '')
-
-    #Remove the path from the URL to isolate the name we should output to file.
-    url_basename = path.basename(url)
-
-    # Compute base_filename, using the parameter value if it exists.
-    base_filename = filename
-    if base_filename is None:
-        if cd_fname is not None:
-            base_filename = cd_fname
-        else:
-            base_filename = url_basename
-
-    # Compute the full path.
-    out_path = base_filename
-    if directory is not None:
-        out_path = path.join(directory, base_filename)
+    cd_fname, url_basename, base_filename, out_path = output_path(url, response, directory, filename)
 
     # Verbose output
     if verbose: